@@ -27,6 +27,32 @@ Usage:
 >>> Md5Sum.md5sum("myfile.txt")
 ... eacc9c036025f0e64fb724cacaadd8b4
 
+The checksums function generates several different types of
+checksum (MD5, SHA1, SHA256 and CRC32) in a single pass through
+the file:
+
+>>> Md5sum.checksums("myfile.txt",('md5','sha256'))
+... ('eacc9c036025f0e64fb724cacaadd8b4', '2c26b46b68ffc68f...')
+
+The copy_and_checksums function copies a file and generates its
+checksums from the same read of the data, and drop_cache can be
+used to make sure that the copy is subsequently re-read from disk
+(rather than from memory) when verifying it.
+
+Sparse files (e.g. virtual machine images) are detected automatically:
+only the regions which contain data are read, and the holes are fed to
+the checksums as runs of zeroes, so the checksums are the same as for
+reading every byte but the I/O depends on the amount of data actually
+allocated (see data_extents).
+
+All reads can be rate-limited by installing a throttle.Throttle
+object (see the throttle module).
+
+The md5sum_decompressed function generates the MD5 sum of the
+uncompressed contents of a gzip, bzip2 or xz compressed file without
+writing the uncompressed data to disk; decompression runs in a
+separate thread from the checksum generation.
+
 This module implements two methods for generating the md5 digest of a file:
 the first uses a method based on the hashlib module, while the second (used
 as a fallback for pre-2.5 Python) uses the now deprecated md5 module. Note
@@ -37,12 +63,29 @@ however that the md5sum function determines itself which method to use.
 # Import modules that this module depends on
 #######################################################################
 
+import os
+import zlib
+import errno
 try:
     # Preferentially use hashlib module
     import hashlib
 except ImportError:
     # hashlib not available, use deprecated md5 module
     import md5
+import threading
+import Queue
+import StringIO
+import gzip
+import bz2
+try:
+    import lzma
+except ImportError:
+    # Python 2 needs the backports.lzma package for xz
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+import throttle
 
 #######################################################################
 # Modules constants
@@ -50,6 +93,153 @@ except ImportError:
 
 BLOCKSIZE = 1024*1024
 
+# Supported checksum algorithms
+ALGORITHMS = ('md5','sha1','sha256','crc32')
+
+# posix_fadvise advice value for dropping cached pages (Linux)
+POSIX_FADV_DONTNEED = 4
+
+# Number of blocks to read ahead when reading in a separate thread
+READ_AHEAD = 4
+
+# lseek whence values for finding data and holes in sparse files (Linux)
+SEEK_DATA = getattr(os,'SEEK_DATA',3)
+SEEK_HOLE = getattr(os,'SEEK_HOLE',4)
+
+# Files are treated as sparse if the space allocated on disk is less
+# than this fraction of their size
+SPARSE_RATIO = 0.5
+
+# Block of zeroes used for the holes in sparse files
+ZERO_BLOCK = '\0'*BLOCKSIZE
+
+# File extensions for compressed files, and functions which return
+# a file-like object reading the uncompressed data from the file
+# object of the compressed file
+DECOMPRESSORS = { '.gz': lambda fp: gzip.GzipFile(fileobj=fp,mode='rb'),
+                  '.bz2': lambda fp: Bz2Reader(fp) }
+if lzma is not None:
+    DECOMPRESSORS['.xz'] = lambda fp: lzma.LZMAFile(fp)
+
+#######################################################################
+# Classes
+#######################################################################
+
+class Crc32:
+    """Class providing a hashlib-style interface for CRC32 checksums
+
+    The checksum is generated using zlib.crc32 and is reported
+    as 8 hex digits (i.e. the same as the 'crc32' utility).
+
+    """
+    def __init__(self):
+        self._crc = 0
+
+    def update(self,data):
+        """Update the checksum with more data
+        """
+        self._crc = zlib.crc32(data,self._crc)
+
+    def digest(self):
+        """Return the checksum as a string of bytes
+        """
+        crc = self._crc & 0xffffffff
+        return ''.join([chr((crc >> shift) & 0xff)
+                        for shift in (24,16,8,0)])
+
+class ThrottledReader:
+    """Class wrapping a file object so that reads use the throttle
+
+    Each read is accounted for using throttle.data_read, so
+    that data read by other code (e.g. a decompressor) is
+    subject to the limit on the read rate.
+
+    """
+    def __init__(self,fp):
+        self._fp = fp
+
+    def read(self,size=-1):
+        data = self._fp.read(size)
+        throttle.data_read(len(data))
+        return data
+
+    def __getattr__(self,name):
+        return getattr(self._fp,name)
+
+class Bz2Reader:
+    """Class reading uncompressed data from a bzip2 file object
+
+    Unlike bz2.BZ2File this reads from a file object rather than
+    a file name, and also handles files consisting of several
+    concatenated bzip2 streams (e.g. as written by pbzip2).
+
+    """
+    def __init__(self,fp):
+        self._fp = fp
+        self._decompressor = bz2.BZ2Decompressor()
+        self._buffer = ''
+        self._eof = False
+
+    def read(self,size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self._fp.read(BLOCKSIZE)
+            if not data:
+                self._eof = True
+                break
+            self._decompress(data)
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        self._buffer = ''
+
+    def _decompress(self,data):
+        while data:
+            try:
+                self._buffer += self._decompressor.decompress(data)
+            except EOFError:
+                # Previous stream has ended, so start the next one
+                self._decompressor = bz2.BZ2Decompressor()
+                continue
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = bz2.BZ2Decompressor()
+
+class DecompressedFile:
+    """Class for reading the uncompressed contents of a compressed file
+
+    The compressed file is read in blocks via the throttle (see
+    ThrottledReader) and decompressed using the appropriate
+    function from DECOMPRESSORS.
+
+    Raises IOError if the compression type isn't supported.
+
+    """
+    def __init__(self,filen):
+        try:
+            decompressor = DECOMPRESSORS[compression_type(filen)]
+        except KeyError:
+            raise IOError("%s: unsupported compression type" % filen)
+        throttle.file_opened()
+        self._raw = open(filen,'rb')
+        try:
+            self._fp = decompressor(ThrottledReader(self._raw))
+        except:
+            self._raw.close()
+            raise
+
+    def read(self,size=-1):
+        return self._fp.read(size)
+
+    def close(self):
+        try:
+            self._fp.close()
+        finally:
+            self._raw.close()
+
 #######################################################################
 # Functions
 #######################################################################
@@ -77,23 +267,404 @@ def md5sum(filen):
     Returns:
       Md5sum digest for the named file.
     """
+    return checksums(filen,('md5',))[0]
+
+def md5sum_stream(fp,threaded=False):
+    """Return md5sum digest for the data read from a file-like object
+
+    Data is read in blocks until the end of the stream is reached,
+    so this can be used with e.g. members of tar or zip archives
+    without needing to extract them first.
+
+    Arguments:
+      fp: file-like object opened for reading in binary mode
+      threaded: if True then read from the stream in a separate
+        thread (useful if reading involves work, for example
+        decompression, that can overlap with the checksumming)
+
+    Returns:
+      Md5sum digest for the data in the stream.
+    """
+    return checksums_stream(fp,('md5',),threaded=threaded)[0]
+
+def checksums(filen,algorithms=ALGORITHMS):
+    """Return multiple checksums for a file
+
+    The file is only read once, with each block being used to
+    update all the requested checksums.
+
+    Arguments:
+      filen: name of the file to generate the checksums from
+      algorithms: list of checksum algorithms (any of those
+        in ALGORITHMS)
+
+    Files which are smaller than BLOCKSIZE are read using a
+    single read.
+
+    Returns:
+      Tuple of the digests for each of the algorithms, in the
+      order that they were requested.
+    """
+    throttle.file_opened()
+    with open(filen, "rb") as f:
+        st = os.fstat(f.fileno())
+        if is_sparse(st):
+            blocks = sparse_blocks(f,st.st_size)
+        else:
+            blocks = file_blocks(f)
+        return checksum_blocks(blocks,algorithms)
+
+def checksums_stream(fp,algorithms=ALGORITHMS,threaded=False):
+    """Return multiple checksums for the data read from a file-like object
+
+    Arguments:
+      fp: file-like object opened for reading in binary mode
+      algorithms: list of checksum algorithms (any of those
+        in ALGORITHMS)
+      threaded: if True then read from the stream in a separate
+        thread (see md5sum_stream)
+
+    Returns:
+      Tuple of the digests for each of the algorithms, in the
+      order that they were requested.
+    """
+    if threaded:
+        blocks = read_ahead(fp)
+    else:
+        blocks = throttled(iter(lambda: fp.read(BLOCKSIZE), ''))
+    return checksum_blocks(blocks,algorithms)
+
+def checksum_blocks(blocks,algorithms=ALGORITHMS):
+    """Return multiple checksums for a sequence of blocks of data
+
+    Arguments:
+      blocks: iterable returning blocks of data
+      algorithms: list of checksum algorithms (any of those
+        in ALGORITHMS)
+
+    Returns:
+      Tuple of the digests for each of the algorithms, in the
+      order that they were requested.
+    """
+    chksums = [new_checksum(algorithm) for algorithm in algorithms]
+    for block in blocks:
+        for chksum in chksums:
+            chksum.update(block)
+    return tuple([hexify(chksum.digest()) for chksum in chksums])
+
+def file_blocks(fp):
+    """Generator returning blocks of data read from a file
+
+    Reading stops at the first block which is shorter than
+    BLOCKSIZE, so a file smaller than BLOCKSIZE is read using
+    a single read (rather than needing a second read to detect
+    the end of the file).
+
+    Nb this relies on 'read' always returning a full block
+    unless the end of the file has been reached, which is the
+    case for regular files but may not be for other streams.
+
+    Arguments:
+      fp: file object opened for reading in binary mode
+    """
+    while True:
+        block = fp.read(BLOCKSIZE)
+        throttle.data_read(len(block))
+        if block:
+            yield block
+        if len(block) < BLOCKSIZE:
+            return
+
+def is_sparse(st):
+    """Check if a file is sparse
+
+    A file is considered to be sparse if the space allocated
+    for it on disk is less than SPARSE_RATIO of its size (and
+    the size is at least BLOCKSIZE).
+
+    Arguments:
+      st: result of os.stat for the file
+    """
+    blocks = getattr(st,'st_blocks',None)
+    if blocks is None or st.st_size < BLOCKSIZE:
+        return False
+    return blocks*512 < st.st_size*SPARSE_RATIO
+
+def data_extents(fp,size):
+    """Generator returning the regions of a file which contain data
+
+    Uses lseek with SEEK_DATA and SEEK_HOLE to skip over the
+    holes in a sparse file. If these aren't supported then the
+    whole file is returned as a single region.
+
+    Arguments:
+      fp: file object opened for reading
+      size: size of the file in bytes
+
+    Returns:
+      Tuples (offset,length) for each region.
+    """
+    fd = fp.fileno()
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd,offset,SEEK_DATA)
+        except OSError,ex:
+            if ex.errno == errno.ENXIO:
+                # No more data (the rest of the file is a hole)
+                return
+            if offset == 0 and ex.errno in (errno.EINVAL,errno.ENOTSUP):
+                # Not supported by this system or filesystem
+                yield (0,size)
+                return
+            raise
+        end = min(os.lseek(fd,start,SEEK_HOLE),size)
+        if end > start:
+            yield (start,end-start)
+        offset = end
+
+def sparse_blocks(fp,size):
+    """Generator returning blocks of data from a sparse file
+
+    Only the regions of the file which contain data are read
+    (see data_extents); blocks of zeroes are returned for the
+    holes between them. The blocks returned are the same as
+    for reading the file from start to finish (although their
+    sizes may differ).
+
+    Arguments:
+      fp: file object opened for reading in binary mode
+      size: size of the file in bytes
+    """
+    position = 0
+    for offset,length in data_extents(fp,size):
+        for block in zero_blocks(offset-position):
+            yield block
+        fp.seek(offset)
+        position = offset
+        end = offset + length
+        while position < end:
+            block = fp.read(min(BLOCKSIZE,end-position))
+            throttle.data_read(len(block))
+            if not block:
+                # File was truncated
+                return
+            position += len(block)
+            yield block
+    for block in zero_blocks(size-position):
+        yield block
+
+def throttled(blocks):
+    """Generator returning blocks, accounting for them with the throttle
+
+    """
+    for block in blocks:
+        throttle.data_read(len(block))
+        yield block
+
+def zero_blocks(nbytes):
+    """Generator returning blocks of zeroes totalling 'nbytes'
+
+    """
+    while nbytes > 0:
+        if nbytes >= BLOCKSIZE:
+            yield ZERO_BLOCK
+        else:
+            yield ZERO_BLOCK[:nbytes]
+        nbytes -= BLOCKSIZE
+
+def copy_and_checksums(src,dst,algorithms=('md5',)):
+    """Copy a file and return checksums for the copied data
+
+    The checksums are generated from the data as it is read
+    from the source file, so the source is only read once. The
+    destination file is flushed to disk before returning.
+
+    Arguments:
+      src: name of the file to copy
+      dst: name of the file to copy to (will be overwritten if
+        it already exists)
+      algorithms: list of checksum algorithms (any of those
+        in ALGORITHMS)
+
+    Returns:
+      Tuple of the digests for each of the algorithms, in the
+      order that they were requested.
+    """
+    chksums = [new_checksum(algorithm) for algorithm in algorithms]
+    throttle.file_opened()
+    with open(src, "rb") as fin:
+        with open(dst, "wb") as fout:
+            for block in throttled(iter(lambda: fin.read(BLOCKSIZE), '')):
+                fout.write(block)
+                for chksum in chksums:
+                    chksum.update(block)
+            fout.flush()
+            os.fsync(fout.fileno())
+    return tuple([hexify(chksum.digest()) for chksum in chksums])
+
+def drop_cache(filen):
+    """Ask the operating system to discard cached data for a file
+
+    Uses posix_fadvise with POSIX_FADV_DONTNEED so that the
+    next read of the file comes from the disk rather than the
+    page cache. This is only advisory, and is only available on
+    some platforms.
+
+    Arguments:
+      filen: name of the file
+
+    Returns:
+      True if the request was made, False if it isn't supported.
+    """
+    fadvise = _get_fadvise()
+    if fadvise is None:
+        return False
+    fd = os.open(filen,os.O_RDONLY)
+    try:
+        return (fadvise(fd,0,0,POSIX_FADV_DONTNEED) in (0,None))
+    finally:
+        os.close(fd)
+
+def _get_fadvise():
+    """Internal: return a posix_fadvise function (or None)
+
+    """
+    try:
+        return os.posix_fadvise
+    except AttributeError:
+        pass
+    # Fall back to calling the C library via ctypes
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        posix_fadvise = libc.posix_fadvise
+    except (ImportError,OSError,AttributeError,TypeError):
+        return None
+    posix_fadvise.argtypes = [ctypes.c_int,ctypes.c_int64,ctypes.c_int64,
+                              ctypes.c_int]
+    return posix_fadvise
+
+def new_checksum(algorithm):
+    """Return a new checksum object for the named algorithm
+
+    The returned object has 'update' and 'digest' methods
+    in the same way as the hashlib objects.
+
+    Raises ValueError if the algorithm isn't one of those in
+    ALGORITHMS (or isn't available).
+
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError("Unsupported checksum algorithm '%s'" % algorithm)
+    if algorithm == 'crc32':
+        return Crc32()
     # Initialise checksum using whatever is available
     try:
-        chksum = hashlib.md5()
+        return hashlib.new(algorithm)
     except NameError:
-        chksum = md5.new()
-    # Generate checksum
+        if algorithm == 'md5':
+            return md5.new()
+        raise ValueError("Checksum algorithm '%s' not available" % algorithm)
+
+def md5sum_head(filen,nbytes=BLOCKSIZE):
+    """Return md5sum digest for the start of a file
+
+    Generates the checksum for only the first 'nbytes' bytes of
+    the file (or the whole file if it is smaller than this), for
+    example to cheaply rule out files as being identical.
+
+    Arguments:
+      filen: name of the file to generate the checksum from
+      nbytes: number of bytes from the start of the file to use
+
+    Returns:
+      Md5sum digest for the start of the named file.
+    """
+    throttle.file_opened()
     with open(filen, "rb") as f:
-        for block in iter(lambda: f.read(BLOCKSIZE), ''):
-            chksum.update(block)
-    return hexify(chksum.digest())
+        return md5sum_stream(StringIO.StringIO(f.read(nbytes)))
+
+def md5sum_decompressed(filen):
+    """Return md5sum digest for the uncompressed contents of a file
+
+    If the file is compressed (i.e. has one of the extensions in
+    DECOMPRESSORS) then the checksum is generated for the
+    uncompressed data, which is never written to disk; otherwise
+    this is the same as md5sum.
+
+    Arguments:
+      filen: name of the file to generate the checksum from
+
+    Returns:
+      Md5sum digest for the uncompressed data.
+    """
+    if compression_type(filen) is None:
+        return md5sum(filen)
+    fp = open_decompressed(filen)
+    try:
+        return md5sum_stream(fp,threaded=True)
+    finally:
+        fp.close()
+
+def compression_type(filen):
+    """Return the compression extension for a file
+
+    Returns the extension (e.g. '.gz') if the file name has
+    one of the extensions in DECOMPRESSORS, otherwise None.
+
+    """
+    ext = os.path.splitext(filen)[1]
+    if ext in DECOMPRESSORS:
+        return ext
+    return None
+
+def open_decompressed(filen):
+    """Open a compressed file for reading its uncompressed contents
+
+    Returns a DecompressedFile object.
+
+    Raises IOError if the compression type isn't supported.
+
+    """
+    return DecompressedFile(filen)
+
+def read_ahead(fp,nblocks=READ_AHEAD):
+    """Generator returning blocks read from a stream in another thread
+
+    A background thread reads up to 'nblocks' blocks ahead of
+    the consumer; any exception raised in the reading thread is
+    re-raised by the generator.
+
+    Arguments:
+      fp: file-like object opened for reading in binary mode
+      nblocks: maximum number of blocks to hold in memory
+    """
+    queue = Queue.Queue(maxsize=nblocks)
+    def reader():
+        try:
+            for block in iter(lambda: fp.read(BLOCKSIZE), ''):
+                queue.put((block,None))
+            queue.put((None,None))
+        except Exception,ex:
+            queue.put((None,ex))
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    while True:
+        block,ex = queue.get()
+        if ex is not None:
+            raise ex
+        if block is None:
+            break
+        yield block
 
 #######################################################################
 # Tests
 #######################################################################
 
 import unittest
-import os
 import tempfile
 
 test_text = """Md5sum is a Python module with functions for generating
@@ -126,6 +697,134 @@ class TestMd5sum(unittest.TestCase):
         self.assertEqual(md5sum(self.filen),
                          '08a6facee51e5435b9ef3744bd4dd5dc')
 
+    def test_md5sum_stream(self):
+        """Test generation of md5sum from a stream
+        """
+        self.assertEqual(md5sum_stream(StringIO.StringIO(test_text)),
+                         '08a6facee51e5435b9ef3744bd4dd5dc')
+
+    def test_md5sum_stream_threaded(self):
+        """Test generation of md5sum from a stream read in another thread
+        """
+        self.assertEqual(md5sum_stream(StringIO.StringIO(test_text),
+                                       threaded=True),
+                         '08a6facee51e5435b9ef3744bd4dd5dc')
+
+    def test_checksums(self):
+        """Test generation of multiple checksums
+        """
+        self.assertEqual(checksums(self.filen),
+                         ('08a6facee51e5435b9ef3744bd4dd5dc',
+                          'ba1d24880695b6681951dc76beb1084f10d4ddbe',
+                          '633cdec614d6651fe12935de9b522d0e'
+                          'cad0d37d00111730343be23165e1ecb3',
+                          'a3ee1a57'))
+        self.assertEqual(checksums(self.filen,('crc32','md5')),
+                         ('a3ee1a57','08a6facee51e5435b9ef3744bd4dd5dc'))
+        self.assertRaises(ValueError,checksums,self.filen,('md4',))
+
+    def test_copy_and_checksums(self):
+        """Test copying a file while generating checksums
+        """
+        dst = self.filen + '.copy'
+        try:
+            self.assertEqual(copy_and_checksums(self.filen,dst),
+                             ('08a6facee51e5435b9ef3744bd4dd5dc',))
+            self.assertEqual(open(dst,'rb').read(),test_text)
+            drop_cache(dst)
+            self.assertEqual(md5sum(dst),'08a6facee51e5435b9ef3744bd4dd5dc')
+        finally:
+            os.remove(dst)
+
+    def test_md5sum_head(self):
+        """Test generation of md5sum for start of file
+        """
+        self.assertEqual(md5sum_head(self.filen,nbytes=6),
+                         md5sum_stream(StringIO.StringIO(test_text[:6])))
+        self.assertEqual(md5sum_head(self.filen),
+                         '08a6facee51e5435b9ef3744bd4dd5dc')
+
+    def test_md5sum_decompressed(self):
+        """Test generation of md5sum for uncompressed contents
+        """
+        self.assertEqual(md5sum_decompressed(self.filen),
+                         '08a6facee51e5435b9ef3744bd4dd5dc')
+        for ext,open_compressed in (('.gz',gzip.open),('.bz2',bz2.BZ2File)):
+            filen = self.filen + ext
+            fp = open_compressed(filen,'wb')
+            fp.write(test_text)
+            fp.close()
+            try:
+                self.assertEqual(compression_type(filen),ext)
+                self.assertEqual(md5sum_decompressed(filen),
+                                 '08a6facee51e5435b9ef3744bd4dd5dc')
+            finally:
+                os.remove(filen)
+
+    def test_md5sum_decompressed_bz2_streams(self):
+        """Test md5sum for uncompressed contents of multi-stream bzip2 file
+        """
+        filen = self.filen + '.bz2'
+        fp = open(filen,'wb')
+        for text in test_text.split('\n'):
+            fp.write(bz2.compress(text+'\n'))
+        fp.close()
+        try:
+            self.assertEqual(md5sum_decompressed(filen),
+                             md5sum_stream(StringIO.StringIO(test_text+'\n')))
+        finally:
+            os.remove(filen)
+
+    def test_md5sum_decompressed_is_throttled(self):
+        """Test compressed data is read in blocks via the throttle
+        """
+        filen = self.filen + '.gz'
+        fp = gzip.open(filen,'wb')
+        fp.write(os.urandom(3*BLOCKSIZE))
+        fp.close()
+        reads = []
+        class Throttle:
+            def file_opened(self):
+                reads.append('open')
+            def data_read(self,nbytes):
+                reads.append(nbytes)
+        throttle.install(Throttle())
+        try:
+            md5sum_decompressed(filen)
+        finally:
+            throttle.install(None)
+            os.remove(filen)
+        self.assertEqual(reads[0],'open')
+        # Several reads, none bigger than the compressed file
+        self.assertTrue(len(reads) > 2)
+        self.assertTrue(max(reads[1:]) <= BLOCKSIZE)
+        self.assertTrue(sum(reads[1:]) > 3*BLOCKSIZE)
+
+    def test_sparse_file(self):
+        """Test generation of checksums for a sparse file
+        """
+        filen = self.filen + '.sparse'
+        fp = open(filen,'wb')
+        fp.write(test_text)
+        fp.seek(5*BLOCKSIZE + 100)
+        fp.write(test_text)
+        fp.truncate(8*BLOCKSIZE)
+        fp.close()
+        try:
+            expected = checksum_blocks(file_blocks(open(filen,'rb')))
+            fp = open(filen,'rb')
+            self.assertEqual(checksum_blocks(sparse_blocks(fp,8*BLOCKSIZE)),
+                             expected)
+            fp.close()
+            self.assertEqual(checksums(filen),expected)
+            fp = open(filen,'rb')
+            extents = list(data_extents(fp,8*BLOCKSIZE))
+            fp.close()
+            self.assertTrue(extents[0][0] == 0)
+            self.assertTrue(sum([n for i,n in extents]) <= 8*BLOCKSIZE)
+        finally:
+            os.remove(filen)
+
     def test_no_file_name(self):
         """Test handling of file name 'None'
         """
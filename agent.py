@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+#
+#     agent.py: hash files via a remote agent process
+#     Copyright (C) University of Manchester 2013 Peter Briggs
+#
+########################################################################
+#
+# agent.py
+#
+#########################################################################
+
+"""agent
+
+Classes and functions for listing and hashing files via an 'agent'
+process, so that file contents are read on the machine where the
+data actually lives and only the file listings and MD5 sums are
+sent back over the link.
+
+The agent is run using 'compare.py --agent ROOT', and communicates
+over its stdin and stdout. Typically it would be started on a
+remote host over ssh, for example:
+
+>>> src = AgentSource('ssh remote.host compare.py --agent /data')
+>>> src.list_files()
+['file1.txt','subdir/file2.txt']
+>>> src.md5sum('file1.txt')
+'eacc9c036025f0e64fb724cacaadd8b4'
+
+Protocol
+--------
+
+Messages in both directions are length-prefixed: the length of the
+payload in bytes is written as a decimal number followed by a
+newline, followed by the payload itself. Requests are:
+
+LIST        list all files; the agent responds with one message
+            per file of the form 'SIZE PATH', followed by an empty
+            message to mark the end of the listing
+MD5 PATH    return the MD5 sum of PATH; the agent responds with
+            'OK DIGEST' or 'ERR MESSAGE'
+MD5Z PATH   as for MD5, but the MD5 sum is for the uncompressed
+            contents of PATH (see Md5sum.md5sum_decompressed)
+SUM ALGORITHMS PATH
+            return multiple checksums for PATH, where ALGORITHMS is
+            a comma-separated list (e.g. 'md5,sha256'); the agent
+            responds with 'OK DIGEST1,DIGEST2,...' or 'ERR MESSAGE'
+QUIT        stop the agent
+
+The agent handles requests in the order they're received, so the
+responses come back in the same order. To avoid waiting for a round
+trip for each file, the files which are going to be needed can be
+passed to AgentSource.prefetch: up to PIPELINE_DEPTH requests are
+then kept in flight, and the responses are collected as the
+checksums are asked for.
+
+If the agent stops unexpectedly then requests for checksums raise
+IOError (i.e. the files are treated as unreadable).
+
+"""
+
+#######################################################################
+# Import modules that this module depends on
+#######################################################################
+
+import sys
+import subprocess
+import collections
+
+#######################################################################
+# Module constants
+#######################################################################
+
+# Prefix identifying an agent command in a source specification
+AGENT_PREFIX = "cmd:"
+
+# Maximum number of requests sent to the agent before reading the
+# responses (kept small enough that the responses will fit in the
+# pipe buffers, so the agent never blocks writing them)
+PIPELINE_DEPTH = 64
+
+#######################################################################
+# Classes
+#######################################################################
+
+class AgentSource:
+    """Class providing access to files via a hashing agent
+
+    Implements a tree source (see compare.DirectorySource) where
+    the listing and hashing is performed by an agent process
+    that is started by running a shell command.
+
+    """
+    def __init__(self,command):
+        """Create a new AgentSource object
+
+        Arguments:
+          command: shell command that starts the agent (e.g.
+            'ssh remote.host compare.py --agent /data')
+
+        """
+        self.name = command
+        self.command = command
+        self._sizes = None
+        # Requests waiting to be sent, requests sent but not
+        # answered (in order), and responses not yet collected
+        self._queued = collections.deque()
+        self._pending = collections.deque()
+        self._responses = {}
+        self._agent = subprocess.Popen(command,shell=True,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE)
+
+    def list_files(self):
+        """Return a list of all files available from the agent
+
+        """
+        # Collect the responses for any outstanding requests first
+        while self._pending:
+            self._read_response()
+        self._request("LIST")
+        self._sizes = {}
+        while True:
+            msg = self._read_message()
+            if not msg:
+                break
+            size,filen = msg.split(' ',1)
+            self._sizes[filen] = int(size)
+        files = self._sizes.keys()
+        files.sort()
+        return files
+
+    def getsize(self,filen):
+        """Return the size of a file in bytes
+
+        Sizes are taken from the listing so list_files must
+        have been invoked first.
+
+        """
+        if self._sizes is None:
+            self.list_files()
+        try:
+            return self._sizes[filen]
+        except KeyError:
+            raise IOError("%s: not found" % filen)
+
+    def md5sum(self,filen):
+        """Return the MD5 sum for a file, as computed by the agent
+
+        Raises IOError if the agent was unable to read the file.
+
+        """
+        return self.checksums(filen)[0]
+
+    def checksums(self,filen,algorithms=('md5',)):
+        """Return multiple checksums for a file, as computed by the agent
+
+        Raises IOError if the agent was unable to read the file.
+
+        """
+        return tuple(self._checksum("SUM %s" % ','.join(algorithms),
+                                    filen).split(','))
+
+    def prefetch(self,files,algorithms=('md5',)):
+        """Request checksums for files ahead of them being needed
+
+        The requests are sent to the agent without waiting for
+        the responses (keeping up to PIPELINE_DEPTH in flight),
+        so the round trip to the agent isn't paid for each file.
+        The checksums should then be fetched using checksums (or
+        md5sum for MD5 sums only), preferably in the same order.
+
+        Arguments:
+          files: list of file names, in the order that they
+            will be needed
+          algorithms: list of checksum algorithms
+
+        """
+        request = "SUM %s" % ','.join(algorithms)
+        self._queued.extend([(request,filen) for filen in files])
+        self._fill_pipeline()
+
+    def md5sum_decompressed(self,filen):
+        """Return the MD5 sum for the uncompressed contents of a file
+
+        Raises IOError if the agent was unable to read the file.
+
+        """
+        return self._checksum("MD5Z",filen)
+
+    def close(self):
+        """Stop the agent process
+
+        """
+        if self._agent.poll() is None:
+            self._request("QUIT")
+            self._agent.stdin.close()
+            self._agent.wait()
+
+    def _checksum(self,request,filen):
+        """Internal: fetch a checksum for a file from the agent
+
+        If the request has already been sent (see prefetch) then
+        responses are read until the one for this request
+        arrives; otherwise the request is sent now.
+
+        """
+        key = (request,filen)
+        if key not in self._responses and key not in self._pending:
+            self._send(key)
+        while key not in self._responses:
+            self._read_response()
+        status,value = self._responses.pop(key)
+        self._fill_pipeline()
+        if status != "OK":
+            raise IOError(value)
+        return value
+
+    def _fill_pipeline(self):
+        """Internal: send queued requests until PIPELINE_DEPTH are in flight
+
+        """
+        while self._queued and len(self._pending) < PIPELINE_DEPTH:
+            key = self._queued.popleft()
+            if key not in self._responses and key not in self._pending:
+                try:
+                    self._send(key)
+                except IOError,ex:
+                    self._responses[key] = ("ERR",str(ex))
+
+    def _send(self,key):
+        """Internal: send a checksum request to the agent
+
+        """
+        self._request("%s %s" % key)
+        self._pending.append(key)
+
+    def _read_response(self):
+        """Internal: read the response to the oldest outstanding request
+
+        """
+        key = self._pending.popleft()
+        try:
+            status,value = self._read_message().split(' ',1)
+        except IOError,ex:
+            status,value = ("ERR",str(ex))
+        self._responses[key] = (status,value)
+
+    def _read_message(self):
+        """Internal: read a message from the agent
+
+        Raises IOError if the agent has stopped.
+
+        """
+        try:
+            return read_message(self._agent.stdout)
+        except EOFError,ex:
+            raise IOError("Agent '%s' stopped: %s" % (self.command,ex))
+
+    def _request(self,msg):
+        """Internal: send a request to the agent
+
+        """
+        if self._agent.poll() is not None:
+            raise IOError("Agent '%s' exited with status %s" %
+                          (self.command,self._agent.returncode))
+        write_message(self._agent.stdin,msg)
+
+#######################################################################
+# Functions
+#######################################################################
+
+def write_message(fp,msg):
+    """Write a length-prefixed message to a file handle
+
+    """
+    fp.write("%d\n%s" % (len(msg),msg))
+    fp.flush()
+
+def read_message(fp):
+    """Read a length-prefixed message from a file handle
+
+    Returns the message payload, or raises EOFError if the
+    stream has been closed.
+
+    """
+    length = fp.readline()
+    if not length:
+        raise EOFError("Connection closed")
+    length = int(length)
+    msg = fp.read(length)
+    if len(msg) != length:
+        raise EOFError("Connection closed mid-message")
+    return msg
+
+def serve(source,fin=sys.stdin,fout=sys.stdout):
+    """Run a hashing agent for a tree source
+
+    Reads requests from 'fin' and writes responses to 'fout'
+    until a QUIT request is received or the input is closed.
+
+    Arguments:
+      source: tree source object (e.g. compare.DirectorySource)
+        for the files being served
+      fin: file handle to read requests from
+      fout: file handle to write responses to
+
+    """
+    while True:
+        try:
+            msg = read_message(fin)
+        except EOFError:
+            return
+        cmd = msg.split(' ',1)
+        if cmd[0] == "SUM":
+            try:
+                algorithms,filen = cmd[1].split(' ',1)
+                chksums = source.checksums(filen,algorithms.split(','))
+                write_message(fout,"OK %s" % ','.join(chksums))
+            except (IOError,OSError,ValueError),ex:
+                write_message(fout,"ERR %s" % ex)
+            continue
+        if cmd[0] == "LIST":
+            for filen in source.list_files():
+                try:
+                    size = source.getsize(filen)
+                except OSError:
+                    continue
+                write_message(fout,"%d %s" % (size,filen))
+            write_message(fout,"")
+        elif cmd[0] in ("MD5","MD5Z"):
+            try:
+                if cmd[0] == "MD5":
+                    chksum = source.md5sum(cmd[1])
+                else:
+                    chksum = source.md5sum_decompressed(cmd[1])
+                write_message(fout,"OK %s" % chksum)
+            except (IOError,OSError),ex:
+                write_message(fout,"ERR %s" % ex)
+        elif cmd[0] == "QUIT":
+            return
+        else:
+            write_message(fout,"ERR Unrecognised request '%s'" % cmd[0])
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import os
+import shutil
+import tempfile
+
+class TestAgentSource(unittest.TestCase):
+
+    def setUp(self):
+        self.dirn = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dirn,'sub'))
+        for filen,text in (('hello.txt',"hello!"),
+                           ('sub/goodbye.txt',"goodbye")):
+            fp = open(os.path.join(self.dirn,filen),'w')
+            fp.write(text)
+            fp.close()
+        compare_py = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'compare.py')
+        self.src = AgentSource('"%s" "%s" --agent "%s"' % (sys.executable,
+                                                           compare_py,
+                                                           self.dirn))
+
+    def tearDown(self):
+        self.src.close()
+        shutil.rmtree(self.dirn)
+
+    def test_list_files(self):
+        """Test listing files via an agent
+        """
+        self.assertEqual(self.src.list_files(),
+                         ['hello.txt','sub/goodbye.txt'])
+        self.assertEqual(self.src.getsize('hello.txt'),6)
+        self.assertEqual(self.src.getsize('sub/goodbye.txt'),7)
+
+    def test_md5sum(self):
+        """Test fetching MD5 sums via an agent
+        """
+        self.assertEqual(self.src.md5sum('hello.txt'),
+                         '5a8dd3ad0756a93ded72b823b19dd877')
+        self.assertEqual(self.src.md5sum('sub/goodbye.txt'),
+                         '69faab6268350295550de7d587bc323d')
+
+    def test_checksums(self):
+        """Test fetching multiple checksums via an agent
+        """
+        self.assertEqual(self.src.checksums('hello.txt',('md5','crc32')),
+                         ('5a8dd3ad0756a93ded72b823b19dd877','9a86c960'))
+
+    def test_md5sum_missing_file(self):
+        """Test agent raises IOError for a missing file
+        """
+        self.assertRaises(IOError,self.src.md5sum,'missing.txt')
+
+    def test_prefetch(self):
+        """Test fetching checksums for files requested ahead of time
+        """
+        files = ['hello.txt','missing.txt','sub/goodbye.txt'] + \
+                ['missing%d.txt' % i for i in xrange(100)]
+        self.src.prefetch(files,('md5','crc32'))
+        # Only the first requests are sent before any responses
+        # are read
+        self.assertEqual(len(self.src._pending),PIPELINE_DEPTH)
+        self.assertEqual(self.src.checksums('hello.txt',('md5','crc32')),
+                         ('5a8dd3ad0756a93ded72b823b19dd877','9a86c960'))
+        # Requests can be collected out of order
+        self.assertEqual(self.src.checksums('sub/goodbye.txt',
+                                            ('md5','crc32'))[0],
+                         '69faab6268350295550de7d587bc323d')
+        self.assertRaises(IOError,self.src.checksums,'missing.txt',
+                          ('md5','crc32'))
+        # Requests which weren't prefetched still work
+        self.assertEqual(self.src.md5sum('hello.txt'),
+                         '5a8dd3ad0756a93ded72b823b19dd877')
+        # Listing after prefetching
+        self.assertEqual(self.src.list_files(),
+                         ['hello.txt','sub/goodbye.txt'])
+        self.assertEqual(self.src.md5sum('sub/goodbye.txt'),
+                         '69faab6268350295550de7d587bc323d')
+
+    def test_agent_stopped(self):
+        """Test agent raises IOError if the agent has stopped
+        """
+        self.src.prefetch(['hello.txt','sub/goodbye.txt'])
+        self.src._agent.kill()
+        self.src._agent.wait()
+        self.assertRaises(IOError,self.src.md5sum,'hello.txt')
+        self.assertRaises(IOError,self.src.md5sum,'sub/goodbye.txt')
+        self.assertRaises(IOError,self.src.md5sum,'hello.txt')
+
+########################################################################
+# Main: test runner
+#########################################################################
+if __name__ == "__main__":
+    # Run tests
+    unittest.main()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+#
+#     archive.py: access the contents of tar and zip archives
+#     Copyright (C) University of Manchester 2013 Peter Briggs
+#
+########################################################################
+#
+# archive.py
+#
+#########################################################################
+
+"""archive
+
+Classes and functions for comparing directories against the contents
+of tar and zip archives without extracting them.
+
+Member names are taken from the archive index and MD5 sums are
+generated by streaming the member contents directly from the
+archive:
+
+>>> src = ArchiveSource('data.tar.gz')
+>>> src.list_files()
+['file1.txt','subdir/file2.txt']
+>>> src.md5sum('file1.txt')
+'eacc9c036025f0e64fb724cacaadd8b4'
+
+For tar archives (which can't be read randomly once compressed) the
+checksums of all members are generated while the archive is being
+listed, so compressed archives are only read and decompressed once.
+Hard links and symbolic links are resolved to the members they point
+to, so they're treated in the same way as links in a directory:
+links to files are compared using the contents of the target, links
+to directories are skipped, and links which can't be resolved within
+the archive are listed but can't be read.
+
+Zip archives are opened once and kept open (so that the index
+only has to be read once); call close when the source is no
+longer needed.
+
+"""
+
+#######################################################################
+# Import modules that this module depends on
+#######################################################################
+
+import os
+import tarfile
+import zipfile
+import Md5sum
+
+#######################################################################
+# Module constants
+#######################################################################
+
+# File extensions recognised as archives
+TAR_EXTENSIONS = ('.tar','.tar.gz','.tgz','.tar.bz2','.tbz2')
+ZIP_EXTENSIONS = ('.zip',)
+
+#######################################################################
+# Classes
+#######################################################################
+
+class ArchiveSource:
+    """Class providing access to the files in a tar or zip archive
+
+    Implements a tree source (see compare.DirectorySource) for
+    the regular files (and links to files) contained in an
+    archive. Leading './' is removed from member names so that
+    they match the paths of the files relative to the archived
+    directory.
+
+    """
+    def __init__(self,archive,algorithms=('md5',)):
+        """Create a new ArchiveSource object
+
+        Arguments:
+          archive: path to a .tar, .tar.gz, .tgz, .tar.bz2 or
+            .zip file
+          algorithms: (optional) checksum algorithms to generate
+            when listing a tar archive (checksums for any other
+            algorithms need another pass through the archive)
+
+        """
+        self.name = archive
+        self.archive = archive
+        self._is_zip = archive.lower().endswith(ZIP_EXTENSIONS)
+        self._algorithms = tuple(algorithms)
+        self._sizes = None
+        self._members = None
+        self._chksums = {}
+        self._hashed = set()
+        self._zipfile = None
+
+    def list_files(self):
+        """Return a list of all files in the archive
+
+        """
+        self._sizes = {}
+        self._members = {}
+        if self._is_zip:
+            for info in self._open_zip().infolist():
+                if info.filename.endswith('/'):
+                    # Directory entry
+                    continue
+                filen = normalise_name(info.filename)
+                self._sizes[filen] = info.file_size
+                self._members[filen] = info.filename
+        else:
+            self._read_tar(self._algorithms)
+        files = self._sizes.keys()
+        files.sort()
+        return files
+
+    def getsize(self,filen):
+        """Return the size of a file in the archive in bytes
+
+        """
+        if self._sizes is None:
+            self.list_files()
+        try:
+            size = self._sizes[filen]
+        except KeyError:
+            raise IOError("%s: not found in %s" % (filen,self.archive))
+        if size is None:
+            raise IOError("%s: link can't be resolved in %s" %
+                          (filen,self.archive))
+        return size
+
+    def md5sum(self,filen):
+        """Return the MD5 sum for a file in the archive
+
+        """
+        return self.checksums(filen)[0]
+
+    def checksums(self,filen,algorithms=('md5',)):
+        """Return multiple checksums for a file in the archive
+
+        Returns a tuple with the checksums in the same order as
+        the algorithms.
+
+        """
+        algorithms = tuple(algorithms)
+        if self._members is None:
+            self.list_files()
+        if filen not in self._members:
+            raise IOError("%s: not found in %s" % (filen,self.archive))
+        if self._is_zip:
+            fp = self._open_zip().open(self._members[filen])
+            try:
+                return Md5sum.checksums_stream(fp,algorithms)
+            finally:
+                fp.close()
+        if not self._hashed.issuperset(algorithms):
+            # Need another pass to get the extra checksums
+            self._read_tar(tuple(self._hashed.union(algorithms)))
+        try:
+            chksums = self._chksums[filen]
+        except KeyError:
+            raise IOError("%s: unable to read from %s" % (filen,self.archive))
+        return tuple([chksums[algorithm] for algorithm in algorithms])
+
+    def close(self):
+        """Close the archive
+
+        The archive will be opened again if it's needed later.
+
+        """
+        if self._zipfile is not None:
+            self._zipfile.close()
+            self._zipfile = None
+
+    def _open_zip(self):
+        """Internal: return the open ZipFile for a zip archive
+
+        The archive is only opened (and its index read) once.
+
+        """
+        if self._zipfile is None:
+            self._zipfile = zipfile.ZipFile(self.archive)
+        return self._zipfile
+
+    def _read_tar(self,algorithms):
+        """Internal: list and generate checksums for files in a tar archive
+
+        Reads the archive sequentially as a stream (so that
+        compressed archives are only decompressed once), storing
+        the size and checksums of every regular file. Links are
+        then resolved to the files they point to (see
+        resolve_links); links which can't be resolved are given a
+        size of None and no checksums.
+
+        """
+        sizes = {}
+        members = {}
+        chksums = {}
+        links = {}
+        dirs = set()
+        tf = tarfile.open(self.archive,mode='r|*')
+        try:
+            for info in tf:
+                filen = normalise_name(info.name).rstrip(os.sep)
+                if info.isdir():
+                    dirs.add(filen)
+                    continue
+                if info.isfile():
+                    fp = tf.extractfile(info)
+                    chksums[filen] = dict(zip(algorithms,
+                                              Md5sum.checksums_stream(
+                                                  fp,algorithms)))
+                    sizes[filen] = info.size
+                elif info.islnk():
+                    links[filen] = normalise_name(info.linkname)
+                elif info.issym():
+                    links[filen] = symlink_target(filen,info.linkname)
+                else:
+                    # Devices, FIFOs etc
+                    continue
+                members[filen] = info.name
+        finally:
+            tf.close()
+        # Directories which only appear implicitly in member names
+        for filen in members:
+            dirn = os.path.dirname(filen)
+            while dirn and dirn not in dirs:
+                dirs.add(dirn)
+                dirn = os.path.dirname(dirn)
+        for filen,target in resolve_links(links).iteritems():
+            if target in sizes:
+                sizes[filen] = sizes[target]
+                chksums[filen] = chksums[target]
+            elif target in dirs:
+                # Link to a directory, which isn't followed
+                del members[filen]
+            else:
+                sizes[filen] = None
+        self._sizes = sizes
+        self._members = members
+        self._chksums = chksums
+        self._hashed = set(algorithms)
+
+#######################################################################
+# Functions
+#######################################################################
+
+def is_archive(path):
+    """Check if a path is a tar or zip archive that can be compared
+
+    """
+    return os.path.isfile(path) and \
+        path.lower().endswith(TAR_EXTENSIONS + ZIP_EXTENSIONS)
+
+def symlink_target(filen,linkname):
+    """Return the path that a symbolic link in an archive points to
+
+    Returns the target relative to the top of the archive, or
+    None if the target is outside the archive (i.e. it's an
+    absolute path, or a relative path which goes above the top).
+
+    """
+    if linkname.startswith('/'):
+        return None
+    target = os.path.normpath(os.path.join(os.path.dirname(filen),
+                                           normalise_name(linkname)))
+    if target == os.pardir or target.startswith(os.pardir + os.sep):
+        return None
+    return target
+
+def resolve_links(links):
+    """Follow chains of links in an archive to their final targets
+
+    Arguments:
+      links: dictionary mapping the names of links to the names
+        that they point to (or None if they point outside the
+        archive)
+
+    Returns:
+      Dictionary mapping the names of links to the names of the
+      final targets (which aren't links), or None if the chain
+      leaves the archive or loops.
+
+    """
+    resolved = {}
+    for filen in links:
+        target = links[filen]
+        seen = set([filen])
+        while target in links and target not in seen:
+            seen.add(target)
+            target = links[target]
+        if target in seen:
+            target = None
+        resolved[filen] = target
+    return resolved
+
+def normalise_name(name):
+    """Return archive member name as a relative path
+
+    Strips any leading './' or '/' from the member name and
+    converts to the local path separator.
+
+    """
+    while name.startswith('./'):
+        name = name[2:]
+    name = name.lstrip('/')
+    return name.replace('/',os.sep)
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import shutil
+import tempfile
+import hashlib
+
+class TestArchiveSource(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.dirn = os.path.join(self.wd,'data')
+        os.mkdir(self.dirn)
+        os.mkdir(os.path.join(self.dirn,'sub'))
+        for filen,text in (('hello.txt',"hello!"),
+                           ('sub/goodbye.txt',"goodbye")):
+            fp = open(os.path.join(self.dirn,filen),'w')
+            fp.write(text)
+            fp.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def _check_archive(self,archive):
+        src = ArchiveSource(archive)
+        self.assertEqual(src.list_files(),['hello.txt','sub/goodbye.txt'])
+        self.assertEqual(src.getsize('sub/goodbye.txt'),7)
+        self.assertEqual(src.md5sum('hello.txt'),
+                         '5a8dd3ad0756a93ded72b823b19dd877')
+        self.assertEqual(src.md5sum('sub/goodbye.txt'),
+                         '69faab6268350295550de7d587bc323d')
+        self.assertRaises(IOError,src.md5sum,'missing.txt')
+        self.assertEqual(src.checksums('hello.txt',('crc32','md5')),
+                         ('9a86c960','5a8dd3ad0756a93ded72b823b19dd877'))
+
+    def test_tar_gz(self):
+        """Test ArchiveSource with a .tar.gz file
+        """
+        archive = os.path.join(self.wd,'data.tar.gz')
+        tf = tarfile.open(archive,'w:gz')
+        tf.add(self.dirn,arcname='.')
+        tf.close()
+        self.assertTrue(is_archive(archive))
+        self._check_archive(archive)
+
+    def test_zip(self):
+        """Test ArchiveSource with a .zip file
+        """
+        archive = os.path.join(self.wd,'data.zip')
+        zf = zipfile.ZipFile(archive,'w')
+        for filen in ('hello.txt','sub/goodbye.txt'):
+            zf.write(os.path.join(self.dirn,filen),filen)
+        zf.close()
+        self.assertTrue(is_archive(archive))
+        self._check_archive(archive)
+
+    def test_zip_opened_once(self):
+        """Test ArchiveSource only opens a zip file once
+        """
+        archive = os.path.join(self.wd,'many.zip')
+        zf = zipfile.ZipFile(archive,'w')
+        for i in xrange(100):
+            zf.writestr("file%03d.txt" % i,"file %d" % i)
+        zf.close()
+        opened = []
+        ZipFile = zipfile.ZipFile
+        def open_zip(*args):
+            opened.append(args)
+            return ZipFile(*args)
+        zipfile.ZipFile = open_zip
+        try:
+            src = ArchiveSource(archive)
+            for filen in src.list_files():
+                src.md5sum(filen)
+            self.assertEqual(len(opened),1)
+            src.close()
+            self.assertEqual(src.md5sum('file000.txt'),
+                             hashlib.md5("file 0").hexdigest())
+            self.assertEqual(len(opened),2)
+            src.close()
+        finally:
+            zipfile.ZipFile = ZipFile
+
+    def test_tar_with_links(self):
+        """Test ArchiveSource with hard and symbolic links in a tar file
+        """
+        os.link(os.path.join(self.dirn,'hello.txt'),
+                os.path.join(self.dirn,'hardlink.txt'))
+        os.symlink('../hello.txt',os.path.join(self.dirn,'sub','symlink.txt'))
+        os.symlink('sub',os.path.join(self.dirn,'dirlink'))
+        os.symlink('missing.txt',os.path.join(self.dirn,'broken.txt'))
+        os.symlink('/etc/passwd',os.path.join(self.dirn,'outside.txt'))
+        archive = os.path.join(self.wd,'data.tar.bz2')
+        tf = tarfile.open(archive,'w:bz2')
+        tf.add(self.dirn,arcname='.')
+        tf.close()
+        src = ArchiveSource(archive,algorithms=('md5','crc32'))
+        self.assertEqual(src.list_files(),['broken.txt','hardlink.txt',
+                                           'hello.txt','outside.txt',
+                                           'sub/goodbye.txt',
+                                           'sub/symlink.txt'])
+        for filen in ('hardlink.txt','sub/symlink.txt'):
+            self.assertEqual(src.getsize(filen),6)
+            self.assertEqual(src.checksums(filen,('crc32','md5')),
+                             ('9a86c960','5a8dd3ad0756a93ded72b823b19dd877'))
+        for filen in ('broken.txt','outside.txt'):
+            self.assertRaises(IOError,src.getsize,filen)
+            self.assertRaises(IOError,src.md5sum,filen)
+        # Other algorithms need another pass
+        self.assertEqual(src.checksums('hardlink.txt',('sha1',)),
+                         ('8f7d88e901a5ad3a05d8cc0de93313fd76028f8c',))
+
+    def test_resolve_links(self):
+        """Test following chains of links in an archive
+        """
+        self.assertEqual(resolve_links({'a': 'b', 'b': 'c', 'd': None,
+                                        'e': 'f', 'f': 'e'}),
+                         {'a': 'c', 'b': 'c', 'd': None,
+                          'e': None, 'f': None})
+        self.assertEqual(symlink_target('sub/link','../file'),'file')
+        self.assertEqual(symlink_target('sub/link','file'),'sub/file')
+        self.assertEqual(symlink_target('link','../file'),None)
+        self.assertEqual(symlink_target('link','/etc/passwd'),None)
+
+    def test_not_archive(self):
+        """Test is_archive rejects directories and other files
+        """
+        self.assertFalse(is_archive(self.dirn))
+        self.assertFalse(is_archive(os.path.join(self.dirn,'hello.txt')))
+
+########################################################################
+# Main: test runner
+#########################################################################
+if __name__ == "__main__":
+    # Run tests
+    unittest.main()
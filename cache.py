@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+#     cache.py: persistent cache of file checksums
+#     Copyright (C) University of Manchester 2013 Peter Briggs
+#
+########################################################################
+#
+# cache.py
+#
+#########################################################################
+
+"""cache
+
+Provides a persistent cache of checksums for files, so that files
+which haven't changed since they were last checked don't need to be
+read again.
+
+Entries are stored against the absolute path of the file and the
+kind of checksum (e.g. 'md5' or 'md5:decompressed'), and are only
+returned if the size and modification time of the file are still
+the same as when the checksum was generated:
+
+>>> cache = DigestCache('checksums.cache')
+>>> cache.get('/data/file1.txt','md5')
+None
+>>> cache.set('/data/file1.txt','md5','eacc9c036025f0e64fb724cacaadd8b4')
+>>> cache.get('/data/file1.txt','md5')
+'eacc9c036025f0e64fb724cacaadd8b4'
+>>> cache.save()
+
+The cache file is a tab-delimited text file with one entry per line.
+
+"""
+
+#######################################################################
+# Import modules that this module depends on
+#######################################################################
+
+import os
+import time
+import threading
+
+#######################################################################
+# Classes
+#######################################################################
+
+class DigestCache:
+    """Class implementing a persistent cache of file checksums
+
+    The cache is safe to use from multiple threads.
+
+    """
+    def __init__(self,filen=None):
+        """Create a new DigestCache object
+
+        Arguments:
+          filen: (optional) file to load the cache from and save
+            it to. If the file doesn't exist then the cache starts
+            empty. If no file is given then the cache is only
+            held in memory.
+
+        """
+        self.filen = filen
+        self._entries = {}
+        self._lock = threading.Lock()
+        if filen is not None and os.path.exists(filen):
+            self.load(filen)
+
+    def load(self,filen):
+        """Load cache entries from a file
+
+        """
+        fp = open(filen,'r')
+        for line in fp:
+            fields = line.rstrip('\n').split('\t',5)
+            if len(fields) != 6:
+                # Skip malformed lines
+                continue
+            kind,size,mtime,timestamp,digest,path = fields
+            self._entries[(kind,path)] = (int(size),float(mtime),
+                                          float(timestamp),digest)
+        fp.close()
+
+    def save(self,filen=None):
+        """Write the cache entries to a file
+
+        Arguments:
+          filen: (optional) file to write to; defaults to the file
+            the cache was created with
+
+        """
+        if filen is None:
+            filen = self.filen
+        if filen is None:
+            return
+        tmp_filen = "%s.tmp" % filen
+        fp = open(tmp_filen,'w')
+        with self._lock:
+            for (kind,path),(size,mtime,timestamp,digest) in \
+                    self._entries.iteritems():
+                fp.write("%s\t%d\t%r\t%r\t%s\t%s\n" % (kind,size,mtime,
+                                                       timestamp,digest,
+                                                       path))
+        fp.close()
+        if os.name == 'nt' and os.path.exists(filen):
+            # Needed for Windows where rename can't overwrite (elsewhere
+            # rename replaces the file atomically)
+            os.remove(filen)
+        os.rename(tmp_filen,filen)
+
+    def get(self,path,kind='md5'):
+        """Return the cached checksum for a file
+
+        Returns None if there is no cached checksum, or if the
+        size or modification time of the file no longer match
+        those stored in the cache.
+
+        """
+        entry = self.lookup(path,kind)
+        if entry is None:
+            return None
+        size,mtime,timestamp,digest = entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != size or st.st_mtime != mtime:
+            return None
+        return digest
+
+    def lookup(self,path,kind='md5'):
+        """Return the raw cache entry for a file
+
+        Returns a tuple (size,mtime,timestamp,digest) where
+        'timestamp' is the time the entry was stored, or None
+        if there is no entry. No check is made that the entry
+        is still valid.
+
+        """
+        with self._lock:
+            return self._entries.get((kind,os.path.abspath(path)))
+
+    def set(self,path,kind,digest,st=None):
+        """Store the checksum for a file
+
+        Arguments:
+          path: path to the file
+          kind: the type of checksum (e.g. 'md5')
+          digest: the checksum value
+          st: (optional) os.stat result for the file at the time
+            the checksum was generated (will be stat'ed if not
+            supplied)
+
+        """
+        if st is None:
+            st = os.stat(path)
+        with self._lock:
+            self._entries[(kind,os.path.abspath(path))] = (st.st_size,
+                                                           st.st_mtime,
+                                                           time.time(),
+                                                           digest)
+
+    def remove(self,path,kind):
+        """Remove the entry for a file (if there is one)
+
+        """
+        with self._lock:
+            self._entries.pop((kind,os.path.abspath(path)),None)
+
+    def entries(self,kind):
+        """Return all the entries of one kind
+
+        Returns a list of tuples (path,(size,mtime,timestamp,digest))
+        where 'path' is the absolute path of the file.
+
+        """
+        with self._lock:
+            return [(path,entry) for (k,path),entry in
+                    self._entries.iteritems() if k == kind]
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import shutil
+import tempfile
+
+class TestDigestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.filen = os.path.join(self.wd,'hello.txt')
+        fp = open(self.filen,'w')
+        fp.write("hello!")
+        fp.close()
+        self.cache_file = os.path.join(self.wd,'test.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def test_set_and_get(self):
+        """Test storing and retrieving checksums
+        """
+        cache = DigestCache()
+        self.assertEqual(cache.get(self.filen),None)
+        cache.set(self.filen,'md5','5a8dd3ad0756a93ded72b823b19dd877')
+        self.assertEqual(cache.get(self.filen),
+                         '5a8dd3ad0756a93ded72b823b19dd877')
+        self.assertEqual(cache.get(self.filen,'md5:decompressed'),None)
+
+    def test_save_and_load(self):
+        """Test saving and reloading the cache
+        """
+        cache = DigestCache(self.cache_file)
+        cache.set(self.filen,'md5','5a8dd3ad0756a93ded72b823b19dd877')
+        cache.save()
+        cache = DigestCache(self.cache_file)
+        self.assertEqual(cache.get(self.filen),
+                         '5a8dd3ad0756a93ded72b823b19dd877')
+
+    def test_remove_and_list_entries(self):
+        """Test listing and removing entries
+        """
+        cache = DigestCache()
+        cache.set(self.filen,'md5','5a8dd3ad0756a93ded72b823b19dd877')
+        cache.set(self.filen,'crc32','9a86c960')
+        entries = cache.entries('md5')
+        self.assertEqual(len(entries),1)
+        self.assertEqual(entries[0][0],os.path.abspath(self.filen))
+        self.assertEqual(entries[0][1][3],'5a8dd3ad0756a93ded72b823b19dd877')
+        cache.remove(self.filen,'md5')
+        self.assertEqual(cache.entries('md5'),[])
+        self.assertEqual(cache.get(self.filen,'crc32'),'9a86c960')
+
+    def test_modified_file_invalidates_entry(self):
+        """Test cached checksum isn't returned if the file changes
+        """
+        cache = DigestCache()
+        cache.set(self.filen,'md5','5a8dd3ad0756a93ded72b823b19dd877')
+        fp = open(self.filen,'a')
+        fp.write("goodbye")
+        fp.close()
+        self.assertEqual(cache.get(self.filen),None)
+
+########################################################################
+# Main: test runner
+#########################################################################
+if __name__ == "__main__":
+    # Run tests
+    unittest.main()
@@ -28,11 +28,22 @@ __version__ = version.__version__
 import sys
 import os
 import re
+import stat
 import optparse
 import logging
 import time
 import locale
+import threading
+import shutil
 import Md5sum
+import agent
+import archive
+import cache
+import filters
+import scheduler
+import watch
+import manifest
+import throttle
 
 #######################################################################
 # Classes
@@ -87,20 +98,395 @@ class SortKeys:
                      ((fragment, self.natural_sort_digits.search(fragment))
                       for fragment in self.natural_sort_digits.split(value)))
 
+class DirectorySource:
+    """Class providing access to the files under a local directory
+
+    A 'tree source' supplies the list of files to a Compare object,
+    along with the sizes and MD5 sums of individual files. This
+    class implements a tree source for a directory on a local (or
+    mounted) filesystem:
+
+    >>> src = DirectorySource('/data')
+    >>> src.list_files()
+    ['file1.txt','subdir/file2.txt']
+    >>> src.md5sum('file1.txt')
+    'eacc9c036025f0e64fb724cacaadd8b4'
+
+    See agent.AgentSource for a source where files are accessed
+    via a remote agent process, and archive.ArchiveSource for a
+    source where files are read from a tar or zip archive.
+
+    """
+    def __init__(self,dirn,cache=None,file_filter=None):
+        """Create a new DirectorySource object
+
+        Arguments:
+          dirn: path to the directory
+          cache: (optional) cache.DigestCache object to fetch
+            and store checksums from
+          file_filter: (optional) filters.FileFilter object used
+            to exclude files and directories when listing
+
+        """
+        self.name = dirn
+        self.dirn = dirn
+        self.cache = cache
+        self.file_filter = file_filter
+        self._tree_index = None
+
+    def path(self,filen):
+        """Return the full path for a file relative to the source
+
+        """
+        return os.path.join(self.dirn,filen)
+
+    def list_files(self):
+        """Return a list of all files under the source directory
+
+        """
+        return list_files(self.dirn,file_filter=self.file_filter)
+
+    def getsize(self,filen):
+        """Return the size of a file in bytes
+
+        """
+        return os.path.getsize(self.path(filen))
+
+    def md5sum(self,filen):
+        """Return the MD5 sum for a file
+
+        """
+        return self.checksums(filen)[0]
+
+    def checksums(self,filen,algorithms=('md5',)):
+        """Return multiple checksums for a file
+
+        The file is only read once to generate all the
+        checksums (see Md5sum.checksums).
+
+        Arguments:
+          filen: file name relative to the source
+          algorithms: list of checksum algorithms
+
+        Returns:
+          Tuple with the checksums in the same order as the
+          algorithms.
+
+        """
+        return self._cached_checksums(filen,algorithms,
+                                      lambda path: Md5sum.checksums(path,
+                                                                    algorithms))
+
+    def md5sum_head(self,filen):
+        """Return the MD5 sum for the first block of a file
+
+        """
+        return Md5sum.md5sum_head(self.path(filen))
+
+    def md5sum_decompressed(self,filen):
+        """Return the MD5 sum for the uncompressed contents of a file
+
+        """
+        return self._cached_checksums(filen,('md5:decompressed',),
+                                      lambda path:
+                                      (Md5sum.md5sum_decompressed(path),))[0]
+
+    def _cached_checksums(self,filen,kinds,checksum_func):
+        """Internal: return checksums, using the cache if available
+
+        'checksum_func' is only invoked (to generate all the
+        checksums in one go) if any of the checksum kinds
+        aren't already in the cache.
+
+        Raises IOError if the file can't be read (including if
+        it can't be stat'ed, e.g. for a dangling symbolic link).
+
+        """
+        path = self.path(filen)
+        if self.cache is None:
+            return checksum_func(path)
+        chksums = tuple([self.cache.get(path,kind) for kind in kinds])
+        if None in chksums:
+            try:
+                st = os.stat(path)
+            except OSError,ex:
+                raise IOError(ex.errno,ex.strerror,path)
+            chksums = checksum_func(path)
+            for kind,chksum in zip(kinds,chksums):
+                self.cache.set(path,kind,chksum,st)
+        return chksums
+
+    def unchanged_tree(self,reldir,algorithms=('md5',)):
+        """Return the cached contents of a subdirectory if it's unchanged
+
+        Looks up the directory digest stored in the cache for the
+        subdirectory (see set_tree_digest). The subdirectory is
+        considered to be unchanged if its modification time and
+        size, and those of all the directories under it, are the
+        same as when the digests were stored, and if the digest
+        recomputed from the cached entries for the files it
+        contains matches the stored one. Only the directories are
+        stat'ed; the files under them aren't examined at all.
+
+        Note that the modification time of a directory only changes
+        when entries are added, removed or renamed, so files which
+        have been modified in place won't be detected.
+
+        Arguments:
+          reldir: subdirectory relative to the source directory
+            ('' for the source directory itself)
+          algorithms: list of checksum algorithms used for the
+            file digests
+
+        Returns:
+          Tuple (digest,files,dirs) with the directory digest and
+          lists of the files and directories under it (relative
+          to the source directory), or None if the subdirectory
+          has changed or there's no cached digest for it.
+
+        """
+        index = self._get_tree_index(algorithms)
+        if reldir in index['checked']:
+            return index['checked'][reldir]
+        result = None
+        path = os.path.abspath(self.path(reldir))
+        entry = index['trees'].get(path)
+        if entry is not None:
+            size,mtime,timestamp,digest = entry
+            try:
+                st = os.stat(path)
+                unchanged = (st.st_size == size and st.st_mtime == mtime)
+            except OSError:
+                unchanged = False
+            if unchanged:
+                result = self._cached_tree(reldir,path,digest,algorithms)
+        index['checked'][reldir] = result
+        return result
+
+    def cached_checksums(self,filen,algorithms=('md5',)):
+        """Return the checksums for a file in an unchanged subdirectory
+
+        The checksums are taken from the cache without checking
+        the file (see unchanged_tree).
+
+        """
+        index = self._get_tree_index(algorithms)
+        d,name = os.path.split(os.path.abspath(self.path(filen)))
+        return tuple(index['files'][d][name][1:])
+
+    def set_tree_digest(self,reldir,digest,st,names,algorithms=('md5',)):
+        """Store the directory digest for a subdirectory in the cache
+
+        Entries for files which are no longer in the subdirectory
+        are also removed from the cache (so that they don't affect
+        the digest recomputed by unchanged_tree), along with all
+        the entries under directories which have been removed.
+
+        Arguments:
+          reldir: subdirectory relative to the source directory
+          digest: the directory digest (see directory_digest)
+          st: os.stat result for the subdirectory at the time
+            that its contents were listed
+          names: names of the files and directories in the
+            subdirectory
+          algorithms: list of checksum algorithms used for the
+            file digests
+
+        """
+        index = self._get_tree_index(algorithms)
+        path = os.path.abspath(self.path(reldir))
+        names = set(names)
+        for name in index['files'].get(path,{}):
+            if name not in names:
+                for kind in algorithms:
+                    self.cache.remove(os.path.join(path,name),kind)
+        for name in index['dirs'].get(path,()):
+            if name not in names:
+                self._remove_cached_tree(os.path.join(path,name),algorithms)
+        self.cache.set(path,tree_kind(algorithms),digest,st)
+
+    def _remove_cached_tree(self,path,algorithms):
+        """Internal: remove all cache entries under a removed directory
+
+        """
+        index = self._get_tree_index(algorithms)
+        for name in index['files'].get(path,{}):
+            for kind in algorithms:
+                self.cache.remove(os.path.join(path,name),kind)
+        if path in index['trees']:
+            self.cache.remove(path,tree_kind(algorithms))
+        for name in index['dirs'].get(path,()):
+            self._remove_cached_tree(os.path.join(path,name),algorithms)
+
+    def _cached_tree(self,reldir,path,digest,algorithms):
+        """Internal: check and return the cached contents of a subdirectory
+
+        """
+        index = self._get_tree_index(algorithms)
+        files = []
+        dirs = [reldir]
+        lines = []
+        for name,entry in index['files'].get(path,{}).iteritems():
+            if None in entry:
+                return None
+            lines.append(file_digest_line(name,entry[0],entry[1:]))
+            files.append(os.path.join(reldir,name))
+        for name in index['subdirs'].get(path,[]):
+            subdir = self.unchanged_tree(os.path.join(reldir,name),algorithms)
+            if subdir is None:
+                return None
+            lines.append(dir_digest_line(name,subdir[0]))
+            files.extend(subdir[1])
+            dirs.extend(subdir[2])
+        if directory_digest(lines) != digest:
+            return None
+        return (digest,files,dirs)
+
+    def _get_tree_index(self,algorithms):
+        """Internal: return an index of the cached entries under the source
+
+        The index is built from the cache the first time it's
+        needed, and holds the cached file entries and directory
+        digests for each directory under the source, the names
+        of the subdirectories of each directory which have any
+        cached entries under them, and the results of checking
+        for unchanged subdirectories.
+
+        """
+        algorithms = tuple(algorithms)
+        if self._tree_index is not None and \
+           self._tree_index['algorithms'] == algorithms:
+            return self._tree_index
+        root = os.path.abspath(self.dirn)
+        prefix = os.path.join(root,'')
+        files = {}
+        for i,kind in enumerate(algorithms):
+            for path,entry in self.cache.entries(kind):
+                if not path.startswith(prefix):
+                    continue
+                d,name = os.path.split(path)
+                if name not in files.setdefault(d,{}):
+                    files[d][name] = [entry[0]] + [None]*len(algorithms)
+                files[d][name][i+1] = entry[3]
+        trees = {}
+        subdirs = {}
+        for path,entry in self.cache.entries(tree_kind(algorithms)):
+            if path == root or path.startswith(prefix):
+                trees[path] = entry
+                if path != root:
+                    d,name = os.path.split(path)
+                    subdirs.setdefault(d,[]).append(name)
+        dirs = {}
+        for path in set(files.keys()).union(trees.keys()):
+            while path != root:
+                d,name = os.path.split(path)
+                if name in dirs.setdefault(d,set()):
+                    break
+                dirs[d].add(name)
+                path = d
+        self._tree_index = { 'algorithms': algorithms,
+                             'files': files,
+                             'trees': trees,
+                             'subdirs': subdirs,
+                             'dirs': dirs,
+                             'checked': {} }
+        return self._tree_index
+
+class CompareStats:
+    """Class holding counters for monitoring a running comparison
+
+    The counters are updated by a Compare object as each copy of
+    a file is checked, and can be read at any time from another
+    thread using the snapshot method (e.g. from a timer in a GUI),
+    so that the rate of progress can be monitored without a
+    callback for every file.
+
+    Each counter is a list with values for the source ('from')
+    and target ('to') sides of the comparison:
+
+      files_total: number of files to check
+      bytes_total: total size of the files to check
+      files_done: number of files checked so far
+      bytes_done: total size of the files checked so far
+      busy_time: total time spent generating checksums (seconds)
+
+    """
+    COUNTERS = ('files_total','bytes_total','files_done','bytes_done',
+                'busy_time')
+
+    def __init__(self):
+        """Create a new CompareStats object
+
+        """
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        for name in self.COUNTERS:
+            setattr(self,name,[0,0])
+
+    def set_totals(self,side,nfiles,nbytes):
+        """Set the number and size of the files to check on one side
+
+        Arguments:
+          side: 0 for the source, 1 for the target
+          nfiles: number of files
+          nbytes: total size of the files in bytes
+
+        """
+        with self._lock:
+            self.files_total[side] = nfiles
+            self.bytes_total[side] = nbytes
+
+    def add(self,side,nbytes,elapsed):
+        """Record that a file has been checked
+
+        Arguments:
+          side: 0 for the source, 1 for the target
+          nbytes: size of the file in bytes
+          elapsed: time taken to generate the checksums
+
+        """
+        with self._lock:
+            self.files_done[side] += 1
+            self.bytes_done[side] += nbytes
+            self.busy_time[side] += elapsed
+
+    def snapshot(self):
+        """Return a consistent copy of the counters
+
+        Returns a dictionary with the current time (as 'time')
+        and copies of each of the counters.
+
+        """
+        with self._lock:
+            stats = dict([(name,list(getattr(self,name)))
+                          for name in self.COUNTERS])
+        stats['time'] = time.time()
+        return stats
+
 class Compare:
     """Class to compare contents of two directories
+
+    The "directories" can also be other tree sources: see the
+    get_source function for details.
     
     """
 
     def __init__(self,from_dir,to_dir,
                  report_progress=False,report_every=0,
                  progress_callback=None,
-                 sort_key=None):
+                 sort_key=None,decompress=False,cache_file=None,
+                 detect_moves=False,file_filter=None,
+                 digests=None,keep_checksums=False,
+                 copy=False,drop_cache=False,io_scheduler=None,
+                 result_callback=None,stats=None,tree_digests=False,
+                 max_failures=None):
         """Create a new Compare object
 
         Arguments:
-          from_dir: path to "source" directory
-          to_dir: path to "target" directory
+          from_dir: path to "source" directory (or any tree
+            source specification understood by get_source)
+          to_dir: path to "target" directory (or any tree
+            source specification understood by get_source)
           report_progress: if True then invoke progress_callback
             with progress messages, or write to stdout (if callback
             is not defined)
@@ -111,47 +497,227 @@ class Compare:
             invoked to report progress
           sort_key: (optional) function to use as a key for sorting
             file names. Default is to use the native sort order
+          decompress: if True then files which only differ by a
+            compression extension (e.g. 'file.fastq' and
+            'file.fastq.gz') are paired up and compared using
+            the checksums of their uncompressed contents
+          cache_file: (optional) file used to cache checksums
+            between runs, so that unchanged files are not read
+            again
+          detect_moves: if True then look for files that have been
+            moved or renamed, by matching the contents of files
+            only found in the source against those only found in
+            the target
+          file_filter: (optional) filters.FileFilter object used
+            to exclude files and directories from the comparison
+          digests: (optional) list of checksum algorithms to use
+            for comparing files (see Md5sum.ALGORITHMS); default
+            is to only use MD5 sums. All the checksums for a file
+            are generated from a single read of its contents.
+          keep_checksums: if True then keep the checksums for all
+            the files in the source (including those which are
+            only in the source), so that a manifest can be written
+            using the write_manifest method
+          copy: if True then after the comparison copy files which
+            are missing from the target, or which differ, from the
+            source to the target and verify the copies (see the
+            copy_files method)
+          drop_cache: if True then ask the operating system to
+            drop cached data for copied files before verifying them
+          io_scheduler: (optional) scheduler.IOScheduler object;
+            if supplied (and both source and target are local
+            directories) then files are read in parallel, grouped
+            by device and in physical order on each device. The
+            report is still written in the order given by the sort
+            key.
+          result_callback: (optional) callback function that will
+            be invoked with the name and status of each file as
+            its result becomes available (status is one of 'OK',
+            'FAILED', 'UNREADABLE', 'ONLY_IN_FROM', 'ONLY_IN_TO' or
+            'UNCHANGED', i.e. accepted without being checked because
+            it's in an unchanged directory)
+          stats: (optional) CompareStats object which will be
+            updated with the number and size of the files checked
+            on each side, and the time taken (note that this
+            means the sizes of all the files in both directories
+            are looked up before the checksums are generated)
+          tree_digests: if True (and a cache file was given, and
+            both source and target are local directories) then
+            store a digest for each directory in the cache, and
+            skip directories where neither copy has changed since
+            the digests were stored (see the setup method)
+          max_failures: (optional) if set then stop the comparison
+            once this many files have failed (see the go_compare
+            method); files which haven't been checked by then are
+            reported as 'NOT CHECKED'
 
         """
         # Store info about source ("from") and target ("to") dirs
         self._from_dir = from_dir
         self._to_dir = to_dir
+        # Checksum cache
+        if cache_file is not None:
+            self._cache = cache.DigestCache(cache_file)
+        else:
+            self._cache = None
+        # Checksums to use
+        if digests:
+            self._digests = tuple(digests)
+        else:
+            self._digests = ('md5',)
+        # Filter for excluding files
+        self._filter = file_filter
+        self._from = get_source(from_dir,cache=self._cache,
+                                file_filter=file_filter,
+                                algorithms=self._digests)
+        self._to = get_source(to_dir,cache=self._cache,
+                              file_filter=file_filter,
+                              algorithms=self._digests)
+        # Pair compressed and uncompressed files
+        self._decompress = decompress
+        self._keep_checksums = keep_checksums
+        # Copy missing and failed files
+        self._copy = copy
+        self._drop_cache = drop_cache
+        self._copied = []
+        self._copy_failed = []
+        # Scheduler for reading files
+        self._io_scheduler = io_scheduler
+        # Look for moved/renamed files
+        self._detect_moves = detect_moves
+        self._moved = []
         # Sort key function to use
         self._sort_key = sort_key
         # Store progress options and callback function
         self._report_progress_flag = report_progress
         self._report_every = report_every
         self._progress_callback = progress_callback
+        self._result_callback = result_callback
+        # Skip unchanged directories
+        self._tree_digests = tree_digests
+        self._unchanged = set()
+        if tree_digests:
+            if self._cache is None or \
+               not isinstance(self._from,DirectorySource) or \
+               not isinstance(self._to,DirectorySource):
+                self._report_progress("Directory digests are only available "
+                                      "for local directories with a cache")
+                self._tree_digests = False
+        # Stop after a number of failures
+        self._max_failures = max_failures
+        # Counters for monitoring progress
+        self._stats = stats
+        self._file_sizes = ({},{})
         # Setup
         self._start_time = time.time()
         self.setup()
+        if self._detect_moves:
+            self.detect_moves()
         # Do checksum comparison
         self.go_compare()
+        # Finished with archives and agents
+        close_sources((self._from,self._to))
+        # Copy files
+        if self._copy:
+            self.copy_files(drop_cache=self._drop_cache)
         self._end_time = time.time()
 
     def setup(self):
         """Collect lists of files for comparison
 
+        If directory digests are being used then subdirectories
+        where neither copy has changed since the last comparison,
+        and where everything under them matched, are not examined:
+        the files under them are taken from the cache and accepted
+        without being checked (see DirectorySource.unchanged_tree
+        for the caveats).
+
         """
         # Create sets of files in "from" and "to" directories
-        self._report_progress("Collecting files for %s" % self._from_dir)
-        self._from_set = set(self._list_files(self._from_dir))
-        self._report_progress("Collecting files for %s" % self._to_dir)
-        self._to_set = set(self._list_files(self._to_dir))
+        if self._tree_digests:
+            self._report_progress("Collecting files for %s and %s" %
+                                  (self._from_dir,self._to_dir))
+            from_files,to_files = self._walk_trees()
+            self._from_set = set(from_files)
+            self._to_set = set(to_files)
+        else:
+            self._report_progress("Collecting files for %s" % self._from_dir)
+            self._from_set = set(self._list_files(self._from))
+            self._report_progress("Collecting files for %s" % self._to_dir)
+            self._to_set = set(self._list_files(self._to))
         # Lists created from subsets
         self._report_progress("Sorting files into sets")
         self._common = list(self._from_set.intersection(self._to_set))
         self._only_in_from = list(self._from_set.difference(self._to_set))
         self._only_in_to   = list(self._to_set.difference(self._from_set))
+        # Pair up compressed and uncompressed versions
+        self._compressed_pairs = []
+        if self._decompress:
+            self._report_progress("Pairing compressed files")
+            self._pair_compressed_files()
         # Sort the lists
         sort_key = self._sort_key
         self._common.sort(key=sort_key)
         self._only_in_from.sort(key=sort_key)
         self._only_in_to.sort(key=sort_key)
+        if sort_key is not None:
+            self._compressed_pairs.sort(key=lambda x: sort_key(x[0]))
+        else:
+            self._compressed_pairs.sort()
+
+    def detect_moves(self):
+        """Match up files which have been moved or renamed
+
+        Looks for files only found in the source which have the
+        same contents as files only found in the target. Files
+        are first grouped by size, and only files whose size
+        matches one on the other side are checksummed (so most
+        files never need to be read). Empty files are ignored.
+
+        Matched files are removed from the 'only in' lists and
+        stored as (from_file,to_file) tuples in the list of
+        moved files.
+
+        """
+        self._report_progress("Looking for moved files")
+        from_sizes = group_by_size(self._from,self._only_in_from)
+        to_sizes = group_by_size(self._to,self._only_in_to)
+        moved = []
+        for size in from_sizes:
+            if size == 0 or size not in to_sizes:
+                continue
+            from_chksums = group_by_md5sum(self._from,from_sizes[size])
+            to_chksums = group_by_md5sum(self._to,to_sizes[size])
+            for chksum in from_chksums:
+                if chksum in to_chksums:
+                    # Pair up files with the same checksum
+                    moved.extend(zip(from_chksums[chksum],
+                                     to_chksums[chksum]))
+        moved_from = set([f for f,t in moved])
+        moved_to = set([t for f,t in moved])
+        self._only_in_from = [f for f in self._only_in_from
+                              if f not in moved_from]
+        self._only_in_to = [f for f in self._only_in_to
+                            if f not in moved_to]
+        sort_key = self._sort_key
+        if sort_key is not None:
+            moved.sort(key=lambda x: sort_key(x[0]))
+        else:
+            moved.sort()
+        self._moved = moved
 
     def go_compare(self):
         """Do the comparison
 
+        If a maximum number of failures was set then the comparison
+        stops as soon as that many files have failed (files only in
+        one of the directories, moved files, files which differ and
+        files which can't be read all count as failures). To find
+        failures as quickly as possible, the files in both
+        directories are checked in order of priority (see the
+        _prioritise method) rather than in the sort order, and files
+        whose sizes differ are counted as failed without being read.
+
         """
         nfiles = len(self._common)
         if self._report_every < 1:
@@ -164,22 +730,319 @@ class Compare:
         unreadable = []
         to_chksums = {}
         from_chksums = {}
-        for f in self._common:
-            n += 1
-            if n%n_mod == 0:
-                self._report_progress("Examining %d/%d (%s)" % (n,nfiles,f))
+        # Order the files to find failures quickly
+        files = self._common
+        size_mismatches = {}
+        n_failures = len(self._only_in_from) + len(self._only_in_to) + \
+                     len(self._moved)
+        if self._max_failures is not None:
+            files,size_mismatches = self._prioritise(self._common)
+        not_checked = []
+        # Sizes of files are needed for the progress stats
+        if self._stats is not None:
+            self._report_progress("Getting file sizes")
+            self._get_file_sizes()
+        # Generate checksums up front using the scheduler
+        scheduled_chksums = None
+        if self._io_scheduler is not None:
+            if self._max_failures is not None:
+                self._report_progress("I/O scheduling is not used when "
+                                      "stopping after failures")
+            elif isinstance(self._from,DirectorySource) and \
+               isinstance(self._to,DirectorySource):
+                scheduled_chksums = self._fetch_scheduled_md5s(n_mod)
+            else:
+                self._report_progress("I/O scheduling is only available "
+                                      "for local directories")
+        # Send the checksum requests to agents ahead of time, so
+        # that they don't wait for a round trip for each file
+        if scheduled_chksums is None:
+            prefetch = [f for f in files if f not in size_mismatches
+                        and f not in self._unchanged]
+            if self._keep_checksums and not self._copy:
+                from_prefetch = prefetch + self._only_in_from
+            else:
+                from_prefetch = prefetch
+            for source,source_files in ((self._from,from_prefetch),
+                                        (self._to,prefetch)):
+                if hasattr(source,'prefetch'):
+                    source.prefetch(source_files,self._digests)
+        for f in self._only_in_from:
+            self._report_result(f,"ONLY_IN_FROM")
+        for f in self._only_in_to:
+            self._report_result(f,"ONLY_IN_TO")
+        for i,f in enumerate(files):
+            if self._limit_reached(n_failures):
+                self._report_progress("Stopping after %d failures" %
+                                      n_failures)
+                not_checked = files[i:]
+                break
+            if scheduled_chksums is None:
+                n += 1
+                if n%n_mod == 0:
+                    self._report_progress("Examining %d/%d (%s)" % (n,nfiles,f))
+            if f in size_mismatches:
+                # Sizes differ so no need to read the contents
+                failed_md5.append(f)
+                n_failures += 1
+                self._report_result(f,"FAILED")
+                continue
             try:
-                from_chksum,to_chksum = self._fetch_md5s(f)
+                if f in self._unchanged:
+                    from_chksum = self._from.cached_checksums(f,self._digests)
+                    to_chksum = from_chksum
+                elif scheduled_chksums is None:
+                    from_chksum,to_chksum = self._fetch_md5s(f)
+                else:
+                    from_chksum,to_chksum = scheduled_chksums[f]
+                    if from_chksum is None or to_chksum is None:
+                        raise IOError("%s: unreadable" % f)
                 if not from_chksum == to_chksum:
                     failed_md5.append(f)
                     from_chksums[f] = from_chksum
                     to_chksums[f]   = to_chksum
-            except IOError:
+                    status = "FAILED"
+                else:
+                    if self._keep_checksums:
+                        from_chksums[f] = from_chksum
+                    if f in self._unchanged:
+                        status = "UNCHANGED"
+                    else:
+                        status = "OK"
+            except (IOError,OSError):
                 unreadable.append(f)
+                status = "UNREADABLE"
+            if status not in ("OK","UNCHANGED"):
+                n_failures += 1
+            self._report_result(f,status)
+        # Also get checksums for files only in the source
+        # (unless they're about to be copied, in which case
+        # they'll be generated then), and for moved and
+        # compressed files (which aren't compared directly)
+        if self._keep_checksums:
+            extra_files = [f for f,t in self._moved] + \
+                          [f for f,t in self._compressed_pairs]
+            if not self._copy:
+                extra_files.extend(self._only_in_from)
+            for f in extra_files:
+                try:
+                    from_chksums[f] = self._from.checksums(f,self._digests)
+                except (IOError,OSError):
+                    pass
+        # Compare uncompressed contents of compressed pairs
+        failed_decompressed = []
+        unreadable_decompressed = []
+        decompressed_chksums = {}
+        not_checked_decompressed = []
+        for i,(from_f,to_f) in enumerate(self._compressed_pairs):
+            if self._limit_reached(n_failures):
+                not_checked_decompressed = [f for f,t in
+                                            self._compressed_pairs[i:]]
+                break
+            try:
+                from_chksum = self._from.md5sum_decompressed(from_f)
+                to_chksum = self._to.md5sum_decompressed(to_f)
+                if not from_chksum == to_chksum:
+                    failed_decompressed.append(from_f)
+                    decompressed_chksums[from_f] = (from_chksum,to_chksum)
+                    n_failures += 1
+            except (IOError,OSError):
+                unreadable_decompressed.append(from_f)
+                n_failures += 1
         self._failed_md5 = failed_md5
+        self._size_mismatches = size_mismatches
+        self._not_checked = not_checked
+        self._not_checked_decompressed = not_checked_decompressed
         self._to_chksums = to_chksums
         self._from_chksums = from_chksums
         self._unreadable = unreadable
+        self._failed_decompressed = failed_decompressed
+        self._unreadable_decompressed = unreadable_decompressed
+        self._decompressed_chksums = decompressed_chksums
+        # Update the directory digests
+        if self._tree_digests:
+            self._update_tree_digests()
+        # Store cached checksums
+        if self._cache is not None:
+            self._cache.save()
+
+    def copy_files(self,drop_cache=False):
+        """Copy missing and differing files from source to target
+
+        Copies files that are only in the source, or whose checksums
+        didn't match, from the source to the target directory. The
+        checksums of the source data are generated while it is being
+        copied, so each source file is only read once; the copy is
+        then re-read and its checksums compared against those of the
+        source data to verify it.
+
+        Files are first written to a temporary file in the target
+        directory, which is only renamed to replace the target once
+        the copy has been verified (if verification fails then the
+        temporary file is removed and the target is left untouched).
+        File modification times and permissions are also copied.
+
+        Successfully copied files are moved into the list of common
+        files; files where the copy failed or didn't verify are
+        recorded as (file,reason) tuples in the list of failed
+        copies.
+
+        Both source and target must be local directories.
+
+        Arguments:
+          drop_cache: if True then ask the operating system to
+            drop cached data for each copy before verifying it,
+            so that the verification reads from disk
+
+        """
+        for src in (self._from,self._to):
+            if not isinstance(src,DirectorySource):
+                raise Exception("%s: can only copy between local "
+                                "directories" % src.name)
+        files = self._only_in_from + self._failed_md5
+        files.sort(key=self._sort_key)
+        nfiles = len(files)
+        n = 0
+        copied = []
+        copy_failed = []
+        for f in files:
+            n += 1
+            self._report_progress("Copying %d/%d (%s)" % (n,nfiles,f))
+            src = self._from.path(f)
+            dst = self._to.path(f)
+            tmp_dst = os.path.join(os.path.dirname(dst),
+                                   ".%s.copying" % os.path.basename(dst))
+            try:
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                st = os.stat(src)
+                chksums = Md5sum.copy_and_checksums(src,tmp_dst,self._digests)
+                shutil.copystat(src,tmp_dst)
+                # Verify the copy before it replaces the target
+                if drop_cache:
+                    Md5sum.drop_cache(tmp_dst)
+                if chksums != Md5sum.checksums(tmp_dst,self._digests):
+                    os.remove(tmp_dst)
+                    copy_failed.append((f,"verification failed"))
+                    continue
+                if os.name == 'nt' and os.path.exists(dst):
+                    # Needed for Windows where rename can't overwrite (elsewhere
+                    # rename replaces the file atomically)
+                    os.remove(dst)
+                os.rename(tmp_dst,dst)
+            except (IOError,OSError),ex:
+                if os.path.exists(tmp_dst):
+                    os.remove(tmp_dst)
+                copy_failed.append((f,"copy failed: %s" % ex))
+                continue
+            copied.append(f)
+            if self._keep_checksums:
+                self._from_chksums[f] = chksums
+            if self._cache is not None:
+                for kind,chksum in zip(self._digests,chksums):
+                    self._cache.set(src,kind,chksum,st)
+                    self._cache.set(dst,kind,chksum)
+        # Update the lists of files
+        copied_set = set(copied)
+        self._only_in_from = [f for f in self._only_in_from
+                              if f not in copied_set]
+        self._failed_md5 = [f for f in self._failed_md5
+                            if f not in copied_set]
+        self._common = list(set(self._common).union(copied_set))
+        self._common.sort(key=self._sort_key)
+        self._copied = copied
+        self._copy_failed = copy_failed
+        # Store cached checksums
+        if self._cache is not None:
+            self._cache.save()
+
+    def update_files(self,files):
+        """Re-examine files which have changed since the comparison
+
+        Updates the results for each of the specified files, by
+        checking whether it now exists in the source and/or target
+        and regenerating the checksums if it's in both (so only
+        the changed files are read again). This is used to keep
+        the comparison up to date when watching the directories
+        for changes (see the watch module).
+
+        Moved files, compressed pairs and copies are not updated.
+
+        Both source and target must be local directories.
+
+        Arguments:
+          files: list of file paths relative to the source and
+            target directories
+
+        Returns:
+          List of (file,status) tuples, where status is one of
+          'OK', 'FAILED', 'UNREADABLE', 'ONLY_IN_FROM', 'ONLY_IN_TO'
+          or 'REMOVED' (i.e. no longer in either directory).
+
+        """
+        for src in (self._from,self._to):
+            if not isinstance(src,DirectorySource):
+                raise Exception("%s: can only update local "
+                                "directories" % src.name)
+        files = set(files)
+        self._unchanged.difference_update(files)
+        for src,file_set in ((self._from,self._from_set),
+                             (self._to,self._to_set)):
+            for f in files:
+                if os.path.isfile(src.path(f)) and \
+                   (self._filter is None or self._filter.filter_files([f])):
+                    file_set.add(f)
+                else:
+                    file_set.discard(f)
+        # Remove the old results
+        self._common = [f for f in self._common if f not in files]
+        self._only_in_from = [f for f in self._only_in_from if f not in files]
+        self._only_in_to = [f for f in self._only_in_to if f not in files]
+        self._failed_md5 = [f for f in self._failed_md5 if f not in files]
+        self._unreadable = [f for f in self._unreadable if f not in files]
+        self._not_checked = [f for f in self._not_checked if f not in files]
+        # Classify each file again
+        results = []
+        for f in sorted(files,key=self._sort_key):
+            self._from_chksums.pop(f,None)
+            self._to_chksums.pop(f,None)
+            self._size_mismatches.pop(f,None)
+            if f in self._from_set and f in self._to_set:
+                self._common.append(f)
+                try:
+                    from_chksum,to_chksum = self._fetch_md5s(f)
+                except (IOError,OSError):
+                    self._unreadable.append(f)
+                    results.append((f,"UNREADABLE"))
+                    continue
+                if not from_chksum == to_chksum:
+                    self._failed_md5.append(f)
+                    self._from_chksums[f] = from_chksum
+                    self._to_chksums[f] = to_chksum
+                    results.append((f,"FAILED"))
+                else:
+                    if self._keep_checksums:
+                        self._from_chksums[f] = from_chksum
+                    results.append((f,"OK"))
+            elif f in self._from_set:
+                self._only_in_from.append(f)
+                results.append((f,"ONLY_IN_FROM"))
+            elif f in self._to_set:
+                self._only_in_to.append(f)
+                results.append((f,"ONLY_IN_TO"))
+            else:
+                results.append((f,"REMOVED"))
+        for f,status in results:
+            self._report_result(f,status)
+        # Sort the lists
+        for file_list in (self._common,self._only_in_from,self._only_in_to,
+                          self._failed_md5,self._unreadable):
+            file_list.sort(key=self._sort_key)
+        self._end_time = time.time()
+        # Store cached checksums
+        if self._cache is not None:
+            self._cache.save()
+        return results
 
     def report(self,output_file=None,fp=sys.stdout):
         """Write a report of the comparison
@@ -194,14 +1057,32 @@ class Compare:
         # Deal with output file
         if output_file is not None:
             self._report_progress("Writing report to %s" % output_file)
-            self.report(fp=open(output_file,'w'))
-            return
+            fp = open(output_file,'w')
+            status = self.report(fp=fp)
+            fp.close()
+            return status
         # Calculate numbers of files that passed, failed etc
-        n_passed = len(self._common) - len(self._failed_md5) - len(self._unreadable)
         n_failed = len(self._failed_md5)
         n_unreadable = len(self._unreadable)
+        n_not_checked = len(self._not_checked)
+        unchanged = self._unchanged.difference(self._failed_md5,
+                                               self._unreadable,
+                                               self._not_checked)
+        n_unchanged = len(unchanged)
+        n_passed = len(self._common) - n_failed - n_unreadable - \
+                   n_not_checked - n_unchanged
         n_only_in_from = len(self._only_in_from)
         n_only_in_to = len(self._only_in_to)
+        n_moved = len(self._moved)
+        n_copied = len(self._copied)
+        n_copy_failed = len(self._copy_failed)
+        n_compressed = len(self._compressed_pairs)
+        n_failed_decompressed = len(self._failed_decompressed)
+        n_unreadable_decompressed = len(self._unreadable_decompressed)
+        n_not_checked_decompressed = len(self._not_checked_decompressed)
+        n_passed_decompressed = n_compressed - n_failed_decompressed - \
+                                n_unreadable_decompressed - \
+                                n_not_checked_decompressed
         # Preamble
         title_line = "Comparing contents of %s and %s" % (self._from_dir,
                                                           self._to_dir)
@@ -210,12 +1091,34 @@ class Compare:
                                                          time.ctime(self._end_time)))
         # Summary
         fp.write("\nSummary\n%s\n" % ("-"*len("Summary")))
+        if n_not_checked or n_not_checked_decompressed:
+            fp.write("\tStopped after reaching %d failures\n" %
+                     self._max_failures)
         fp.write("\t%d files only found in %s\n" % (n_only_in_from,self._from_dir))
         fp.write("\t%d files only found in %s\n" % (n_only_in_to,self._to_dir))
+        if self._detect_moves:
+            fp.write("\t%d files moved or renamed\n" % n_moved)
         fp.write("\t%d files in both\n" % len(self._common))
         fp.write("\t\t%d files OK\n" % n_passed)
         fp.write("\t\t%d files FAILED\n" % n_failed)
         fp.write("\t\t%d files UNREADABLE\n" % n_unreadable)
+        if self._max_failures is not None:
+            fp.write("\t\t%d files NOT CHECKED\n" % n_not_checked)
+        if self._tree_digests:
+            fp.write("\t\t%d files OK (unchanged dir), not checked\n" %
+                     n_unchanged)
+        if self._copy:
+            fp.write("\t%d files copied and verified\n" % n_copied)
+            fp.write("\t%d files FAILED to copy\n" % n_copy_failed)
+        if self._decompress:
+            fp.write("\t%d files compared after decompression\n" %
+                     n_compressed)
+            fp.write("\t\t%d files OK\n" % n_passed_decompressed)
+            fp.write("\t\t%d files FAILED\n" % n_failed_decompressed)
+            fp.write("\t\t%d files UNREADABLE\n" % n_unreadable_decompressed)
+            if self._max_failures is not None:
+                fp.write("\t\t%d files NOT CHECKED\n" %
+                         n_not_checked_decompressed)
         # Files only in one or the other directory
         fp.write("\nFiles only in %s (%d)\n" % (self._from_dir,n_only_in_from))
         for f in self._only_in_from:
@@ -223,30 +1126,89 @@ class Compare:
         fp.write("\nFiles only in %s (%d)\n" % (self._to_dir,n_only_in_to))
         for f in self._only_in_to:
             fp.write("\t%s\n" % str(f))
+        # Files which have been moved or renamed
+        if self._detect_moves:
+            fp.write("\nFiles moved or renamed (%d)\n" % n_moved)
+            for from_f,to_f in self._moved:
+                fp.write("\t%s\t->\t%s\n" % (from_f,to_f))
+        # Files which were copied
+        if self._copy:
+            fp.write("\nFiles copied (%d)\n" % (n_copied + n_copy_failed))
+            for f in self._copied:
+                fp.write("\tCOPIED\t%s\n" % f)
+            for f,reason in self._copy_failed:
+                fp.write("\tCOPY FAILED\t%s\t(%s)\n" % (f,reason))
         # Compare checksums for files in both directories
         fp.write("\nCommon files (%d)\n" % len(self._common))
+        failed_md5 = set(self._failed_md5)
+        unreadable = set(self._unreadable)
+        not_checked = set(self._not_checked)
         for f in self._common:
             status = "OK"
-            if f in self._failed_md5:
+            if f in failed_md5:
                 status = "FAILED"
-            elif f in self._unreadable:
+            elif f in unreadable:
                 status = "UNREADABLE"
+            elif f in not_checked:
+                status = "NOT CHECKED"
+            elif f in unchanged:
+                status = "OK (unchanged dir)"
             fp.write("\t%s\t%s\n" % (status,f))
-            if status == "FAILED":
+            if status == "FAILED" and f in self._size_mismatches:
+                # Report the different sizes
+                fp.write("\t\t\tSizes: from %d\tTo %d\n" %
+                         self._size_mismatches[f])
+            elif status == "FAILED":
                 # Also report the different checksums
-                fp.write("\t\t\tMD5s: from %s\tTo %s\n" % (self._from_chksums[f],
-                                                           self._to_chksums[f]))
+                for name,from_chksum,to_chksum in zip(self._digests,
+                                                      self._from_chksums[f],
+                                                      self._to_chksums[f]):
+                    fp.write("\t\t\t%ss: from %s\tTo %s\n" % (name.upper(),
+                                                              from_chksum,
+                                                              to_chksum))
+        # Compare uncompressed contents of compressed pairs
+        if self._decompress:
+            fp.write("\nFiles compared after decompression (%d)\n" %
+                     n_compressed)
+            failed_decompressed = set(self._failed_decompressed)
+            unreadable_decompressed = set(self._unreadable_decompressed)
+            not_checked_decompressed = set(self._not_checked_decompressed)
+            for from_f,to_f in self._compressed_pairs:
+                status = "OK"
+                if from_f in failed_decompressed:
+                    status = "FAILED"
+                elif from_f in unreadable_decompressed:
+                    status = "UNREADABLE"
+                elif from_f in not_checked_decompressed:
+                    status = "NOT CHECKED"
+                fp.write("\t%s\t%s\t%s\n" % (status,from_f,to_f))
+                if status == "FAILED":
+                    fp.write("\t\t\tMD5s: from %s\tTo %s\n" %
+                             self._decompressed_chksums[from_f])
         # Send a progress update indicating final result
-        summary = ["Finished: %d/%d OK" % (n_passed,len(self._common))]
+        n_failed += n_failed_decompressed
+        n_unreadable += n_unreadable_decompressed
+        summary = ["Finished: %d/%d OK" % (n_passed + n_passed_decompressed,
+                                           len(self._common) + n_compressed)]
         if n_failed > 0:
             summary.append(", %d failed" % n_failed)
         if n_unreadable > 0:
             summary.append(", %d 'bad' files" % n_unreadable)
         if n_only_in_from > 0 or n_only_in_to > 0:
             summary.append(", %d 'extra' files" % (n_only_in_from + n_only_in_to))
+        if n_moved > 0:
+            summary.append(", %d moved files" % n_moved)
+        if n_copy_failed > 0:
+            summary.append(", %d failed copies" % n_copy_failed)
+        n_not_checked += n_not_checked_decompressed
+        if n_not_checked > 0:
+            summary.append(", %d not checked" % n_not_checked)
+        if n_unchanged > 0:
+            summary.append(", %d in unchanged directories" % n_unchanged)
         self._report_progress(' '.join(summary))
         # Return status depending on whether there were problems
-        if n_failed or n_unreadable or (n_only_in_from + n_only_in_to):
+        if n_failed or n_unreadable or (n_only_in_from + n_only_in_to) or \
+           n_moved or n_copy_failed or n_not_checked:
             return False
         else:
             return True
@@ -258,19 +1220,286 @@ class Compare:
             else:
                 print str(message)
 
-    def _list_files(self,dirn):
-        """Return a list of all files under a directory
+    def _report_result(self,filen,status):
+        if self._result_callback is not None:
+            self._result_callback(filen,status)
+
+    def write_manifest(self,output_file=None,fp=sys.stdout,algorithm='md5'):
+        """Write a checksum manifest for the files in the source
+
+        The manifest is in the same format as the output from
+        'md5sum' (or 'sha1sum' etc), with a line for each file
+        giving the checksum and the path relative to the source
+        directory (including files which were moved, or paired
+        with a compressed copy). Files which couldn't be read are
+        omitted.
+
+        The Compare object must have been created with
+        'keep_checksums=True'.
+
+        Arguments:
+          output_file: (optional) name of file to write the
+            manifest to
+          fp: (optional) file handle to write the manifest to
+            if no output file is specified (default is stdout)
+          algorithm: checksum algorithm to write (must be one
+            of the digests used for the comparison)
+
+        """
+        if not self._keep_checksums:
+            raise Exception("Checksums were not kept for manifest")
+        if output_file is not None:
+            self._report_progress("Writing %s manifest to %s" % (algorithm,
+                                                                 output_file))
+            fp = open(output_file,'w')
+            self.write_manifest(fp=fp,algorithm=algorithm)
+            fp.close()
+            return
+        i = list(self._digests).index(algorithm)
+        files = self._from_chksums.keys()
+        files.sort(key=self._sort_key)
+        for f in files:
+            fp.write("%s  %s\n" % (self._from_chksums[f][i],
+                                   f.replace(os.sep,'/')))
+
+    def _pair_compressed_files(self):
+        """Pair up compressed and uncompressed copies of files
+
+        Matches files that are only in one of the directories
+        against files only in the other, where the names only
+        differ by a compression extension (e.g. 'file.fastq'
+        and 'file.fastq.gz', or 'file.fastq.gz' and
+        'file.fastq.bz2'). Paired files are removed from the
+        'only in' lists and stored as (from_file,to_file)
+        tuples in the list of compressed pairs.
+
+        Pairing is only done if both sources are able to
+        generate checksums for uncompressed contents.
+
+        """
+        for src in (self._from,self._to):
+            if not hasattr(src,'md5sum_decompressed'):
+                self._report_progress("%s: can't compare uncompressed "
+                                      "contents" % src.name)
+                return
+        from_names = uncompressed_names(self._only_in_from)
+        to_names = uncompressed_names(self._only_in_to)
+        for name in from_names:
+            if name in to_names:
+                self._compressed_pairs.append((from_names[name],
+                                               to_names[name]))
+        for from_f,to_f in self._compressed_pairs:
+            self._only_in_from.remove(from_f)
+            self._only_in_to.remove(to_f)
+
+    def _list_files(self,source):
+        """Return a list of all files in a tree source
+
+        Any files which are excluded by the file filter are
+        removed from the list (directory sources do this
+        themselves while walking the directory tree).
         
         """
-        files = []
-        for d in os.walk(dirn):
-            # os.walk returns tuple (dir,(file1,file2,...))
-            for f in d[2]:
-                # Hacky way to get path of each file relative to dirn
-                files.append(os.path.join(str(d[0])[len(dirn):].lstrip(os.sep),f))
-        files.sort()
+        files = source.list_files()
+        if self._filter is not None and \
+           not isinstance(source,DirectorySource):
+            files = self._filter.filter_files(files)
+        return files
+
+    def _limit_reached(self,n_failures):
+        """Internal: check if the maximum number of failures has been reached
+
+        """
+        return self._max_failures is not None and \
+            n_failures >= self._max_failures
+
+    def _prioritise(self,files):
+        """Internal: order files so that failures are likely to be found first
+
+        Files are put into the following order:
+
+        - files whose sizes differ (which have definitely failed),
+          or whose sizes can't be found;
+        - files which don't have valid cached checksums, most
+          recently modified first;
+        - files with valid cached checksums, oldest first;
+        - files in unchanged directories (see setup).
+
+        Modification times are only available for local directories,
+        and cached checksums are only used if there's a cache.
+
+        Returns:
+          Tuple (files,size_mismatches) where 'files' is the list
+          of files in priority order and 'size_mismatches' is a
+          dictionary with (source_size,target_size) tuples for the
+          files whose sizes differ.
+
+        """
+        self._report_progress("Ordering files by priority")
+        sources = (self._from,self._to)
+        size_mismatches = {}
+        keys = {}
+        for f in files:
+            if f in self._unchanged:
+                keys[f] = (3,0)
+                continue
+            try:
+                info = [file_info(source,f) for source in sources]
+            except (IOError,OSError):
+                keys[f] = (0,0)
+                continue
+            sizes = [size for size,mtime in info]
+            if sizes[0] != sizes[1]:
+                size_mismatches[f] = tuple(sizes)
+                keys[f] = (0,0)
+                continue
+            timestamps = []
+            if self._cache is not None:
+                for source,(size,mtime) in zip(sources,info):
+                    if not isinstance(source,DirectorySource):
+                        continue
+                    entry = self._cache.lookup(source.path(f),
+                                               self._digests[0])
+                    if entry is not None and entry[0] == size and \
+                       entry[1] == mtime:
+                        timestamps.append(entry[2])
+                    else:
+                        timestamps.append(None)
+            if timestamps and None not in timestamps:
+                keys[f] = (2,min(timestamps))
+            else:
+                keys[f] = (1,-max([mtime for size,mtime in info]))
+        return (sorted(files,key=lambda f: keys[f]),size_mismatches)
+
+    def _walk_trees(self):
+        """Internal: list the files in the source and target together
+
+        Walks the source and target directories at the same time,
+        skipping subdirectories which are unchanged on both sides
+        and have the same directory digest. Files under skipped
+        subdirectories are added to the set of unchanged files.
+
+        The modification times of the directories that are walked
+        are also recorded, for storing with the new directory
+        digests.
+
+        Returns:
+          Tuple (from_files,to_files) with lists of the files in
+          the source and target.
+
+        """
+        sources = (self._from,self._to)
+        files = ([],[])
+        self._dir_stats = ({},{})
+        self._unchanged_dirs = {}
+        self._unchanged = set()
+        pending = ['']
+        while pending:
+            reldir = pending.pop()
+            from_tree = self._from.unchanged_tree(reldir,self._digests)
+            if from_tree is not None:
+                to_tree = self._to.unchanged_tree(reldir,self._digests)
+                if to_tree is not None and to_tree[0] == from_tree[0]:
+                    self._unchanged_dirs[reldir] = from_tree[0]
+                    self._unchanged.update(from_tree[1])
+                    files[0].extend(from_tree[1])
+                    files[1].extend(from_tree[1])
+                    continue
+            subdirs = set()
+            for side,source in enumerate(sources):
+                path = source.path(reldir)
+                try:
+                    st = os.stat(path)
+                    names = os.listdir(path)
+                except OSError:
+                    continue
+                self._dir_stats[side][reldir] = st
+                for name in names:
+                    relpath = os.path.join(reldir,name)
+                    if os.path.isdir(source.path(relpath)):
+                        if os.path.islink(source.path(relpath)) or \
+                           (self._filter is not None and
+                            self._filter.exclude_dir(relpath)):
+                            continue
+                        subdirs.add(relpath)
+                    elif self._filter is None or \
+                         not self._filter.exclude_file(relpath):
+                        files[side].append(relpath)
+            pending.extend(subdirs)
         return files
 
+    def _update_tree_digests(self):
+        """Internal: store new digests for the directories that were walked
+
+        A digest is only stored for a directory if it's in both
+        the source and target, all the files under it are in both
+        and matched, and the same is true for its subdirectories.
+
+        """
+        self._report_progress("Updating directory digests")
+        ok = set(self._common).difference(self._failed_md5,self._unreadable)
+        dirs = set(self._dir_stats[0]).union(self._dir_stats[1],
+                                             self._unchanged_dirs)
+        # Find directories with differences under them
+        bad = set()
+        def mark_bad(d):
+            while d not in bad:
+                bad.add(d)
+                if not d:
+                    break
+                d = os.path.dirname(d)
+        for d in dirs:
+            if d not in self._unchanged_dirs and \
+               not (d in self._dir_stats[0] and d in self._dir_stats[1]):
+                mark_bad(d)
+        for f in self._from_set.union(self._to_set):
+            if f not in ok:
+                mark_bad(os.path.dirname(f))
+        # Collect the lines for each directory digest
+        lines = {}
+        names = {}
+        for f in ok:
+            if f in self._unchanged:
+                continue
+            d,name = os.path.split(f)
+            if d in bad:
+                continue
+            chksums = []
+            for kind in self._digests:
+                entry = self._cache.lookup(self._from.path(f),kind)
+                if entry is None:
+                    break
+                chksums.append(entry[3])
+            if len(chksums) != len(self._digests):
+                mark_bad(d)
+                continue
+            lines.setdefault(d,[]).append(file_digest_line(name,entry[0],
+                                                           chksums))
+            names.setdefault(d,[]).append(name)
+        # Generate the digests starting from the deepest directories
+        subdirs = {}
+        for d in dirs:
+            if d:
+                subdirs.setdefault(os.path.dirname(d),[]).append(d)
+        digests = dict(self._unchanged_dirs)
+        for d in sorted(dirs,key=lambda d: -d.count(os.sep) - bool(d)):
+            if d in bad or d in self._unchanged_dirs:
+                continue
+            d_lines = lines.get(d,[])
+            d_names = names.get(d,[])
+            for subdir in subdirs.get(d,[]):
+                if subdir not in digests:
+                    break
+                name = os.path.basename(subdir)
+                d_lines.append(dir_digest_line(name,digests[subdir]))
+                d_names.append(name)
+            else:
+                digests[d] = directory_digest(d_lines)
+                for side,source in enumerate((self._from,self._to)):
+                    source.set_tree_digest(d,digests[d],
+                                           self._dir_stats[side][d],
+                                           d_names,self._digests)
+
     def _fetch_md5s(self,filen):
         """Compute and return MD5 sums for each copy of a file
 
@@ -278,11 +1507,97 @@ class Compare:
         in the source and target directories and returns a tuple
         (source_md5,target_md5).
 
+        If other checksum algorithms have been specified then
+        'source_md5' and 'target_md5' are each tuples of all the
+        checksums for the file (in the same order as the
+        algorithms were specified).
+
         """
-        chksum1 = Md5sum.md5sum(os.path.join(self._from_dir,filen))
-        chksum2 = Md5sum.md5sum(os.path.join(self._to_dir,filen))
+        chksum1 = self._fetch_checksums(0,filen)
+        chksum2 = self._fetch_checksums(1,filen)
         return (chksum1,chksum2)
 
+    def _fetch_checksums(self,side,filen):
+        """Compute and return the checksums for one copy of a file
+
+        Arguments:
+          side: 0 for the copy in the source, 1 for the copy
+            in the target
+          filen: name of the file
+
+        Returns a tuple with the checksums for each of the
+        digests. The stats are also updated (if being collected).
+
+        """
+        source = (self._from,self._to)[side]
+        if self._stats is None:
+            return source.checksums(filen,self._digests)
+        start = time.time()
+        try:
+            return source.checksums(filen,self._digests)
+        finally:
+            self._stats.add(side,self._file_sizes[side].get(filen,0),
+                            time.time()-start)
+
+    def _get_file_sizes(self):
+        """Look up the sizes of the common files and set the totals
+
+        Files in unchanged directories (which won't be read) are
+        not included.
+
+        """
+        for side,source in enumerate((self._from,self._to)):
+            sizes = {}
+            for f in self._common:
+                if f in self._unchanged:
+                    continue
+                try:
+                    sizes[f] = source.getsize(f)
+                except (IOError,OSError):
+                    sizes[f] = 0
+            self._file_sizes[side].update(sizes)
+            self._stats.set_totals(side,len(sizes),sum(sizes.values()))
+
+    def _fetch_scheduled_md5s(self,n_mod=1):
+        """Compute MD5 sums for all common files using the I/O scheduler
+
+        The copies of each file in the source and target are
+        scheduled as separate jobs, so that the reads can be
+        grouped by device and ordered on each device.
+
+        Returns a dictionary where the keys are the file names
+        and the values are lists [source_md5,target_md5] (see
+        _fetch_md5s); MD5s are None for files that couldn't be
+        read.
+
+        """
+        files = [f for f in self._common if f not in self._unchanged]
+        nfiles = len(files)
+        chksums = dict([(f,[None,None]) for f in files])
+        pending = dict([(f,2) for f in files])
+        finished = [0]
+        lock = threading.Lock()
+        def fetch_md5(job):
+            f,i = job
+            try:
+                chksum = self._fetch_checksums(i,f)
+            except (IOError,OSError):
+                chksum = None
+            with lock:
+                chksums[f][i] = chksum
+                pending[f] -= 1
+                if pending[f] == 0:
+                    finished[0] += 1
+                    if finished[0]%n_mod == 0:
+                        self._report_progress("Examining %d/%d (%s)" %
+                                              (finished[0],nfiles,f))
+        jobs = []
+        for f in files:
+            jobs.append(((f,0),self._from.path(f)))
+            jobs.append(((f,1),self._to.path(f)))
+        self._io_scheduler.run(jobs,fetch_md5)
+        return chksums
+
     def _check_md5(self,filen):
         """Compare MD5 sums of two copies of a file
 
@@ -295,54 +1610,1754 @@ class Compare:
         chksum1,chksum2 = self._fetch_md5s(filen)
         return chksum1 == chksum2
 
-#######################################################################
-# Functions
-#######################################################################
+class MultiCompare:
+    """Class to compare contents of one directory against several others
 
-# None defined
+    Compares a single source ("from") directory against multiple
+    target ("to") directories (for example, replicas of the
+    source). The source directory is only listed and read once,
+    and the source and targets are each read in parallel in
+    separate threads.
 
-#######################################################################
-# Main program
-#######################################################################
+    Usage:
 
-if __name__ == "__main__":
-    usage = "%prog FROM_DIR TO_DIR [ OUTPUT_FILE ]"
-    p = optparse.OptionParser(usage=usage,
-                              version="%prog "+__version__,
-                              description=
-                              "compare contents of a pair of directories using "
-                              "MD5 sums")
-    # Define options
-    p.add_option('--progress',action="store_true",dest="progress",default=False,
-                 help="report progress")
-    p.add_option('--use-natural-sort',action="store_true",dest="use_natural_sort",default=False,
-                 help="use 'natural sort order' for ordering files (same as Windows Explorer)")
+    >>> MultiCompare('/data',['/replica1','/replica2']).report()
 
-    # Process command line
-    options,arguments = p.parse_args()
-    if len(arguments) < 2 or len(arguments) > 3:
-        p.error("Takes either 2 or 3 arguments: FROM_DIR, TO_DIR and optional OUTPUT_FILE")
-    from_dir = arguments[0]
-    if not os.path.isdir(from_dir):
-        p.error("%s: directory not found" % from_dir)
-    to_dir = arguments[1]
-    if not os.path.isdir(from_dir):
-        p.error("%s: directory not found" % to_dir)
-    if len(arguments) == 3:
-        output_file = arguments[2]
-    else:
-        output_file = None
+    """
 
-    # Setup sorting function
-    if options.use_natural_sort:
-        sort_key = SortKeys.natural
-    else:
-        sort_key = SortKeys.default
+    def __init__(self,from_dir,to_dirs,
+                 report_progress=False,report_every=0,
+                 progress_callback=None,
+                 sort_key=None,cache_file=None,file_filter=None):
+        """Create a new MultiCompare object
 
-    # Set up logging output
-    logging.basicConfig(format='%(message)s')
-    
-    # Invoke the comparison
-    comparison = Compare(from_dir,to_dir,
-                         report_progress=options.progress,
-                         sort_key=sort_key).report(output_file)
+        Arguments:
+          from_dir: path to "source" directory (or any tree
+            source specification understood by get_source)
+          to_dirs: list of paths to "target" directories (or any
+            tree source specifications understood by get_source)
+          report_progress: if True then invoke progress_callback
+            with progress messages, or write to stdout (if callback
+            is not defined)
+          report_every: if non-zero then send a progress update for
+            every n files that are checked (if n=0 then a reasonable
+            value will be set automatically)
+          progress: (optional) callback function that will be
+            invoked to report progress
+          sort_key: (optional) function to use as a key for sorting
+            file names. Default is to use the native sort order
+          cache_file: (optional) file used to cache checksums
+            between runs, so that unchanged files are not read
+            again
+          file_filter: (optional) filters.FileFilter object used
+            to exclude files and directories from the comparison
+
+        """
+        # Store info about source ("from") and target ("to") dirs
+        self._from_dir = from_dir
+        self._to_dirs = list(to_dirs)
+        if cache_file is not None:
+            self._cache = cache.DigestCache(cache_file)
+        else:
+            self._cache = None
+        self._filter = file_filter
+        self._from = get_source(from_dir,cache=self._cache,
+                                file_filter=file_filter)
+        self._tos = [get_source(d,cache=self._cache,file_filter=file_filter)
+                     for d in self._to_dirs]
+        # Sort key function to use
+        self._sort_key = sort_key
+        # Store progress options and callback function
+        self._report_progress_flag = report_progress
+        self._report_every = report_every
+        self._progress_callback = progress_callback
+        # Setup
+        self._start_time = time.time()
+        self.setup()
+        # Do checksum comparison
+        self.go_compare()
+        close_sources([self._from] + self._tos)
+        self._end_time = time.time()
+
+    def setup(self):
+        """Collect lists of files for comparison
+
+        """
+        self._report_progress("Collecting files for %s" % self._from_dir)
+        self._from_set = set(self._list_files(self._from))
+        self._to_sets = []
+        for to_dir,to in zip(self._to_dirs,self._tos):
+            self._report_progress("Collecting files for %s" % to_dir)
+            self._to_sets.append(set(self._list_files(to)))
+        # Files in the source which are also in at least one target
+        self._report_progress("Sorting files into sets")
+        in_any_target = set()
+        for to_set in self._to_sets:
+            in_any_target.update(to_set)
+        self._common = list(self._from_set.intersection(in_any_target))
+        self._only_in_from = list(self._from_set.difference(in_any_target))
+        # Files in the targets which aren't in the source
+        self._extra = list(in_any_target.difference(self._from_set))
+        # Sort the lists
+        sort_key = self._sort_key
+        self._from_files = list(self._from_set)
+        self._from_files.sort(key=sort_key)
+        self._common.sort(key=sort_key)
+        self._only_in_from.sort(key=sort_key)
+        self._extra.sort(key=sort_key)
+
+    def go_compare(self):
+        """Do the comparison
+
+        The MD5 sums for the source and each of the targets are
+        generated in parallel (one thread for each directory), and
+        then compared.
+
+        Every file starts out without an MD5 sum, so files which
+        the threads don't get to (e.g. because a thread failed
+        unexpectedly) are reported as unreadable.
+
+        """
+        # Generate checksums in parallel
+        self._from_chksums = dict.fromkeys(self._common)
+        self._to_chksums = []
+        threads = [threading.Thread(target=self._fetch_md5s,
+                                    args=(self._from,self._common,
+                                          self._from_chksums,True))]
+        for to,to_set in zip(self._tos,self._to_sets):
+            files = [f for f in self._common if f in to_set]
+            chksums = dict.fromkeys(files)
+            self._to_chksums.append(chksums)
+            threads.append(threading.Thread(target=self._fetch_md5s,
+                                            args=(to,files,chksums)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Compare checksums
+        self._status = [{} for to in self._tos]
+        for i,to_set in enumerate(self._to_sets):
+            status = self._status[i]
+            to_chksums = self._to_chksums[i]
+            for f in self._from_files:
+                if f not in to_set:
+                    status[f] = "MISSING"
+                elif self._from_chksums.get(f) is None or \
+                     to_chksums.get(f) is None:
+                    status[f] = "UNREADABLE"
+                elif self._from_chksums[f] != to_chksums[f]:
+                    status[f] = "FAILED"
+                else:
+                    status[f] = "OK"
+        # Store cached checksums
+        if self._cache is not None:
+            self._cache.save()
+
+    def report(self,output_file=None,fp=sys.stdout):
+        """Write a report of the comparison
+
+        Report will be written to the specified file name (if provided),
+        or else to the specified file handle (must have been opened for
+        writing).
+
+        If neither is supplied then the report is written to stdout.
+
+        The status of each file is reported in a separate column
+        for each target directory.
+
+        Returns True if all the targets matched the source, False
+        otherwise.
+
+        """
+        # Deal with output file
+        if output_file is not None:
+            self._report_progress("Writing report to %s" % output_file)
+            return self.report(fp=open(output_file,'w'))
+        n_targets = len(self._to_dirs)
+        n_files = len(self._from_files)
+        # Preamble
+        title_line = "Comparing contents of %s and %d targets" % \
+                     (self._from_dir,n_targets)
+        fp.write("%s\n%s\n" % (title_line,"="*len(title_line)))
+        fp.write("\nStart time: %s\nEnd time  : %s\n" % (time.ctime(self._start_time),
+                                                         time.ctime(self._end_time)))
+        # Targets
+        fp.write("\nTargets\n%s\n" % ("-"*len("Targets")))
+        for i,to_dir in enumerate(self._to_dirs):
+            fp.write("\t[%d]\t%s\n" % (i+1,to_dir))
+        # Summary
+        all_ok = True
+        fp.write("\nSummary\n%s\n" % ("-"*len("Summary")))
+        fp.write("\t%d files in %s\n" % (n_files,self._from_dir))
+        for i,to_dir in enumerate(self._to_dirs):
+            counts = {}
+            for status in self._status[i].itervalues():
+                counts[status] = counts.get(status,0) + 1
+            n_extra = len(self._to_sets[i].difference(self._from_set))
+            fp.write("\t[%d] %s\n" % (i+1,to_dir))
+            for status in ("OK","FAILED","UNREADABLE","MISSING"):
+                fp.write("\t\t%d files %s\n" % (counts.get(status,0),status))
+            fp.write("\t\t%d files EXTRA\n" % n_extra)
+            if counts.get("OK",0) != n_files or n_extra:
+                all_ok = False
+        # Status of files in the source
+        header = '\t'.join(["[%d]" % (i+1) for i in xrange(n_targets)])
+        fp.write("\nFiles in %s (%d)\n" % (self._from_dir,n_files))
+        fp.write("\t%s\tFile\n" % header)
+        for f in self._from_files:
+            fp.write("\t%s\t%s\n" % ('\t'.join([self._status[i][f]
+                                                for i in xrange(n_targets)]),
+                                     f))
+        # Extra files in the targets
+        fp.write("\nFiles not in %s (%d)\n" % (self._from_dir,len(self._extra)))
+        fp.write("\t%s\tFile\n" % header)
+        for f in self._extra:
+            fp.write("\t%s\t%s\n" % ('\t'.join([("EXTRA" if f in to_set else "-")
+                                                for to_set in self._to_sets]),
+                                     f))
+        # Send a progress update indicating final result
+        if all_ok:
+            self._report_progress("Finished: all %d targets OK" % n_targets)
+        else:
+            self._report_progress("Finished: one or more targets failed")
+        return all_ok
+
+    def _fetch_md5s(self,source,files,chksums,report=False):
+        """Internal: generate MD5 sums for a list of files
+
+        Stores the MD5 sums for each file in the 'chksums'
+        dictionary (or None if the file couldn't be read). If
+        'report' is True then progress updates are also sent.
+
+        """
+        nfiles = len(files)
+        if self._report_every < 1:
+            n_mod = int(float(nfiles)/100)
+        else:
+            n_mod = self._report_every
+        if n_mod == 0: n_mod = 1
+        n = 0
+        if hasattr(source,'prefetch'):
+            source.prefetch(files)
+        for f in files:
+            n += 1
+            if report and n%n_mod == 0:
+                self._report_progress("Examining %d/%d (%s)" % (n,nfiles,f))
+            try:
+                chksums[f] = source.md5sum(f)
+            except (IOError,OSError):
+                chksums[f] = None
+
+    def _list_files(self,source):
+        """Return a list of all files in a tree source
+
+        """
+        files = source.list_files()
+        if self._filter is not None and \
+           not isinstance(source,DirectorySource):
+            files = self._filter.filter_files(files)
+        return files
+
+    def _report_progress(self,message):
+        if self._report_progress_flag:
+            if self._progress_callback is not None:
+                self._progress_callback(message)
+            else:
+                print str(message)
+
+class Dedupe:
+    """Class to find files with duplicate contents within a directory
+
+    Candidate duplicates are narrowed down in stages, so that most
+    files are never read:
+
+    1. files are grouped by size, and files with a unique size
+       are discarded;
+    2. the remaining files are grouped by the MD5 sum of their
+       first block, and files with a unique checksum discarded;
+    3. files bigger than a block which are still candidates are
+       grouped by the MD5 sum of their full contents.
+
+    Empty files are ignored, as are symbolic links. Hard links to
+    the same file aren't duplicates (removing one doesn't free
+    any space), so only one name for each file is used when
+    looking for duplicates; the other names are reported
+    separately.
+
+    """
+
+    def __init__(self,dirn,
+                 report_progress=False,
+                 progress_callback=None,
+                 sort_key=None,cache_file=None,
+                 file_filter=None):
+        """Create a new Dedupe object
+
+        Arguments:
+          dirn: path to the directory to examine
+          report_progress: if True then invoke progress_callback
+            with progress messages, or write to stdout (if callback
+            is not defined)
+          progress: (optional) callback function that will be
+            invoked to report progress
+          sort_key: (optional) function to use as a key for sorting
+            file names. Default is to use the native sort order
+          cache_file: (optional) file used to cache checksums
+            between runs, so that unchanged files are not read
+            again
+          file_filter: (optional) filters.FileFilter object used
+            to exclude files and directories
+
+        """
+        self._dirn = dirn
+        self._sort_key = sort_key
+        if cache_file is not None:
+            self._cache = cache.DigestCache(cache_file)
+        else:
+            self._cache = None
+        self._source = DirectorySource(dirn,cache=self._cache,
+                                       file_filter=file_filter)
+        # Store progress options and callback function
+        self._report_progress_flag = report_progress
+        self._progress_callback = progress_callback
+        # Find the duplicates
+        self._start_time = time.time()
+        self.find_duplicates()
+        self._end_time = time.time()
+
+    def find_duplicates(self):
+        """Find groups of files with the same contents
+
+        """
+        self._report_progress("Collecting files for %s" % self._dirn)
+        self._files = self._source.list_files()
+        # Skip symbolic links and collapse hard links
+        files,self._hard_links,self._symlinks = \
+            find_links(self._source,self._files)
+        # Group by size
+        self._report_progress("Grouping %d files by size" % len(files))
+        candidates = []
+        for size,files in group_by_size(self._source,files).iteritems():
+            if size > 0 and len(files) > 1:
+                candidates.append((size,files))
+        # Group by checksum of first block
+        self._report_progress("Checking first block of %d files" %
+                              sum([len(files) for size,files in candidates]))
+        candidates = self._narrow(candidates,self._source.md5sum_head)
+        # Group by checksum of full contents (only needed for
+        # files bigger than the first block)
+        duplicates = [(size,files) for size,files in candidates
+                      if size <= Md5sum.BLOCKSIZE]
+        candidates = [(size,files) for size,files in candidates
+                      if size > Md5sum.BLOCKSIZE]
+        self._report_progress("Checking full contents of %d files" %
+                              sum([len(files) for size,files in candidates]))
+        duplicates.extend(self._narrow(candidates,self._source.md5sum))
+        # Sort the files within each group, and then the groups
+        # (biggest savings first)
+        sort_key = self._sort_key
+        if sort_key is None:
+            sort_key = SortKeys.default
+        for size,files in duplicates:
+            files.sort(key=sort_key)
+        duplicates.sort(key=lambda x: (-x[0]*(len(x[1])-1),sort_key(x[1][0])))
+        self._duplicates = duplicates
+        self._symlinks.sort(key=sort_key)
+        # Store cached checksums
+        if self._cache is not None:
+            self._cache.save()
+
+    def report(self,output_file=None,fp=sys.stdout):
+        """Write a report of the duplicate files
+
+        Report will be written to the specified file name (if provided),
+        or else to the specified file handle (must have been opened for
+        writing).
+
+        If neither is supplied then the report is written to stdout.
+
+        Returns True if no duplicates were found, False otherwise.
+
+        """
+        # Deal with output file
+        if output_file is not None:
+            self._report_progress("Writing report to %s" % output_file)
+            return self.report(fp=open(output_file,'w'))
+        n_groups = len(self._duplicates)
+        n_duplicates = sum([len(files)-1 for size,files in self._duplicates])
+        n_hard_links = sum([len(links) for links in self._hard_links.values()])
+        reclaimable = sum([size*(len(files)-1)
+                           for size,files in self._duplicates])
+        # Preamble
+        title_line = "Duplicate files in %s" % self._dirn
+        fp.write("%s\n%s\n" % (title_line,"="*len(title_line)))
+        fp.write("\nStart time: %s\nEnd time  : %s\n" % (time.ctime(self._start_time),
+                                                         time.ctime(self._end_time)))
+        # Summary
+        fp.write("\nSummary\n%s\n" % ("-"*len("Summary")))
+        fp.write("\t%d files examined\n" % len(self._files))
+        fp.write("\t%d symbolic links skipped\n" % len(self._symlinks))
+        fp.write("\t%d hard links to other files\n" % n_hard_links)
+        fp.write("\t%d groups of duplicate files\n" % n_groups)
+        fp.write("\t%d duplicate files\n" % n_duplicates)
+        fp.write("\t%d bytes reclaimable\n" % reclaimable)
+        # Duplicate groups
+        fp.write("\nDuplicate groups (%d)\n" % n_groups)
+        for size,files in self._duplicates:
+            fp.write("\t%d files of %d bytes (%d bytes reclaimable)\n" %
+                     (len(files),size,size*(len(files)-1)))
+            for f in files:
+                fp.write("\t\t%s\n" % f)
+                for link in self._hard_links.get(f,[]):
+                    fp.write("\t\t\t(hard link %s)\n" % link)
+        # Hard links
+        fp.write("\nHard linked files (%d)\n" % len(self._hard_links))
+        sort_key = self._sort_key
+        if sort_key is None:
+            sort_key = SortKeys.default
+        for f in sorted(self._hard_links,key=sort_key):
+            fp.write("\t%s\n" % f)
+            for link in self._hard_links[f]:
+                fp.write("\t\t%s\n" % link)
+        # Send a progress update indicating final result
+        self._report_progress("Finished: %d duplicate files, %d bytes "
+                              "reclaimable" % (n_duplicates,reclaimable))
+        return (n_groups == 0)
+
+    def _narrow(self,candidates,checksum):
+        """Internal: split groups of candidate duplicates by checksum
+
+        Takes a list of (size,files) tuples and returns a new list
+        where each group has been split by the supplied checksum
+        function, and groups with only one file discarded.
+
+        """
+        narrowed = []
+        for size,files in candidates:
+            for files in group_by_checksum(files,checksum).itervalues():
+                if len(files) > 1:
+                    narrowed.append((size,files))
+        return narrowed
+
+    def _report_progress(self,message):
+        if self._report_progress_flag:
+            if self._progress_callback is not None:
+                self._progress_callback(message)
+            else:
+                print str(message)
+
+#######################################################################
+# Functions
+#######################################################################
+
+def list_files(dirn,file_filter=None):
+    """Return a list of all files under a directory
+
+    File names are returned relative to the directory and in
+    sorted order.
+
+    If a filters.FileFilter object is supplied then excluded
+    files are omitted, and excluded directories are not
+    descended into.
+
+    """
+    files = []
+    for d in os.walk(dirn):
+        # os.walk returns tuple (dir,(subdir1,...),(file1,file2,...))
+        # Hacky way to get path of each file relative to dirn
+        reldir = str(d[0])[len(dirn):].lstrip(os.sep)
+        if file_filter is not None:
+            # Prune excluded subdirectories in place so that
+            # os.walk doesn't descend into them
+            d[1][:] = [s for s in d[1]
+                       if not file_filter.exclude_dir(os.path.join(reldir,s))]
+        for f in d[2]:
+            f = os.path.join(reldir,f)
+            if file_filter is not None and file_filter.exclude_file(f):
+                continue
+            files.append(f)
+    files.sort()
+    return files
+
+def find_links(source,files):
+    """Find symbolic and hard links amongst files in a directory
+
+    Arguments:
+      source: DirectorySource object
+      files: list of file names relative to the source
+
+    Returns:
+      Tuple (files,hard_links,symlinks) where 'files' is a list
+      with a single name for each distinct file (i.e. the first
+      of the names which are hard linked to each other, and
+      excluding symbolic links), 'hard_links' is a dictionary
+      mapping names in 'files' to lists of the other names for
+      the same file, and 'symlinks' is a list of the symbolic
+      links. Files which can't be examined are left in 'files'.
+
+    """
+    distinct = []
+    hard_links = {}
+    symlinks = []
+    inodes = {}
+    for f in files:
+        try:
+            st = os.lstat(source.path(f))
+        except OSError:
+            distinct.append(f)
+            continue
+        if stat.S_ISLNK(st.st_mode):
+            symlinks.append(f)
+            continue
+        inode = (st.st_dev,st.st_ino)
+        if st.st_nlink > 1 and inode in inodes:
+            hard_links.setdefault(inodes[inode],[]).append(f)
+            continue
+        inodes[inode] = f
+        distinct.append(f)
+    return (distinct,hard_links,symlinks)
+
+def group_by_size(source,files):
+    """Group files in a tree source by their sizes
+
+    Returns a dictionary where the keys are file sizes and the
+    values are lists of the files with that size. Files whose
+    size can't be determined are omitted.
+
+    """
+    sizes = {}
+    for f in files:
+        try:
+            size = source.getsize(f)
+        except (IOError,OSError):
+            continue
+        sizes.setdefault(size,[]).append(f)
+    return sizes
+
+def group_by_md5sum(source,files):
+    """Group files in a tree source by their MD5 sums
+
+    Returns a dictionary where the keys are MD5 sums and the
+    values are lists of the files with that checksum. Files
+    which can't be read are omitted.
+
+    """
+    return group_by_checksum(files,source.md5sum)
+
+def group_by_checksum(files,checksum):
+    """Group files by a checksum function
+
+    Returns a dictionary where the keys are the values returned
+    by the 'checksum' function for each file, and the values are
+    lists of the files with that checksum. Files which can't be
+    read are omitted.
+
+    """
+    chksums = {}
+    for f in files:
+        try:
+            chksum = checksum(f)
+        except (IOError,OSError):
+            continue
+        chksums.setdefault(chksum,[]).append(f)
+    return chksums
+
+def uncompressed_names(files):
+    """Map names of uncompressed files to the actual file names
+
+    Returns a dictionary where the keys are the file names with
+    any compression extension removed, and the values are the
+    original file names. Names which are ambiguous (e.g. if both
+    'file.gz' and 'file.bz2' are present) are omitted.
+
+    """
+    names = {}
+    ambiguous = set()
+    for f in files:
+        if Md5sum.compression_type(f) is not None:
+            name = os.path.splitext(f)[0]
+        else:
+            name = f
+        if name in names:
+            ambiguous.add(name)
+        names[name] = f
+    for name in ambiguous:
+        del(names[name])
+    return names
+
+def file_info(source,filen):
+    """Return the size and modification time of a file in a tree source
+
+    Returns a tuple (size,mtime); the modification time is only
+    available for files in local directories (it's zero for other
+    sources).
+
+    """
+    if isinstance(source,DirectorySource):
+        st = os.stat(source.path(filen))
+        return (st.st_size,st.st_mtime)
+    return (source.getsize(filen),0)
+
+def tree_kind(algorithms):
+    """Return the cache entry kind for directory digests
+
+    """
+    return "tree:%s" % '+'.join(algorithms)
+
+def file_digest_line(name,size,chksums):
+    """Return the line for a file used to generate a directory digest
+
+    """
+    return "f\t%s\t%d\t%s" % (name,size,','.join(chksums))
+
+def dir_digest_line(name,digest):
+    """Return the line for a subdirectory used to generate a directory digest
+
+    """
+    return "d\t%s\t%s" % (name,digest)
+
+def directory_digest(lines):
+    """Return the digest for a directory
+
+    The directory digest is the MD5 sum of the sorted lines
+    for each of the files (giving the name, size and checksums)
+    and subdirectories (giving the name and the subdirectory's
+    digest) that the directory contains, so two directories only
+    have the same digest if everything under them is the same
+    (i.e. it's a Merkle tree).
+
+    """
+    lines = sorted(lines)
+    return Md5sum.checksum_blocks(['\n'.join(lines)],('md5',))[0]
+
+def get_source(spec,cache=None,file_filter=None,algorithms=('md5',)):
+    """Return a tree source object for a source specification
+
+    The specification can be one of:
+
+    - a path to a local directory (returns a DirectorySource
+      which uses 'cache' and 'file_filter', if supplied, for
+      storing checksums and excluding files)
+    - a string of the form 'cmd:COMMAND', where COMMAND is a
+      shell command which runs a hashing agent (e.g. 'cmd:ssh
+      remote.host compare.py --agent /data'); returns an
+      agent.AgentSource
+    - a path to a .tar, .tar.gz, .tgz, .tar.bz2 or .zip file;
+      returns an archive.ArchiveSource (which generates checksums
+      for 'algorithms' while listing a tar archive)
+    - an existing tree source object, which is returned as-is
+
+    """
+    if not isinstance(spec,basestring):
+        return spec
+    if spec.startswith(agent.AGENT_PREFIX):
+        return agent.AgentSource(spec[len(agent.AGENT_PREFIX):])
+    if archive.is_archive(spec):
+        return archive.ArchiveSource(spec,algorithms=algorithms)
+    return DirectorySource(spec,cache=cache,file_filter=file_filter)
+
+def close_sources(sources):
+    """Close tree sources which hold open files or processes
+
+    Archive sources close the archive (see ArchiveSource.close)
+    and agent sources stop the agent; local directories don't
+    need closing.
+
+    """
+    for source in sources:
+        if not isinstance(source,DirectorySource):
+            source.close()
+
+def is_valid_source(spec):
+    """Check if a source specification can be used for a comparison
+
+    Returns True if the specification is an existing directory,
+    a tar or zip archive, or an agent command.
+
+    """
+    return spec.startswith(agent.AGENT_PREFIX) or \
+        archive.is_archive(spec) or \
+        os.path.isdir(spec)
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import tempfile
+import StringIO
+import hashlib
+import gzip
+
+class TestDedupe(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        # Count reads of the first block and full contents
+        self.reads = { 'head': [], 'full': [] }
+        self.md5sum_head = DirectorySource.md5sum_head
+        self.md5sum = DirectorySource.md5sum
+        def md5sum_head(source,filen):
+            self.reads['head'].append(filen)
+            return self.md5sum_head(source,filen)
+        def md5sum(source,filen):
+            self.reads['full'].append(filen)
+            return self.md5sum(source,filen)
+        DirectorySource.md5sum_head = md5sum_head
+        DirectorySource.md5sum = md5sum
+
+    def tearDown(self):
+        DirectorySource.md5sum_head = self.md5sum_head
+        DirectorySource.md5sum = self.md5sum
+        shutil.rmtree(self.wd)
+
+    def _write(self,filen,data):
+        fp = open(os.path.join(self.wd,filen),'wb')
+        fp.write(data)
+        fp.close()
+
+    def _report(self,dedupe):
+        fp = StringIO.StringIO()
+        status = dedupe.report(fp=fp)
+        return (status,fp.getvalue())
+
+    def test_narrowing(self):
+        """Test Dedupe narrows candidates by size, first block and contents
+        """
+        big = 'x'*Md5sum.BLOCKSIZE
+        self._write('small1',"hello")
+        self._write('small2',"hello")
+        self._write('small3',"jello")
+        self._write('unique',"unique size")
+        self._write('big1',big+"same")
+        self._write('big2',big+"same")
+        self._write('big3',big+"diff")
+        self._write('empty1',"")
+        self._write('empty2',"")
+        dedupe = Dedupe(self.wd)
+        self.assertEqual(dedupe._duplicates,
+                         [(len(big)+4,['big1','big2']),
+                          (5,['small1','small2'])])
+        # Files with unique sizes (and empty files) are never read
+        self.assertEqual(sorted(self.reads['head']),
+                         ['big1','big2','big3','small1','small2','small3'])
+        # Only big files need the full contents checking
+        self.assertEqual(sorted(self.reads['full']),['big1','big2','big3'])
+        status,report = self._report(dedupe)
+        self.assertFalse(status)
+        self.assertTrue("\t2 groups of duplicate files\n" in report)
+        self.assertTrue("\t2 duplicate files\n" in report)
+        self.assertTrue("\t%d bytes reclaimable\n" % (len(big)+4+5) in report)
+
+    def test_links_are_not_duplicates(self):
+        """Test Dedupe doesn't count hard and symbolic links as duplicates
+        """
+        self._write('file',"hello")
+        os.link(os.path.join(self.wd,'file'),os.path.join(self.wd,'hardlink'))
+        os.symlink('file',os.path.join(self.wd,'symlink'))
+        dedupe = Dedupe(self.wd)
+        self.assertEqual(dedupe._duplicates,[])
+        self.assertEqual(self.reads['head'],[])
+        status,report = self._report(dedupe)
+        self.assertTrue(status)
+        self.assertTrue("\t1 symbolic links skipped\n" in report)
+        self.assertTrue("\t1 hard links to other files\n" in report)
+        self.assertTrue("\t0 bytes reclaimable\n" in report)
+        self.assertTrue("\nHard linked files (1)\n\tfile\n\t\thardlink\n"
+                        in report)
+
+    def test_hard_link_to_duplicate(self):
+        """Test Dedupe only counts one name for a hard linked duplicate
+        """
+        self._write('file1',"hello")
+        self._write('file2',"hello")
+        os.link(os.path.join(self.wd,'file2'),os.path.join(self.wd,'link'))
+        dedupe = Dedupe(self.wd)
+        self.assertEqual(dedupe._duplicates,[(5,['file1','file2'])])
+        status,report = self._report(dedupe)
+        self.assertTrue("\t5 bytes reclaimable\n" in report)
+        self.assertTrue("\t\tfile2\n\t\t\t(hard link link)\n" in report)
+
+class CompareTestCase(unittest.TestCase):
+    """Base class for tests which need to know which files are read
+
+    Creates a temporary working directory, and records the paths
+    (relative to it) of the files passed to Md5sum.checksums.
+
+    """
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.reads = []
+        self.checksums = Md5sum.checksums
+        def checksums(filen,algorithms=Md5sum.ALGORITHMS):
+            self.reads.append(os.path.relpath(filen,self.wd))
+            return self.checksums(filen,algorithms)
+        Md5sum.checksums = checksums
+
+    def tearDown(self):
+        Md5sum.checksums = self.checksums
+        shutil.rmtree(self.wd)
+
+    def _write(self,filen,text,mtime=None):
+        filen = os.path.join(self.wd,filen)
+        if not os.path.isdir(os.path.dirname(filen)):
+            os.makedirs(os.path.dirname(filen))
+        fp = open(filen,'w')
+        fp.write(text)
+        fp.close()
+        if mtime is not None:
+            os.utime(filen,(mtime,mtime))
+
+    def _report(self,comparison):
+        fp = StringIO.StringIO()
+        status = comparison.report(fp=fp)
+        return (status,fp.getvalue())
+
+class TestTreeDigests(CompareTestCase):
+
+    def setUp(self):
+        CompareTestCase.setUp(self)
+        self.dirs = []
+        for d in ('a','b'):
+            dirn = os.path.join(self.wd,d)
+            os.makedirs(os.path.join(dirn,'deep','er'))
+            self._write(os.path.join(dirn,'top.txt'),"top")
+            self._write(os.path.join(dirn,'deep','f2'),"f2")
+            self._write(os.path.join(dirn,'deep','er','f1'),"f1")
+            # Directory times well in the past, so any change
+            # updates them
+            for subdir in ('',os.path.join('deep','er'),'deep'):
+                os.utime(os.path.join(dirn,subdir),(1000000000,1000000000))
+            self.dirs.append(dirn)
+        self.cache_file = os.path.join(self.wd,'cache')
+
+    def _compare(self):
+        del self.reads[:]
+        results = []
+        comparison = Compare(self.dirs[0],self.dirs[1],
+                             cache_file=self.cache_file,
+                             tree_digests=True,
+                             result_callback=lambda f,status:
+                             results.append((f,status)))
+        status,report = self._report(comparison)
+        return (status,report,dict(results))
+
+    def _cached_paths(self,kind):
+        return sorted([os.path.relpath(path,self.wd) for path,entry in
+                       cache.DigestCache(self.cache_file).entries(kind)])
+
+    def test_skip_unchanged(self):
+        """Test unchanged directories are skipped and reported as such
+        """
+        status,report,results = self._compare()
+        self.assertEqual(len(self.reads),6)
+        self.assertEqual(set(results.values()),set(['OK']))
+        status,report,results = self._compare()
+        self.assertTrue(status)
+        self.assertEqual(self.reads,[])
+        self.assertEqual(set(results.values()),set(['UNCHANGED']))
+        self.assertTrue("\t\t0 files OK\n" in report)
+        self.assertTrue("\t\t3 files OK (unchanged dir), not checked\n"
+                        in report)
+        self.assertTrue("\tOK (unchanged dir)\tdeep/er/f1\n" in report)
+
+    def test_added_file(self):
+        """Test directories with added files aren't skipped
+        """
+        self._compare()
+        for dirn in self.dirs:
+            self._write(os.path.join(dirn,'deep','new.txt'),"new")
+        status,report,results = self._compare()
+        self.assertTrue(status)
+        # Only the new file is read (the others are in the cache)
+        self.assertEqual(sorted(self.reads),['a/deep/new.txt',
+                                             'b/deep/new.txt'])
+        self.assertEqual(results,{ 'top.txt': 'OK',
+                                   'deep/f2': 'OK',
+                                   'deep/new.txt': 'OK',
+                                   'deep/er/f1': 'UNCHANGED' })
+        # Everything is skipped next time
+        status,report,results = self._compare()
+        self.assertEqual(set(results.values()),set(['UNCHANGED']))
+
+    def test_removed_file(self):
+        """Test directories with removed files aren't skipped
+        """
+        self._compare()
+        os.remove(os.path.join(self.dirs[0],'deep','f2'))
+        status,report,results = self._compare()
+        self.assertFalse(status)
+        self.assertEqual(results,{ 'deep/f2': 'ONLY_IN_TO',
+                                   'top.txt': 'OK',
+                                   'deep/er/f1': 'UNCHANGED' })
+
+    def test_cache_cleanup(self):
+        """Test cache entries for removed files and directories are pruned
+        """
+        self._compare()
+        self.assertEqual(self._cached_paths(tree_kind(('md5',))),
+                         ['a','a/deep','a/deep/er','b','b/deep','b/deep/er'])
+        for dirn in self.dirs:
+            os.remove(os.path.join(dirn,'deep','f2'))
+            shutil.rmtree(os.path.join(dirn,'deep','er'))
+        status,report,results = self._compare()
+        self.assertTrue(status)
+        self.assertEqual(self._cached_paths('md5'),['a/top.txt','b/top.txt'])
+        self.assertEqual(self._cached_paths(tree_kind(('md5',))),
+                         ['a','a/deep','b','b/deep'])
+
+class TestCompare(CompareTestCase):
+
+    def setUp(self):
+        CompareTestCase.setUp(self)
+        self.dirs = [os.path.join(self.wd,d) for d in ('a','b')]
+        for d in ('a','b'):
+            self._write(os.path.join(d,'f1'),"same")
+
+    def test_dangling_symlink_with_cache(self):
+        """Test dangling symbolic links are unreadable when using a cache
+        """
+        for d in self.dirs:
+            os.symlink('missing',os.path.join(d,'dang'))
+        for cache_file in (None,os.path.join(self.wd,'cache')):
+            results = []
+            comparison = Compare(self.dirs[0],self.dirs[1],
+                                 cache_file=cache_file,
+                                 result_callback=lambda f,status:
+                                 results.append((f,status)))
+            self.assertEqual(dict(results),{ 'f1': 'OK',
+                                             'dang': 'UNREADABLE' })
+            status,report = self._report(comparison)
+            self.assertFalse(status)
+            self.assertTrue("\t\t1 files UNREADABLE\n" in report)
+
+    def test_exclude_regex_dir(self):
+        """Test directories excluded by a regular expression are pruned
+        """
+        for d in ('scratch','scratch2','data'):
+            for name in self.dirs:
+                self._write(os.path.join(name,d,'x'),"x")
+        # Record the files which the filter is applied to
+        checked = []
+        class RecordingFilter(filters.FileFilter):
+            def exclude_file(self,path):
+                checked.append(path)
+                return filters.FileFilter.exclude_file(self,path)
+        comparison = Compare(self.dirs[0],self.dirs[1],
+                             file_filter=RecordingFilter(
+                                 exclude=['re:^scratch/']))
+        self.assertEqual(sorted(comparison._common),
+                         ['data/x','f1','scratch2/x'])
+        # Files under the excluded directories are never looked at
+        self.assertFalse('scratch/x' in checked)
+        self.assertTrue('scratch2/x' in checked)
+
+class TestDetectMoves(CompareTestCase):
+
+    def setUp(self):
+        CompareTestCase.setUp(self)
+        self.dirs = [os.path.join(self.wd,d) for d in ('a','b')]
+        for filen,text in (('a/f1',"same"),
+                           ('b/f1',"same"),
+                           ('a/old',"moved data"),
+                           ('b/sub/new',"moved data"),
+                           ('a/renamed',"before"),
+                           ('b/renamed2',"after!"),
+                           ('a/dup1',"dup"),
+                           ('a/dup2',"dup"),
+                           ('b/copy',"dup"),
+                           ('a/lonely',"unique size")):
+            self._write(filen,text)
+
+    def test_detect_moves(self):
+        """Test moved and renamed files are matched up by their contents
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1],detect_moves=True)
+        # Only one of the duplicate candidates can be matched
+        self.assertEqual(comparison._moved,[('dup1','copy'),
+                                            ('old','sub/new')])
+        # Renamed files with changed contents aren't matched
+        self.assertEqual(comparison._only_in_from,['dup2','lonely',
+                                                   'renamed'])
+        self.assertEqual(comparison._only_in_to,['renamed2'])
+        # Files whose sizes don't match anything aren't read
+        self.assertEqual(sorted(self.reads),['a/dup1','a/dup2','a/f1',
+                                             'a/old','a/renamed',
+                                             'b/copy','b/f1','b/renamed2',
+                                             'b/sub/new'])
+        status,report = self._report(comparison)
+        self.assertFalse(status)
+        self.assertTrue("\t2 files moved or renamed\n" in report)
+        self.assertTrue("\nFiles moved or renamed (2)\n"
+                        "\tdup1\t->\tcopy\n"
+                        "\told\t->\tsub/new\n" in report)
+
+    def test_no_moves(self):
+        """Test nothing is matched when moves aren't being detected
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1])
+        self.assertEqual(comparison._moved,[])
+        self.assertEqual(len(comparison._only_in_from),5)
+        self.assertEqual(sorted(self.reads),['a/f1','b/f1'])
+        status,report = self._report(comparison)
+        self.assertFalse("moved or renamed" in report)
+
+class TestUpdateFiles(CompareTestCase):
+
+    def setUp(self):
+        CompareTestCase.setUp(self)
+        self.dirs = [os.path.join(self.wd,d) for d in ('a','b')]
+        for d in ('a','b'):
+            for name,text in (('f1',"same"),('f2',"same2"),('f3',"keep")):
+                self._write(os.path.join(d,name),text,mtime=1000000000)
+        self.cache_file = os.path.join(self.wd,'cache')
+
+    def test_update_files(self):
+        """Test only changed files are examined again
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1],
+                             cache_file=self.cache_file)
+        self.assertEqual(len(self.reads),6)
+        self._write(os.path.join('a','f1'),"changed")
+        os.remove(os.path.join(self.dirs[1],'f2'))
+        for d in ('a','b'):
+            self._write(os.path.join(d,'new'),"new")
+        del self.reads[:]
+        results = comparison.update_files(['f1','f2','new'])
+        self.assertEqual(results,[('f1','FAILED'),
+                                  ('f2','ONLY_IN_FROM'),
+                                  ('new','OK')])
+        # The unchanged copy of f1 comes from the cache, and
+        # files which haven't changed aren't looked at
+        self.assertEqual(sorted(self.reads),['a/f1','a/new','b/new'])
+        status,report = self._report(comparison)
+        self.assertFalse(status)
+        self.assertTrue("\t1 files only found in %s\n" % self.dirs[0]
+                        in report)
+        self.assertTrue("\t\t2 files OK\n\t\t1 files FAILED\n" in report)
+        self.assertTrue("\tFAILED\tf1\n" in report)
+        # Put f1 back, and remove f2 completely
+        self._write(os.path.join('a','f1'),"same",mtime=1000000001)
+        os.remove(os.path.join(self.dirs[0],'f2'))
+        del self.reads[:]
+        results = comparison.update_files(['f1','f2'])
+        self.assertEqual(results,[('f1','OK'),('f2','REMOVED')])
+        self.assertEqual(self.reads,['a/f1'])
+        status,report = self._report(comparison)
+        self.assertTrue(status)
+        self.assertTrue("\t\t3 files OK\n\t\t0 files FAILED\n" in report)
+
+    def test_update_files_without_cache(self):
+        """Test files which aren't updated are not read without a cache
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1])
+        self._write(os.path.join('b','f3'),"KEEP")
+        del self.reads[:]
+        results = comparison.update_files(['f3'])
+        self.assertEqual(results,[('f3','FAILED')])
+        self.assertEqual(sorted(self.reads),['a/f3','b/f3'])
+
+class TestManifest(CompareTestCase):
+
+    def setUp(self):
+        CompareTestCase.setUp(self)
+        self.dirs = [os.path.join(self.wd,d) for d in ('a','b')]
+        for d,contents in (('a',("same","one","only",None,"moved",None,
+                                 "zipped",None)),
+                           ('b',("same","two",None,"extra",None,"moved",
+                                 None,"zipped"))):
+            for name,text in zip(('f1','f2','f3','f4','old','new',
+                                  'c.txt','c.txt.gz'),contents):
+                if text is None:
+                    continue
+                if name.endswith('.gz'):
+                    fp = gzip.open(os.path.join(self.wd,d,name),'wb')
+                    fp.write(text)
+                    fp.close()
+                else:
+                    self._write(os.path.join(d,name),text)
+
+    def _checksum(self,text,algorithm='md5'):
+        return hashlib.new(algorithm,text).hexdigest()
+
+    def _manifest(self,comparison,algorithm='md5'):
+        fp = StringIO.StringIO()
+        comparison.write_manifest(fp=fp,algorithm=algorithm)
+        return fp.getvalue()
+
+    def test_multiple_digests(self):
+        """Test comparing files using multiple checksums
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1],
+                             digests=('md5','sha1'),
+                             keep_checksums=True)
+        self.assertEqual(comparison._failed_md5,['f2'])
+        self.assertEqual(comparison._from_chksums['f2'],
+                         (self._checksum("one"),
+                          self._checksum("one",'sha1')))
+        self.assertEqual(comparison._to_chksums['f2'],
+                         (self._checksum("two"),
+                          self._checksum("two",'sha1')))
+        # Each file is only read once for both checksums
+        self.assertEqual(sorted(self.reads),['a/c.txt','a/f1','a/f2','a/f3',
+                                             'a/old','b/f1','b/f2'])
+        self.assertEqual(self._manifest(comparison,'sha1'),
+                         "%s  c.txt\n%s  f1\n%s  f2\n%s  f3\n%s  old\n" %
+                         tuple([self._checksum(text,'sha1') for text in
+                                ("zipped","same","one","only","moved")]))
+        self.assertRaises(ValueError,self._manifest,comparison,'sha256')
+
+    def test_manifest_includes_moved_and_compressed(self):
+        """Test the manifest includes moved and compressed files
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1],
+                             detect_moves=True,decompress=True,
+                             keep_checksums=True)
+        self.assertEqual(comparison._moved,[('old','new')])
+        self.assertEqual(comparison._compressed_pairs,[('c.txt','c.txt.gz')])
+        self.assertEqual(self._manifest(comparison),
+                         "%s  c.txt\n%s  f1\n%s  f2\n%s  f3\n%s  old\n" %
+                         tuple([self._checksum(text) for text in
+                                ("zipped","same","one","only","moved")]))
+
+    def test_manifest_after_copy(self):
+        """Test the manifest includes copied files
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1],copy=True,
+                             keep_checksums=True)
+        self.assertEqual(comparison._copied,['c.txt','f2','f3','old'])
+        self.assertEqual(self._manifest(comparison),
+                         "%s  c.txt\n%s  f1\n%s  f2\n%s  f3\n%s  old\n" %
+                         tuple([self._checksum(text) for text in
+                                ("zipped","same","one","only","moved")]))
+
+class TestCopyFiles(CompareTestCase):
+
+    def setUp(self):
+        CompareTestCase.setUp(self)
+        self.dirs = [os.path.join(self.wd,d) for d in ('a','b')]
+        for d,contents in (('a',("same","new","only")),
+                           ('b',("same","old",None))):
+            for name,text in zip(('f1','f2','sub/f3'),contents):
+                if text is not None:
+                    self._write(os.path.join(d,name),text)
+
+    def _read(self,filen):
+        return open(os.path.join(self.wd,filen)).read()
+
+    def test_copy_files(self):
+        """Test missing and differing files are copied and verified
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1],copy=True)
+        self.assertEqual(comparison._copied,['f2','sub/f3'])
+        self.assertEqual(comparison._copy_failed,[])
+        self.assertEqual(self._read('b/f2'),"new")
+        self.assertEqual(self._read('b/sub/f3'),"only")
+        self.assertEqual(sorted(os.listdir(self.dirs[1])),['f1','f2','sub'])
+        status,report = self._report(comparison)
+        self.assertTrue(status)
+        self.assertTrue("\t2 files copied and verified\n" in report)
+
+    def test_verification_failed(self):
+        """Test the target is left untouched if a copy fails to verify
+        """
+        def checksums(filen,algorithms=Md5sum.ALGORITHMS):
+            self.reads.append(os.path.relpath(filen,self.wd))
+            chksums = self.checksums(filen,algorithms)
+            if filen.endswith('.copying'):
+                # Simulate the copy being corrupted
+                chksums = tuple(['0'*len(c) for c in chksums])
+            return chksums
+        Md5sum.checksums = checksums
+        comparison = Compare(self.dirs[0],self.dirs[1],copy=True)
+        self.assertEqual(comparison._copied,[])
+        self.assertEqual(comparison._copy_failed,
+                         [('f2',"verification failed"),
+                          ('sub/f3',"verification failed")])
+        # The target is unchanged and there are no temporary files
+        self.assertEqual(self._read('b/f2'),"old")
+        self.assertEqual(sorted(os.listdir(self.dirs[1])),['f1','f2','sub'])
+        self.assertEqual(os.listdir(os.path.join(self.dirs[1],'sub')),[])
+        status,report = self._report(comparison)
+        self.assertFalse(status)
+        self.assertTrue("\tCOPY FAILED\tf2\t(verification failed)\n"
+                        in report)
+
+class TestAgentCompare(CompareTestCase):
+
+    def setUp(self):
+        CompareTestCase.setUp(self)
+        self.dirs = [os.path.join(self.wd,d) for d in ('a','b')]
+        for d,contents in (('a',("same","one","only")),
+                           ('b',("same","two",None))):
+            for name,text in zip(('f1','f2','f3'),contents):
+                if text is not None:
+                    self._write(os.path.join(d,name),text)
+        self.package_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def _compare(self,command):
+        results = []
+        comparison = Compare(self.dirs[0],"%s%s" % (agent.AGENT_PREFIX,
+                                                    command),
+                             result_callback=lambda f,status:
+                             results.append((f,status)))
+        return (comparison,dict(results))
+
+    def test_compare_with_agent(self):
+        """Test comparing a directory against an agent
+        """
+        comparison,results = self._compare(
+            '"%s" "%s" --agent "%s"' % (sys.executable,
+                                       os.path.join(self.package_dir,
+                                                    'compare.py'),
+                                       self.dirs[1]))
+        self.assertEqual(results,{ 'f1': 'OK',
+                                   'f2': 'FAILED',
+                                   'f3': 'ONLY_IN_FROM' })
+
+    def test_agent_stops(self):
+        """Test files are unreadable if the agent stops
+        """
+        # Agent which stops after listing the files
+        script = os.path.join(self.wd,'list_only.py')
+        self._write(script,
+                    "import sys\n"
+                    "sys.path.insert(0,sys.argv[1])\n"
+                    "import agent,compare\n"
+                    "src = compare.DirectorySource(sys.argv[2])\n"
+                    "agent.read_message(sys.stdin)\n"
+                    "for f in src.list_files():\n"
+                    "    agent.write_message(sys.stdout,'%d %s' %\n"
+                    "                        (src.getsize(f),f))\n"
+                    "agent.write_message(sys.stdout,'')\n")
+        comparison,results = self._compare(
+            '"%s" "%s" "%s" "%s"' % (sys.executable,script,
+                                     self.package_dir,self.dirs[1]))
+        self.assertEqual(results,{ 'f1': 'UNREADABLE',
+                                   'f2': 'UNREADABLE',
+                                   'f3': 'ONLY_IN_FROM' })
+        status,report = self._report(comparison)
+        self.assertFalse(status)
+        self.assertTrue("\t\t2 files UNREADABLE\n" in report)
+
+class TestMultiCompare(CompareTestCase):
+
+    def setUp(self):
+        CompareTestCase.setUp(self)
+        self.dirs = [os.path.join(self.wd,d) for d in ('a','b','c')]
+        for d,contents in (('a',("same","diff","only")),
+                           ('b',("same","DIFF",None)),
+                           ('c',("same","diff",None))):
+            for name,text in zip(('f1','f2','f3'),contents):
+                if text is not None:
+                    self._write(os.path.join(d,name),text)
+        self._write(os.path.join('c','extra'),"extra")
+
+    def _compare(self,cache_file=None):
+        del self.reads[:]
+        return MultiCompare(self.dirs[0],self.dirs[1:],
+                            cache_file=cache_file)
+
+    def test_multi_compare(self):
+        """Test MultiCompare reports the status of each target
+        """
+        comparison = self._compare()
+        self.assertEqual(comparison._status,
+                         [{ 'f1': 'OK', 'f2': 'FAILED', 'f3': 'MISSING' },
+                          { 'f1': 'OK', 'f2': 'OK', 'f3': 'MISSING' }])
+        # The source is only read once
+        self.assertEqual(sorted(self.reads),['a/f1','a/f2',
+                                             'b/f1','b/f2',
+                                             'c/f1','c/f2'])
+        status,report = self._report(comparison)
+        self.assertFalse(status)
+        self.assertTrue("\t[2] %s\n\t\t2 files OK\n\t\t0 files FAILED\n"
+                        "\t\t0 files UNREADABLE\n\t\t1 files MISSING\n"
+                        "\t\t1 files EXTRA\n" % self.dirs[2] in report)
+        self.assertTrue("\tFAILED\tOK\tf2\n" in report)
+        self.assertTrue("\t-\tEXTRA\textra\n" in report)
+
+    def test_dangling_symlink_with_cache(self):
+        """Test MultiCompare reports dangling symbolic links as unreadable
+        """
+        for d in self.dirs:
+            os.symlink('missing',os.path.join(d,'dang'))
+        for cache_file in (None,os.path.join(self.wd,'cache')):
+            comparison = self._compare(cache_file)
+            for status in comparison._status:
+                self.assertEqual(status['dang'],'UNREADABLE')
+                self.assertEqual(status['f1'],'OK')
+            status,report = self._report(comparison)
+            self.assertTrue("\tUNREADABLE\tUNREADABLE\tdang\n" in report)
+
+    def test_failed_thread(self):
+        """Test MultiCompare reports files as unreadable if a thread fails
+        """
+        def checksums(filen,algorithms=Md5sum.ALGORITHMS):
+            raise Exception("Failed")
+        Md5sum.checksums = checksums
+        # Hide the tracebacks from the failed threads
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            comparison = self._compare()
+        finally:
+            sys.stderr = stderr
+        for status in comparison._status:
+            self.assertEqual(status['f1'],'UNREADABLE')
+            self.assertEqual(status['f2'],'UNREADABLE')
+
+class TestMaxFailures(CompareTestCase):
+
+    def setUp(self):
+        CompareTestCase.setUp(self)
+        self.dirs = []
+        for d,contents in (('a',("same1","same2","old","new","short")),
+                           ('b',("same1","same2","OLD","NEW","longer"))):
+            for name,text,mtime in zip(('f1','f2','f3','f4','f5'),contents,
+                                       (3000,4000,1000,5000,2000)):
+                self._write(os.path.join(d,name),text,mtime)
+            self.dirs.append(os.path.join(self.wd,d))
+
+    def test_size_mismatch_fails_without_reading(self):
+        """Test files whose sizes differ fail first, without being read
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1],max_failures=1)
+        self.assertEqual(self.reads,[])
+        status,report = self._report(comparison)
+        self.assertFalse(status)
+        self.assertTrue("\tStopped after reaching 1 failures\n" in report)
+        self.assertTrue("\t\t0 files OK\n\t\t1 files FAILED\n" in report)
+        self.assertTrue("\t\t4 files NOT CHECKED\n" in report)
+        self.assertTrue("\tFAILED\tf5\n\t\t\tSizes: from 5\tTo 6\n" in report)
+        for name in ('f1','f2','f3','f4'):
+            self.assertTrue("\tNOT CHECKED\t%s\n" % name in report)
+
+    def test_most_recently_modified_first(self):
+        """Test files are checked starting with the most recently modified
+        """
+        comparison = Compare(self.dirs[0],self.dirs[1],max_failures=2)
+        # Only the newest file needs to be read to find a second failure
+        self.assertEqual(sorted(self.reads),['a/f4','b/f4'])
+        status,report = self._report(comparison)
+        self.assertFalse(status)
+        self.assertTrue("\tFAILED\tf4\n" in report)
+        self.assertTrue("\t\t3 files NOT CHECKED\n" in report)
+        comparison = Compare(self.dirs[0],self.dirs[1],max_failures=3)
+        self.assertEqual([f for f in self.reads[2:] if f.startswith('a/')],
+                         ['a/f4','a/f2','a/f1','a/f3'])
+        status,report = self._report(comparison)
+        self.assertTrue("\t\t2 files OK\n\t\t3 files FAILED\n" in report)
+        self.assertTrue("\t\t0 files NOT CHECKED\n" in report)
+
+    def test_only_in_one_directory_counts_as_failure(self):
+        """Test files only in one directory count towards the maximum
+        """
+        self._write(os.path.join('a','extra'),"extra")
+        comparison = Compare(self.dirs[0],self.dirs[1],max_failures=1)
+        self.assertEqual(self.reads,[])
+        status,report = self._report(comparison)
+        self.assertFalse(status)
+        self.assertTrue("\t\t5 files NOT CHECKED\n" in report)
+
+#######################################################################
+# Main program
+#######################################################################
+
+if __name__ == "__main__":
+    usage = "\n\t%prog FROM_DIR TO_DIR [ OUTPUT_FILE ]\n\t%prog --dedupe DIR [ OUTPUT_FILE ]\n\t%prog --manifests OLD NEW [ OUTPUT_FILE ]"
+    p = optparse.OptionParser(usage=usage,
+                              version="%prog "+__version__,
+                              description=
+                              "compare contents of a pair of directories using "
+                              "MD5 sums")
+    # Define options
+    p.add_option('--progress',action="store_true",dest="progress",default=False,
+                 help="report progress")
+    p.add_option('--use-natural-sort',action="store_true",dest="use_natural_sort",default=False,
+                 help="use 'natural sort order' for ordering files (same as Windows Explorer)")
+    p.add_option('--to',action="append",dest="to_dirs",default=[],
+                 help="also compare FROM_DIR against DIR (can be specified "
+                 "multiple times to compare against several replicas in a "
+                 "single pass, with FROM_DIR only being read once)")
+    p.add_option('--decompress',action="store_true",dest="decompress",default=False,
+                 help="pair up compressed and uncompressed versions of files "
+                 "(e.g. 'file.txt' and 'file.txt.gz') and compare their "
+                 "uncompressed contents")
+    p.add_option('--detect-moves',action="store_true",dest="detect_moves",default=False,
+                 help="look for files which have been moved or renamed, by "
+                 "matching the contents of files which are only in one "
+                 "directory against those only in the other")
+    p.add_option('--digest',action="append",dest="digests",default=[],
+                 help="checksum algorithm to use to compare files: one of "
+                 "%s (default is md5); can be specified multiple times to "
+                 "use several checksums, which are all generated from a "
+                 "single read of each file" % ', '.join(Md5sum.ALGORITHMS))
+    p.add_option('--manifest',action="store",dest="manifest",default=None,
+                 help="write a checksum manifest for the files in FROM_DIR "
+                 "to MANIFEST, in the same format as 'md5sum' (if multiple "
+                 "checksums are specified using --digest then a manifest is "
+                 "written for each, as MANIFEST.md5, MANIFEST.sha256 etc)")
+    p.add_option('--copy',action="store_true",dest="copy",default=False,
+                 help="copy files which are missing from TO_DIR, or which "
+                 "differ, from FROM_DIR and verify the copies (the source "
+                 "files are only read once)")
+    p.add_option('--drop-cache',action="store_true",dest="drop_cache",
+                 default=False,
+                 help="with --copy, ask the operating system to drop cached "
+                 "data for the copied files before verifying them so that "
+                 "they are re-read from disk")
+    p.add_option('--io-scheduler',action="store_true",dest="io_scheduler",
+                 default=False,
+                 help="read files in parallel, grouped by storage device "
+                 "(with a number of concurrent reads depending on the type "
+                 "of device) and in physical order on each device")
+    p.add_option('--io-order',action="store",dest="io_order",default='extent',
+                 choices=scheduler.ORDERINGS,
+                 help="with --io-scheduler, order in which files are read on "
+                 "each device: 'extent' (physical location on disk, where "
+                 "available), 'inode' or 'none' (default: 'extent')")
+    p.add_option('--device-concurrency',action="append",
+                 dest="device_concurrency",default=[],
+                 help="with --io-scheduler, set the number of concurrent "
+                 "reads for a device type, as TYPE=N where TYPE is one of "
+                 "%s (defaults: %s); can be specified multiple times" %
+                 (', '.join(sorted(scheduler.DEVICE_CONCURRENCY.keys())),
+                  ', '.join(["%s=%d" % (t,scheduler.DEVICE_CONCURRENCY[t])
+                             for t in sorted(scheduler.DEVICE_CONCURRENCY)])))
+    p.add_option('--small-file-threshold',action="store",
+                 dest="small_file_threshold",default=None,
+                 help="read files of SIZE bytes or more first (largest "
+                 "first) and then read smaller files in batches; SIZE can "
+                 "have a suffix K, M or G (e.g. 64K). Implies "
+                 "--io-scheduler")
+    p.add_option('--device-type',action="append",dest="device_types",default=[],
+                 help="with --io-scheduler, treat files under PATH as being "
+                 "on a device of the specified type, as PATH=TYPE (overrides "
+                 "automatic detection); can be specified multiple times")
+    p.add_option('--watch',action="store_true",dest="watch",default=False,
+                 help="after the comparison keep watching FROM_DIR and "
+                 "TO_DIR for changes (Linux only), re-examining only the "
+                 "files which are created, modified, moved or deleted; "
+                 "each change is written to stdout and the report in "
+                 "OUTPUT_FILE (if given) is updated")
+    p.add_option('--max-failures',action="store",type="int",
+                 dest="max_failures",default=None,
+                 help="stop the comparison once N files have failed (i.e. "
+                 "differ, can't be read, or are only in one of the "
+                 "directories); files whose sizes differ are checked first, "
+                 "then the most recently modified files, then files whose "
+                 "cached checksums are oldest. Files which weren't checked "
+                 "are reported as 'NOT CHECKED', and the exit status is 1 if "
+                 "any files failed")
+    p.add_option('--fail-fast',action="store_const",const=1,
+                 dest="max_failures",
+                 help="stop the comparison at the first failure (same as "
+                 "--max-failures=1)")
+    p.add_option('--max-read-rate',action="store",type="float",
+                 dest="max_read_rate",default=None,metavar="MB_PER_SEC",
+                 help="limit the total rate at which files are read to "
+                 "MB_PER_SEC megabytes per second (across all threads)")
+    p.add_option('--max-opens-per-sec',action="store",type="float",
+                 dest="max_opens",default=None,metavar="N",
+                 help="limit the number of files opened to N per second")
+    p.add_option('--limits-file',action="store",dest="limits_file",
+                 default=None,
+                 help="check LIMITS_FILE every few seconds while running "
+                 "and use the limits in it instead of --max-read-rate and "
+                 "--max-opens-per-sec (lines 'max-read-rate=MB_PER_SEC' "
+                 "and/or 'max-opens-per-sec=N', with 0 for no limit); the "
+                 "original limits are restored if the file is removed")
+    p.add_option('--ionice',action="store",dest="ionice",default=None,
+                 metavar="CLASS[:LEVEL]",
+                 help="set the I/O scheduling class and priority level in "
+                 "the same way as the 'ionice' utility (Linux only), where "
+                 "CLASS is one of %s and LEVEL is 0 (highest) to 7 "
+                 "(lowest), e.g. 'idle' or 'best-effort:7'" %
+                 ', '.join(sorted(throttle.IOPRIO_CLASSES)))
+    p.add_option('--nice',action="store",type="int",dest="nice",default=None,
+                 help="increase the 'niceness' of the process by NICE "
+                 "(i.e. lower its CPU priority)")
+    p.add_option('--exclude',action="append",dest="exclude",default=[],
+                 help="exclude files and directories matching PATTERN (a "
+                 "glob pattern, or a regular expression if prefixed with "
+                 "'re:'; end with '/' to only match directories); can be "
+                 "specified multiple times")
+    p.add_option('--include',action="append",dest="include",default=[],
+                 help="only include files matching PATTERN (same syntax as "
+                 "--exclude); can be specified multiple times")
+    p.add_option('--exclude-from',action="store",dest="ignore_file",default=None,
+                 help="read include and exclude patterns from IGNORE_FILE")
+    p.add_option('--cache',action="store",dest="cache_file",default=None,
+                 help="store checksums in CACHE_FILE and reuse them for "
+                 "files which haven't changed on subsequent runs")
+    p.add_option('--skip-unchanged-dirs',action="store_true",
+                 dest="tree_digests",default=False,
+                 help="with --cache, also store a digest for each directory "
+                 "and skip directories where nothing has been added, "
+                 "removed or renamed on either side since the last run "
+                 "(NB files modified in place in these directories are not "
+                 "detected)")
+    p.add_option('--dedupe',action="store_true",dest="dedupe",default=False,
+                 help="find files with duplicate contents within a single "
+                 "directory DIR, instead of comparing two directories")
+    p.add_option('--manifests',action="store",nargs=2,dest="manifests",
+                 default=None,metavar="OLD NEW",
+                 help="compare two checksum manifests OLD and NEW (in the "
+                 "format written by 'md5sum' or --manifest) instead of "
+                 "comparing two directories; none of the files are read, "
+                 "and manifests of any size are compared using a fixed "
+                 "amount of memory")
+    p.add_option('--agent',action="store",dest="agent_root",default=None,
+                 help="run as a hashing agent for directory AGENT_ROOT, "
+                 "communicating via stdin/stdout (FROM_DIR or TO_DIR can be "
+                 "specified as 'cmd:COMMAND' to use an agent)")
+
+    # Process command line
+    options,arguments = p.parse_args()
+    for digest in options.digests:
+        if digest not in Md5sum.ALGORITHMS:
+            p.error("%s: unrecognised checksum algorithm" % digest)
+
+    # Set up filtering of files
+    if options.include or options.exclude or options.ignore_file:
+        if options.ignore_file and not os.path.isfile(options.ignore_file):
+            p.error("%s: file not found" % options.ignore_file)
+        file_filter = filters.FileFilter(include=options.include,
+                                         exclude=options.exclude,
+                                         ignore_file=options.ignore_file)
+    else:
+        file_filter = None
+
+    # Set up limits on reading
+    for value in (options.max_read_rate,options.max_opens):
+        if value is not None and value < 0:
+            p.error("limits on reading can't be negative")
+    if options.max_read_rate or options.max_opens or options.limits_file:
+        max_read_rate = options.max_read_rate
+        if max_read_rate:
+            max_read_rate *= throttle.MB
+        read_throttle = throttle.Throttle(max_read_rate=max_read_rate,
+                                          max_opens=options.max_opens,
+                                          control_file=options.limits_file)
+        read_throttle.check_control_file(force=True)
+        throttle.install(read_throttle)
+    if options.ionice is not None:
+        try:
+            throttle.set_io_priority(*throttle.parse_io_priority(
+                options.ionice))
+        except ValueError,ex:
+            p.error("%s: bad value for --ionice (%s)" % (options.ionice,ex))
+        except OSError,ex:
+            p.error("unable to set I/O priority: %s" % ex.strerror)
+    if options.nice is not None:
+        try:
+            os.nice(options.nice)
+        except OSError,ex:
+            p.error("unable to set niceness: %s" % ex.strerror)
+
+    if options.agent_root is not None:
+        # Run as an agent
+        if not os.path.isdir(options.agent_root):
+            p.error("%s: directory not found" % options.agent_root)
+        if options.cache_file is not None:
+            agent_cache = cache.DigestCache(options.cache_file)
+        else:
+            agent_cache = None
+        agent.serve(DirectorySource(options.agent_root,cache=agent_cache,
+                                    file_filter=file_filter))
+        if agent_cache is not None:
+            agent_cache.save()
+        sys.exit(0)
+    if options.manifests is not None:
+        # Compare manifests
+        if len(arguments) > 1:
+            p.error("--manifests takes an optional OUTPUT_FILE argument")
+        for filen in options.manifests:
+            if not os.path.isfile(filen):
+                p.error("%s: file not found" % filen)
+        if len(arguments) == 1:
+            output_file = arguments[0]
+        else:
+            output_file = None
+        if options.use_natural_sort:
+            sort_key = SortKeys.natural
+        else:
+            sort_key = None
+        try:
+            manifest.ManifestCompare(options.manifests[0],
+                                     options.manifests[1],
+                                     report_progress=options.progress,
+                                     sort_key=sort_key).report(output_file)
+        except ValueError,ex:
+            p.error(str(ex))
+        sys.exit(0)
+    if options.dedupe:
+        # Look for duplicate files
+        if len(arguments) < 1 or len(arguments) > 2:
+            p.error("--dedupe takes either 1 or 2 arguments: DIR and "
+                    "optional OUTPUT_FILE")
+        if not os.path.isdir(arguments[0]):
+            p.error("%s: directory not found" % arguments[0])
+        if len(arguments) == 2:
+            output_file = arguments[1]
+        else:
+            output_file = None
+        if options.use_natural_sort:
+            sort_key = SortKeys.natural
+        else:
+            sort_key = SortKeys.default
+        Dedupe(arguments[0],
+               report_progress=options.progress,
+               sort_key=sort_key,
+               cache_file=options.cache_file,
+               file_filter=file_filter).report(output_file)
+        sys.exit(0)
+    if len(arguments) < 2 or len(arguments) > 3:
+        p.error("Takes either 2 or 3 arguments: FROM_DIR, TO_DIR and optional OUTPUT_FILE")
+    from_dir = arguments[0]
+    if not is_valid_source(from_dir):
+        p.error("%s: directory not found" % from_dir)
+    to_dir = arguments[1]
+    if not is_valid_source(to_dir):
+        p.error("%s: directory not found" % to_dir)
+    if len(arguments) == 3:
+        output_file = arguments[2]
+    else:
+        output_file = None
+    if options.copy and not (os.path.isdir(from_dir) and os.path.isdir(to_dir)):
+        p.error("--copy can only be used when FROM_DIR and TO_DIR are "
+                "both local directories")
+    if options.tree_digests:
+        if options.cache_file is None:
+            p.error("--skip-unchanged-dirs can only be used with --cache")
+        if not (os.path.isdir(from_dir) and os.path.isdir(to_dir)):
+            p.error("--skip-unchanged-dirs can only be used when FROM_DIR "
+                    "and TO_DIR are both local directories")
+    if options.watch:
+        if not (os.path.isdir(from_dir) and os.path.isdir(to_dir)):
+            p.error("--watch can only be used when FROM_DIR and TO_DIR are "
+                    "both local directories")
+        if options.to_dirs or options.decompress or options.detect_moves or \
+           options.copy:
+            p.error("--to, --decompress, --detect-moves and --copy can't be "
+                    "used with --watch")
+        if not watch.is_available():
+            p.error("--watch is only available on Linux")
+    if options.max_failures is not None:
+        if options.max_failures < 1:
+            p.error("--max-failures must be at least 1")
+        if options.to_dirs or options.copy or options.watch or \
+           options.io_scheduler or options.small_file_threshold:
+            p.error("--to, --copy, --watch and --io-scheduler can't be used "
+                    "with --max-failures or --fail-fast")
+
+    # Setup sorting function
+    if options.use_natural_sort:
+        sort_key = SortKeys.natural
+    else:
+        sort_key = SortKeys.default
+
+    # Set up the I/O scheduler
+    if options.small_file_threshold is not None:
+        try:
+            small_file_threshold = scheduler.parse_size(
+                options.small_file_threshold)
+        except ValueError:
+            p.error("%s: bad value for --small-file-threshold" %
+                    options.small_file_threshold)
+        options.io_scheduler = True
+    else:
+        small_file_threshold = None
+    if options.io_scheduler:
+        concurrency = {}
+        for value in options.device_concurrency:
+            try:
+                device_type,n = value.split('=')
+                concurrency[device_type] = int(n)
+            except ValueError:
+                p.error("%s: bad value for --device-concurrency" % value)
+            if device_type not in scheduler.DEVICE_CONCURRENCY:
+                p.error("%s: unrecognised device type" % device_type)
+        device_types = {}
+        for value in options.device_types:
+            try:
+                path,device_type = value.rsplit('=',1)
+            except ValueError:
+                p.error("%s: bad value for --device-type" % value)
+            if device_type not in scheduler.DEVICE_CONCURRENCY:
+                p.error("%s: unrecognised device type" % device_type)
+            device_types[path] = device_type
+        io_scheduler = scheduler.IOScheduler(concurrency=concurrency,
+                                             order=options.io_order,
+                                             device_types=device_types,
+                                             small_file_threshold=
+                                             small_file_threshold)
+    else:
+        io_scheduler = None
+
+    # Set up logging output
+    logging.basicConfig(format='%(message)s')
+    
+    # Invoke the comparison
+    if options.to_dirs:
+        for d in options.to_dirs:
+            if not is_valid_source(d):
+                p.error("%s: directory not found" % d)
+        if options.decompress or options.detect_moves or options.digests or \
+           options.manifest or options.copy:
+            p.error("--decompress, --detect-moves, --digest, --manifest "
+                    "and --copy can't be used with --to")
+        MultiCompare(from_dir,[to_dir]+options.to_dirs,
+                     report_progress=options.progress,
+                     sort_key=sort_key,
+                     cache_file=options.cache_file,
+                     file_filter=file_filter).report(output_file)
+        sys.exit(0)
+    if options.watch:
+        # Start watching before the comparison so that changes made
+        # while it's running aren't missed
+        watcher = watch.Watcher([from_dir,to_dir],file_filter=file_filter)
+    comparison = Compare(from_dir,to_dir,
+                         report_progress=options.progress,
+                         sort_key=sort_key,
+                         decompress=options.decompress,
+                         cache_file=options.cache_file,
+                         detect_moves=options.detect_moves,
+                         file_filter=file_filter,
+                         digests=options.digests,
+                         keep_checksums=(options.manifest is not None),
+                         copy=options.copy,
+                         drop_cache=options.drop_cache,
+                         io_scheduler=io_scheduler,
+                         tree_digests=options.tree_digests,
+                         max_failures=options.max_failures)
+    if options.manifest is not None:
+        digests = options.digests
+        if not digests:
+            digests = ['md5']
+        if len(digests) == 1:
+            comparison.write_manifest(options.manifest,algorithm=digests[0])
+        else:
+            for digest in digests:
+                comparison.write_manifest("%s.%s" % (options.manifest,digest),
+                                          algorithm=digest)
+    status = comparison.report(output_file)
+    if options.max_failures is not None and not status:
+        sys.exit(1)
+    if options.watch:
+        # Re-examine files as they change
+        try:
+            while True:
+                files = watcher.poll()
+                for f,status in comparison.update_files(files):
+                    print "%s\t%s\t%s" % (time.strftime("%Y-%m-%d %H:%M:%S"),
+                                          status,f)
+                sys.stdout.flush()
+                if output_file is not None:
+                    comparison.report(output_file)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+#
+#     filters.py: include and exclude rules for files and directories
+#     Copyright (C) University of Manchester 2013 Peter Briggs
+#
+########################################################################
+#
+# filters.py
+#
+#########################################################################
+
+"""filters
+
+Provides the FileFilter class, which implements rules for including
+and excluding files and directories from a comparison:
+
+>>> f = FileFilter(exclude=['.snapshot/','*.tmp','re:^scratch/'])
+>>> f.exclude_dir('data/.snapshot')
+True
+>>> f.exclude_dir('scratch')
+True
+>>> f.exclude_file('data/file.tmp')
+True
+>>> f.filter_files(['data/file.txt','data/file.tmp','scratch/x'])
+['data/file.txt']
+
+Patterns are either shell-style glob patterns or (if prefixed with
+'re:') regular expressions:
+
+- Glob patterns without a '/' are matched against the name of the
+  file or directory; glob patterns containing a '/' are matched
+  against the whole path relative to the top-level directory.
+- Regular expressions are searched for in the relative path.
+- Patterns ending with a '/' only match directories. For regular
+  expressions the '/' is kept, and the directory path is matched
+  with a trailing '/' added (so 're:^scratch/' matches 'scratch'
+  but not 'scratch2').
+
+Excluded directories are skipped completely (along with everything
+underneath them). If any include patterns are given then only
+files which match at least one of them are kept (include patterns
+are not applied to directories).
+
+Rules can also be read from an 'ignore file', which has one pattern
+per line. Lines starting with '+ ' are include patterns, and lines
+starting with '- ' (or with no prefix) are exclude patterns; blank
+lines and lines starting with '#' are ignored.
+
+"""
+
+#######################################################################
+# Import modules that this module depends on
+#######################################################################
+
+import os
+import re
+import fnmatch
+
+#######################################################################
+# Classes
+#######################################################################
+
+class FileFilter:
+    """Class implementing include and exclude rules for files
+
+    """
+    def __init__(self,include=None,exclude=None,ignore_file=None):
+        """Create a new FileFilter object
+
+        Arguments:
+          include: (optional) list of patterns for files to include
+          exclude: (optional) list of patterns for files and
+            directories to exclude
+          ignore_file: (optional) file to read additional include
+            and exclude patterns from
+
+        """
+        self._include = []
+        self._exclude = []
+        if include:
+            for pattern in include:
+                self.add_include(pattern)
+        if exclude:
+            for pattern in exclude:
+                self.add_exclude(pattern)
+        if ignore_file is not None:
+            self.load(ignore_file)
+
+    def add_include(self,pattern):
+        """Add a pattern for files to include
+
+        """
+        self._include.append(Pattern(pattern))
+
+    def add_exclude(self,pattern):
+        """Add a pattern for files and directories to exclude
+
+        """
+        self._exclude.append(Pattern(pattern))
+
+    def load(self,ignore_file):
+        """Read include and exclude patterns from a file
+
+        """
+        fp = open(ignore_file,'r')
+        for line in fp:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            if line.startswith('+ '):
+                self.add_include(line[2:])
+            elif line.startswith('- '):
+                self.add_exclude(line[2:])
+            else:
+                self.add_exclude(line)
+        fp.close()
+
+    def exclude_dir(self,path):
+        """Check if a directory should be excluded
+
+        Arguments:
+          path: path of the directory relative to the top-level
+            directory being examined
+
+        """
+        path = normalise_path(path)
+        for pattern in self._exclude:
+            if pattern.match(path,isdir=True):
+                return True
+        return False
+
+    def exclude_file(self,path):
+        """Check if a file should be excluded
+
+        Only the file itself is checked (not the directories
+        that contain it).
+
+        Arguments:
+          path: path of the file relative to the top-level
+            directory being examined
+
+        """
+        path = normalise_path(path)
+        for pattern in self._exclude:
+            if pattern.match(path):
+                return True
+        if self._include:
+            for pattern in self._include:
+                if pattern.match(path):
+                    return False
+            return True
+        return False
+
+    def filter_files(self,files):
+        """Remove excluded files from a list
+
+        Files are removed if they are excluded themselves, or if
+        any of the directories containing them are excluded.
+
+        Arguments:
+          files: list of file paths relative to the top-level
+            directory
+
+        Returns:
+          List of the files which are not excluded.
+
+        """
+        excluded_dirs = {}
+        filtered = []
+        for f in files:
+            if self.exclude_file(f):
+                continue
+            # Check all the parent directories
+            excluded = False
+            dirn = os.path.dirname(f)
+            parents = []
+            while dirn:
+                parents.insert(0,dirn)
+                dirn = os.path.dirname(dirn)
+            for dirn in parents:
+                if dirn not in excluded_dirs:
+                    excluded_dirs[dirn] = self.exclude_dir(dirn)
+                if excluded_dirs[dirn]:
+                    excluded = True
+                    break
+            if not excluded:
+                filtered.append(f)
+        return filtered
+
+class Pattern:
+    """Class representing a single include or exclude pattern
+
+    See the module documentation for the pattern syntax.
+
+    """
+    def __init__(self,pattern):
+        """Create a new Pattern object
+
+        """
+        self.pattern = pattern
+        self.dir_only = pattern.endswith('/')
+        if pattern.startswith('re:'):
+            self._regex = re.compile(pattern[3:])
+            self._glob = None
+        else:
+            self._regex = None
+            self._glob = pattern.rstrip('/')
+            self._match_path = ('/' in self._glob)
+
+    def match(self,path,isdir=False):
+        """Check if a path matches the pattern
+
+        Arguments:
+          path: relative path (using '/' as the separator)
+          isdir: True if the path is a directory
+
+        """
+        if self.dir_only and not isdir:
+            return False
+        if self._regex is not None:
+            if self.dir_only:
+                path += '/'
+            return self._regex.search(path) is not None
+        if self._match_path:
+            return fnmatch.fnmatch(path,self._glob)
+        return fnmatch.fnmatch(path.split('/')[-1],self._glob)
+
+#######################################################################
+# Functions
+#######################################################################
+
+def normalise_path(path):
+    """Return path using '/' as the separator
+
+    """
+    if os.sep != '/':
+        path = path.replace(os.sep,'/')
+    return path
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import tempfile
+
+class TestFileFilter(unittest.TestCase):
+
+    def test_exclude_globs(self):
+        """Test excluding files and directories using glob patterns
+        """
+        f = FileFilter(exclude=['*.tmp','cache/','data/scratch*'])
+        self.assertTrue(f.exclude_file('file.tmp'))
+        self.assertTrue(f.exclude_file('sub/file.tmp'))
+        self.assertFalse(f.exclude_file('file.txt'))
+        self.assertTrue(f.exclude_dir('cache'))
+        self.assertTrue(f.exclude_dir('sub/cache'))
+        self.assertFalse(f.exclude_file('cache'))
+        self.assertTrue(f.exclude_dir('data/scratch1'))
+        self.assertFalse(f.exclude_dir('scratch1'))
+
+    def test_exclude_regex(self):
+        """Test excluding files and directories using regular expressions
+        """
+        f = FileFilter(exclude=['re:^tmp[0-9]+$','re:\.bak$'])
+        self.assertTrue(f.exclude_dir('tmp01'))
+        self.assertFalse(f.exclude_dir('sub/tmp01'))
+        self.assertTrue(f.exclude_file('sub/file.bak'))
+
+    def test_exclude_regex_dir(self):
+        """Test excluding directories using regular expressions ending in '/'
+        """
+        f = FileFilter(exclude=['re:^scratch/','re:(^|/)tmp[0-9]+/'])
+        self.assertTrue(f.exclude_dir('scratch'))
+        self.assertFalse(f.exclude_dir('scratch2'))
+        self.assertFalse(f.exclude_dir('data/scratch'))
+        self.assertFalse(f.exclude_file('scratch'))
+        self.assertTrue(f.exclude_dir('data/tmp01'))
+        self.assertEqual(f.filter_files(['data/file.txt',
+                                         'scratch/x',
+                                         'scratch2/x',
+                                         'data/tmp01/y']),
+                         ['data/file.txt','scratch2/x'])
+
+    def test_include(self):
+        """Test including files using patterns
+        """
+        f = FileFilter(include=['*.fastq','re:\.bam$'])
+        self.assertFalse(f.exclude_file('run/reads.fastq'))
+        self.assertFalse(f.exclude_file('run/reads.bam'))
+        self.assertTrue(f.exclude_file('run/reads.txt'))
+        self.assertFalse(f.exclude_dir('run'))
+
+    def test_filter_files(self):
+        """Test filtering a list of files
+        """
+        f = FileFilter(include=['*.txt'],exclude=['.snapshot/','old.txt'])
+        self.assertEqual(f.filter_files(['a.txt',
+                                         'b.dat',
+                                         'old.txt',
+                                         'sub/c.txt',
+                                         'sub/.snapshot/a.txt',
+                                         '.snapshot/d.txt']),
+                         ['a.txt','sub/c.txt'])
+
+    def test_load_ignore_file(self):
+        """Test loading patterns from an ignore file
+        """
+        fd,ignore_file = tempfile.mkstemp()
+        fp = os.fdopen(fd,'w')
+        fp.write("# Comment\n\n.snapshot/\n- *.tmp\n+ *.txt\n")
+        fp.close()
+        try:
+            f = FileFilter(ignore_file=ignore_file)
+        finally:
+            os.remove(ignore_file)
+        self.assertTrue(f.exclude_dir('.snapshot'))
+        self.assertTrue(f.exclude_file('file.tmp'))
+        self.assertTrue(f.exclude_file('file.dat'))
+        self.assertFalse(f.exclude_file('file.txt'))
+
+########################################################################
+# Main: test runner
+#########################################################################
+if __name__ == "__main__":
+    # Run tests
+    unittest.main()
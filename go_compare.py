@@ -30,11 +30,50 @@ import sys
 import os
 import logging
 import time
+import array
+import bisect
+import threading
+import collections
 import webbrowser
 import compare
 from PyQt4 import QtCore
 from PyQt4 import QtGui
 
+#######################################################################
+# Module constants
+#######################################################################
+
+# File statuses reported by the comparison, and how they're displayed
+STATUSES = ('OK','FAILED','UNREADABLE','ONLY_IN_FROM','ONLY_IN_TO',
+            'UNCHANGED')
+STATUS_LABELS = ('OK','FAILED','UNREADABLE','Only in source','Only in target',
+                 'OK (unchanged dir)')
+
+# Choices for filtering the results by status
+RESULTS_FILTERS = (("All files",None),
+                   ("Problems",('FAILED','UNREADABLE',
+                                'ONLY_IN_FROM','ONLY_IN_TO')),
+                   ("Failed",('FAILED',)),
+                   ("Unreadable",('UNREADABLE',)),
+                   ("Only in source",('ONLY_IN_FROM',)),
+                   ("Only in target",('ONLY_IN_TO',)))
+
+# Results are sent to the GUI in batches of up to this many files,
+# or at least this often (milliseconds)
+RESULTS_BATCH_SIZE = 1000
+RESULTS_INTERVAL = 250
+
+# Interval for updating the dashboard (milliseconds), and number
+# of updates shown in the throughput graph
+DASHBOARD_INTERVAL = 1000
+GRAPH_LENGTH = 120
+
+# Number of updates used to estimate the time remaining
+ETA_UPDATES = 30
+
+# Bytes in a megabyte
+MB = 1024*1024
+
 #######################################################################
 # Classes
 #######################################################################
@@ -73,6 +112,31 @@ class Window(QtGui.QWidget):
         self.progressBar = QtGui.QProgressBar(self)
         self.statusBar = QtGui.QLabel()
         self.statusMessage = ''
+        # Throughput and time remaining
+        self.dashboard = Dashboard(self)
+        self.dashboardTimer = QtCore.QTimer()
+        self.dashboardTimer.timeout.connect(self.updateDashboard)
+        # Results for each file
+        self.results = ResultsModel(self)
+        self.resultsView = QtGui.QTableView(self)
+        self.resultsView.setModel(self.results)
+        self.resultsView.verticalHeader().hide()
+        self.resultsView.horizontalHeader().setStretchLastSection(True)
+        self.resultsView.horizontalHeader().setSortIndicator(-1,QtCore.Qt.AscendingOrder)
+        self.resultsView.setSortingEnabled(True)
+        self.resultsView.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
+        self.resultsFilter = QtGui.QComboBox(self)
+        self.resultsFilter.setToolTip("Only show files with the selected status")
+        for name,statuses in RESULTS_FILTERS:
+            self.resultsFilter.addItem(name)
+        self.resultsFilter.currentIndexChanged.connect(self.filterResults)
+        self.resultsCount = QtGui.QLabel()
+        # Put the filter and file count into a box
+        resultsBar = QtGui.QHBoxLayout()
+        resultsBar.addWidget(QtGui.QLabel("Show"))
+        resultsBar.addWidget(self.resultsFilter)
+        resultsBar.addStretch(1)
+        resultsBar.addWidget(self.resultsCount)
         # Timing comparison operation
         self.timer = QtCore.QTimer()
         self.timer.timeout.connect(self.updateStatus)
@@ -100,8 +164,10 @@ class Window(QtGui.QWidget):
         layout.addWidget(self.useNaturalSort)
         layout.addWidget(self.progressBar)
         layout.addWidget(self.statusBar)
+        layout.addWidget(self.dashboard)
+        layout.addLayout(resultsBar)
+        layout.addWidget(self.resultsView,1)
         layout.addLayout(buttons)
-        layout.addStretch(1)
         self.setLayout(layout)
         self.setWindowTitle(self.tr("Go Compare v%s: Md5 sum checker" % __version__))
         self.setMinimumWidth(600)
@@ -112,6 +178,7 @@ class Window(QtGui.QWidget):
         self.thread.finished.connect(self.finishComparison)
         self.thread.progress_update.connect(self.updateProgress)
         self.thread.status_update.connect(self.updateStatus)
+        self.thread.results_update.connect(self.addResults)
 
     @QtCore.pyqtSlot()
     def resetUi(self):
@@ -159,8 +226,13 @@ class Window(QtGui.QWidget):
             sort_key = compare.SortKeys.natural
         else:
             sort_key = compare.SortKeys.default
+        # Clear the results from any previous comparison
+        self.results.clear(sort_key=sort_key)
+        self.updateResultsCount()
         # Do the comparison
+        self.dashboard.reset()
         self.thread.compare(from_dir,to_dir,output,sort_key=sort_key)
+        self.dashboardTimer.start(DASHBOARD_INTERVAL)
 
     @QtCore.pyqtSlot()
     def stopComparison(self):
@@ -172,6 +244,7 @@ class Window(QtGui.QWidget):
         if self.thread.isRunning():
             logging.debug("Terminating running application")
             self.thread.terminate() # Not supposed to do this
+        self.dashboardTimer.stop()
         # Update status
         self.updateStatus("Comparison stopped")
         self.updateUi()
@@ -183,6 +256,8 @@ class Window(QtGui.QWidget):
         """
         # Define finishComparison slot
         # This handles the result of the comparison once it's completed
+        self.dashboardTimer.stop()
+        self.updateDashboard()
         # Check that the output file exists
         output = os.path.abspath(self.selectOutput.selected)
         if not os.path.exists(output):
@@ -256,6 +331,43 @@ class Window(QtGui.QWidget):
             status_msg = "[Elapsed %s] %s" % (self.getElapsedTime(),status_msg)
         self.statusBar.setText(status_msg)
 
+    @QtCore.pyqtSlot()
+    def updateDashboard(self):
+        """Update the dashboard from the stats of the running comparison
+
+        """
+        self.dashboard.updateStats(self.thread.stats.snapshot())
+
+    @QtCore.pyqtSlot(object)
+    def addResults(self,results):
+        """Add results received from a running comparison
+
+        Arguments:
+          results: list of (file,status) tuples
+
+        """
+        self.results.addResults(results)
+        self.updateResultsCount()
+
+    @QtCore.pyqtSlot(int)
+    def filterResults(self,i):
+        """Only show results matching the selected filter
+
+        Arguments:
+          i: index of the filter in RESULTS_FILTERS
+
+        """
+        self.results.setStatusFilter(RESULTS_FILTERS[i][1])
+        self.updateResultsCount()
+
+    def updateResultsCount(self):
+        """Update the number of files shown in the results
+
+        """
+        self.resultsCount.setText("%d of %d files" %
+                                  (self.results.rowCount(),
+                                   self.results.totalCount()))
+
     def validateInputs(self,text=None):
         # Check that inputs are valid and update the UI accordingly
         if os.path.isdir(self.selectFrom.selected) and \
@@ -272,21 +384,7 @@ class Window(QtGui.QWidget):
         days, hours, minutes and seconds as appropriate.
 
         """
-        elapsed_time = time.time()-self.startTime
-        ret = []
-        days = int(elapsed_time/24.0/60.0/60.0)
-        if days > 0:
-            ret.append("%d days" % days)
-        hours = int(elapsed_time/60.0/60.0) - days*24
-        if hours > 0:
-            ret.append("%d hrs" % hours)
-        minutes = int(elapsed_time/60.0) - (hours+days*24)*60
-        if minutes > 0:
-            ret.append("%d mins" % minutes)
-        if days == 0 and hours == 0:
-            seconds = elapsed_time - (minutes+(hours+days*24)*60)*60
-            ret.append("%ds" % seconds)
-        return ' '.join(ret)
+        return format_duration(time.time()-self.startTime)
 
     def updateUi(self):
         """Update the state of the UI when a comparison isn't running
@@ -314,6 +412,9 @@ class CompareWorker(QtCore.QThread):
     >>> # Do the comparison
     >>> thread.compare('dir1','dir2','report.txt')
 
+    Progress of the running comparison can be monitored by polling
+    the 'stats' attribute (a compare.CompareStats object).
+
     This class defines the following custom signals:
 
     status_update(QString): emitted when the status of the
@@ -322,18 +423,31 @@ class CompareWorker(QtCore.QThread):
     progress_update(float): emitted when the percentage
       progress of the comparison is updated; the percentage
       progress is sent as a float between 0 and 100.0.
+    results_update(object): emitted with a list of (file,status)
+      tuples as results become available; results are sent in
+      batches rather than one signal per file (when a batch is
+      full, or otherwise from a timer so that results don't wait
+      for the next file to finish).
 
     """
 
     # Define custom signals
     status_update = QtCore.pyqtSignal('QString')
     progress_update = QtCore.pyqtSignal('float')
+    results_update = QtCore.pyqtSignal(object)
 
     def __init__(self,parent=None):
         """Create new CompareWorker instance
         """
         QtCore.QThread.__init__(self,parent)
         self.exiting = False
+        # Results are collected in the comparison thread and sent
+        # from a timer in the GUI thread
+        self._results = []
+        self._results_lock = threading.Lock()
+        self.resultsTimer = QtCore.QTimer()
+        self.resultsTimer.timeout.connect(self._flush_results)
+        self.finished.connect(self.resultsTimer.stop)
 
     def __del__(self):
         self.exiting = True
@@ -352,6 +466,9 @@ class CompareWorker(QtCore.QThread):
         self.to_dir = to_dir
         self.output = output
         self.sort_key = sort_key
+        self.stats = compare.CompareStats()
+        self._results = []
+        self.resultsTimer.start(RESULTS_INTERVAL)
         self.start()
 
     def progress_handler(self,msg):
@@ -376,6 +493,38 @@ class CompareWorker(QtCore.QThread):
         # Signal latest status message
         self.status_update.emit(QtCore.QString(msg))
 
+    def result_handler(self,filen,status):
+        """Callback function invoked with the result for each file
+
+        This is passed to the 'Compare' object that runs the comparison
+        as a callback that is invoked as each file's result becomes
+        available. Results are collected and emitted as a Qt signal in
+        batches (see _flush_results).
+
+        Arguments:
+          filen: name of the file
+          status: status of the file from the comparison
+
+        """
+        with self._results_lock:
+            self._results.append((filen,status))
+            full = (len(self._results) >= RESULTS_BATCH_SIZE)
+        if full:
+            self._flush_results()
+
+    def _flush_results(self):
+        """Internal: emit any results which haven't been sent yet
+
+        Called from the comparison thread when a batch is full,
+        and from the results timer in the GUI thread.
+
+        """
+        with self._results_lock:
+            results = self._results
+            self._results = []
+        if results:
+            self.results_update.emit(results)
+
     def run(self):
         """Implement the 'run' method of the base class
 
@@ -383,14 +532,410 @@ class CompareWorker(QtCore.QThread):
         thread environment has been set up.
 
         """
-        compare.Compare(self.from_dir,self.to_dir,
-                        report_progress=True,
-                        report_every=1,
-                        progress_callback=self.progress_handler,
-                        sort_key=self.sort_key).report(self.output)
+        comparison = compare.Compare(self.from_dir,self.to_dir,
+                                     report_progress=True,
+                                     progress_callback=self.progress_handler,
+                                     result_callback=self.result_handler,
+                                     stats=self.stats,
+                                     sort_key=self.sort_key)
+        self._flush_results()
+        comparison.report(self.output)
         # Finished, signal that we've reach 100% complete
         self.progress_update.emit(float(100))
 
+class Dashboard(QtGui.QWidget):
+    """Widget showing the throughput of a running comparison
+
+    For each side of the comparison shows the read rate (i.e. the
+    MB/s while files are being read from that side, so a slow
+    mount stands out even though both sides are read in turn), the
+    number of files checked per second and the amount of data left
+    to read; also shows an estimate of the time remaining, and a
+    graph of the recent read rates.
+
+    The dashboard is updated by passing snapshots from a
+    compare.CompareStats object to the updateStats method at
+    regular intervals (e.g. from a timer), rather than for every
+    file.
+
+    """
+    def __init__(self,parent=None):
+        """Create a new Dashboard instance
+
+        """
+        QtGui.QWidget.__init__(self,parent)
+        # Grid with the figures for each side
+        grid = QtGui.QGridLayout()
+        for col,title in enumerate(("","MB/s","Files/s","Remaining")):
+            grid.addWidget(QtGui.QLabel("<b>%s</b>" % title),0,col)
+        self.labels = []
+        for side,name in enumerate(("Source","Target")):
+            grid.addWidget(QtGui.QLabel("<font color='%s'>%s</font>" %
+                                        (ThroughputGraph.COLOURS[side],name)),
+                           side+1,0)
+            labels = [QtGui.QLabel() for i in range(3)]
+            for col,label in enumerate(labels):
+                grid.addWidget(label,side+1,col+1)
+            self.labels.append(labels)
+        self.eta = QtGui.QLabel()
+        grid.addWidget(self.eta,3,0,1,4)
+        # Graph of read rates
+        self.graph = ThroughputGraph(self)
+        # Put them together
+        hbox = QtGui.QHBoxLayout()
+        hbox.addLayout(grid)
+        hbox.addWidget(self.graph,1)
+        self.setLayout(hbox)
+        self.reset()
+
+    def reset(self):
+        """Clear the figures from any previous comparison
+
+        """
+        self._last = None
+        self._history = collections.deque(maxlen=ETA_UPDATES)
+        for labels in self.labels:
+            for label in labels:
+                label.setText("-")
+        self.eta.setText("Time remaining: -")
+        self.graph.clear()
+
+    def updateStats(self,stats):
+        """Update the figures from a new snapshot of the counters
+
+        Arguments:
+          stats: dictionary returned by compare.CompareStats.snapshot
+
+        """
+        last = self._last
+        self._last = stats
+        bytes_done = sum(stats['bytes_done'])
+        bytes_remaining = sum(stats['bytes_total']) - bytes_done
+        self._history.append((stats['time'],bytes_done))
+        rates = []
+        for side,labels in enumerate(self.labels):
+            remaining = stats['bytes_total'][side] - stats['bytes_done'][side]
+            labels[2].setText("%.1f MB" % (float(remaining)/MB))
+            if last is None:
+                continue
+            dt = stats['time'] - last['time']
+            busy = stats['busy_time'][side] - last['busy_time'][side]
+            nbytes = stats['bytes_done'][side] - last['bytes_done'][side]
+            nfiles = stats['files_done'][side] - last['files_done'][side]
+            rate = float(nbytes)/MB/busy if busy > 0 else 0.0
+            rates.append(rate)
+            labels[0].setText("%.1f" % rate)
+            if dt > 0:
+                labels[1].setText("%.1f" % (nfiles/dt))
+        if rates:
+            self.graph.addRates(rates)
+        # Estimate time remaining from the recent overall throughput
+        t0,bytes0 = self._history[0]
+        if bytes_remaining == 0 and stats['files_total'][0]:
+            self.eta.setText("Time remaining: none")
+        elif bytes_done > bytes0:
+            eta = bytes_remaining*(stats['time']-t0)/(bytes_done-bytes0)
+            self.eta.setText("Time remaining: %s" % format_duration(eta))
+
+class ThroughputGraph(QtGui.QWidget):
+    """Widget drawing a graph of recent read rates
+
+    Draws a line for each side of the comparison, scaled to the
+    highest rate in the history, with the most recent rates on
+    the right.
+
+    """
+    COLOURS = ('blue','red')
+
+    def __init__(self,parent=None):
+        """Create a new ThroughputGraph instance
+
+        """
+        QtGui.QWidget.__init__(self,parent)
+        self.setMinimumSize(240,80)
+        self.clear()
+
+    def clear(self):
+        """Remove all the rates from the graph
+
+        """
+        self._history = collections.deque(maxlen=GRAPH_LENGTH)
+        self.update()
+
+    def addRates(self,rates):
+        """Add the latest rates (in MB/s) for each side and redraw
+
+        """
+        self._history.append(tuple(rates))
+        self.update()
+
+    def paintEvent(self,event):
+        """Draw the graph
+
+        """
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(),QtCore.Qt.white)
+        painter.setPen(QtCore.Qt.gray)
+        painter.drawRect(self.rect().adjusted(0,0,-1,-1))
+        if self._history:
+            width = self.width() - 2
+            height = self.height() - 2
+            peak = max([max(rates) for rates in self._history]) or 1.0
+            step = float(width)/(GRAPH_LENGTH - 1)
+            offset = width - (len(self._history) - 1)*step
+            for side,colour in enumerate(self.COLOURS):
+                painter.setPen(QtGui.QColor(colour))
+                points = [QtCore.QPointF(1 + offset + i*step,
+                                         1 + height*(1.0 - rates[side]/peak))
+                          for i,rates in enumerate(self._history)]
+                painter.drawPolyline(QtGui.QPolygonF(points))
+            painter.setPen(QtCore.Qt.black)
+            painter.drawText(4,14,"%.1f MB/s" % peak)
+        painter.end()
+
+class ResultsModel(QtCore.QAbstractTableModel):
+    """Table model holding the result for each file in a comparison
+
+    The results are stored compactly (a list of file names, plus
+    an array with the status of each file as a single byte), and
+    the rows being displayed are held in a separate array of
+    indexes into these, so that filtering and sorting only
+    rearrange the index. The view only requests data for the rows
+    which are visible, so the model copes with millions of files.
+
+    New results are appended while a comparison is running; if
+    the rows are sorted then each new batch of results is sorted
+    and merged into the existing rows in a single pass.
+
+    Whenever the rows are rearranged the persistent indexes (used
+    by the view for the selection and current item) are moved to
+    the new rows for the same files, so the selection stays on the
+    same files as results arrive or the rows are sorted.
+
+    """
+    COLUMNS = ("Status","File")
+
+    def __init__(self,parent=None):
+        """Create a new ResultsModel instance
+
+        """
+        QtCore.QAbstractTableModel.__init__(self,parent)
+        self._statuses = None
+        self._sort_column = -1
+        self._sort_order = QtCore.Qt.AscendingOrder
+        self._init_results()
+
+    def _init_results(self,sort_key=None):
+        """Internal: set up empty results
+
+        """
+        self._files = []
+        self._status = array.array('B')
+        self._rows = array.array('L')
+        self._sort_key = sort_key
+        self._key = self._row_key(self._sort_column)
+
+    def clear(self,sort_key=None):
+        """Remove all the results
+
+        Arguments:
+          sort_key: (optional) function to use as a key for
+            sorting file names
+
+        """
+        self.beginResetModel()
+        self._init_results(sort_key)
+        self.endResetModel()
+
+    def totalCount(self):
+        """Return the total number of results (ignoring the filter)
+
+        """
+        return len(self._files)
+
+    def addResults(self,results):
+        """Add results for more files
+
+        Arguments:
+          results: list of (file,status) tuples
+
+        """
+        new_rows = []
+        for filen,status in results:
+            self._files.append(filen)
+            self._status.append(STATUSES.index(status))
+            i = len(self._files) - 1
+            if self._accept(i):
+                new_rows.append(i)
+        if not new_rows:
+            return
+        if self._key is None:
+            # Unsorted: add to the end
+            first = len(self._rows)
+            self.beginInsertRows(QtCore.QModelIndex(),
+                                 first,first+len(new_rows)-1)
+            self._rows.extend(new_rows)
+            self.endInsertRows()
+        else:
+            self.layoutAboutToBeChanged.emit()
+            persistent = self.persistentIndexList()
+            positions = self._merge_rows(new_rows)
+            # Each existing row moves down by the number of new
+            # rows inserted before it
+            self.changePersistentIndexList(
+                persistent,
+                [self.index(index.row() +
+                            bisect.bisect_right(positions,index.row()),
+                            index.column())
+                 for index in persistent])
+            self.layoutChanged.emit()
+
+    def setStatusFilter(self,statuses=None):
+        """Only show files with the specified statuses
+
+        Arguments:
+          statuses: list of statuses to show, or None to
+            show all files
+
+        """
+        if statuses is not None:
+            self._statuses = set([STATUSES.index(s) for s in statuses])
+        else:
+            self._statuses = None
+        self.beginResetModel()
+        rows = [i for i in xrange(len(self._files)) if self._accept(i)]
+        if self._key is not None:
+            rows.sort(key=self._key,
+                      reverse=(self._sort_order == QtCore.Qt.DescendingOrder))
+        self._rows = array.array('L',rows)
+        self.endResetModel()
+
+    def rowCount(self,parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def columnCount(self,parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.COLUMNS)
+
+    def data(self,index,role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return QtCore.QVariant()
+        i = self._rows[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            if index.column() == 0:
+                return QtCore.QVariant(STATUS_LABELS[self._status[i]])
+            return QtCore.QVariant(self._files[i])
+        if role == QtCore.Qt.ForegroundRole and \
+           STATUSES[self._status[i]] in ('FAILED','UNREADABLE'):
+            return QtCore.QVariant(QtGui.QBrush(QtCore.Qt.red))
+        return QtCore.QVariant()
+
+    def headerData(self,section,orientation,role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and \
+           orientation == QtCore.Qt.Horizontal:
+            return QtCore.QVariant(self.COLUMNS[section])
+        return QtCore.QVariant()
+
+    def sort(self,column,order=QtCore.Qt.AscendingOrder):
+        """Sort the rows on a column
+
+        A column of -1 restores the order in which the results
+        were received.
+
+        """
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        files = [self._rows[index.row()] for index in persistent]
+        self._sort_column = column
+        self._sort_order = order
+        self._key = self._row_key(column)
+        rows = list(self._rows)
+        if self._key is not None:
+            rows.sort(key=self._key,
+                      reverse=(order == QtCore.Qt.DescendingOrder))
+        else:
+            rows.sort()
+        self._rows = array.array('L',rows)
+        # Find the new rows for the files with persistent indexes
+        if persistent:
+            new_rows = dict.fromkeys(files)
+            for row,i in enumerate(rows):
+                if i in new_rows:
+                    new_rows[i] = row
+            self.changePersistentIndexList(
+                persistent,
+                [self.index(new_rows[i],index.column())
+                 for i,index in zip(files,persistent)])
+        self.layoutChanged.emit()
+
+    def _accept(self,i):
+        """Internal: check if the file with index i passes the filter
+
+        """
+        return self._statuses is None or self._status[i] in self._statuses
+
+    def _row_key(self,column):
+        """Internal: return the key function for sorting on a column
+
+        """
+        files = self._files
+        sort_key = self._sort_key
+        if sort_key is None:
+            sort_key = lambda f: f
+        if column == 0:
+            status = self._status
+            return lambda i: (status[i],sort_key(files[i]))
+        elif column == 1:
+            return lambda i: sort_key(files[i])
+        return None
+
+    def _merge_rows(self,new_rows):
+        """Internal: merge new rows into the sorted rows
+
+        The new rows are sorted and their positions found using
+        binary searches, and then the existing rows are copied
+        across in slices, so the cost is a single pass over the
+        existing rows rather than one for each new row.
+
+        Returns the positions in the existing rows where each of
+        the new rows was inserted (in ascending order).
+
+        """
+        new_rows.sort(key=self._key,
+                      reverse=(self._sort_order == QtCore.Qt.DescendingOrder))
+        positions = [self._find_row(i) for i in new_rows]
+        rows = self._rows
+        merged = array.array('L')
+        start = 0
+        for pos,i in zip(positions,new_rows):
+            merged.extend(rows[start:pos])
+            merged.append(i)
+            start = pos
+        merged.extend(rows[start:])
+        self._rows = merged
+        return positions
+
+    def _find_row(self,i):
+        """Internal: return the sorted position for the file with index i
+
+        """
+        key = self._key
+        k = key(i)
+        rows = self._rows
+        descending = (self._sort_order == QtCore.Qt.DescendingOrder)
+        lo,hi = 0,len(rows)
+        while lo < hi:
+            mid = (lo + hi)//2
+            kmid = key(rows[mid])
+            if (k > kmid) if descending else (k < kmid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
 class SelectionLine(QtGui.QWidget):
     """Base class for creating file/directory selection widgets
 
@@ -530,7 +1075,28 @@ class DirSelectionLine(SelectionLine):
 # Functions
 #######################################################################
 
-# None defined
+def format_duration(seconds):
+    """Return a time interval as a string
+
+    Gives the time as days, hours, minutes and seconds as
+    appropriate (seconds are only included for intervals of less
+    than an hour).
+
+    """
+    ret = []
+    days = int(seconds/24.0/60.0/60.0)
+    if days > 0:
+        ret.append("%d days" % days)
+    hours = int(seconds/60.0/60.0) - days*24
+    if hours > 0:
+        ret.append("%d hrs" % hours)
+    minutes = int(seconds/60.0) - (hours+days*24)*60
+    if minutes > 0:
+        ret.append("%d mins" % minutes)
+    if days == 0 and hours == 0:
+        seconds = seconds - (minutes+(hours+days*24)*60)*60
+        ret.append("%ds" % seconds)
+    return ' '.join(ret)
 
 #######################################################################
 # Main program
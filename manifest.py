@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+#
+#     manifest.py: compare checksum manifests
+#     Copyright (C) University of Manchester 2013 Peter Briggs
+#
+########################################################################
+#
+# manifest.py
+#
+#########################################################################
+
+"""manifest
+
+Provides the ManifestCompare class, which compares two checksum
+manifests (in the format output by 'md5sum', 'sha1sum' etc) without
+reading any of the files they describe, and reports the differences
+in the same way as compare.Compare:
+
+>>> ManifestCompare('data.2013-01.md5','data.2013-02.md5').report()
+
+The manifests are merge-joined, so each only needs to be read
+sequentially. Manifests which aren't already sorted are sorted
+externally: they're read in chunks of a fixed number of lines, which
+are sorted in memory and written to temporary files and then merged.
+The results of the comparison are also written to temporary files
+until the report is written, so the memory used doesn't depend on the
+size of the manifests.
+
+"""
+
+#######################################################################
+# Import modules that this module depends on
+#######################################################################
+
+import sys
+import re
+import time
+import heapq
+import tempfile
+
+#######################################################################
+# Module constants
+#######################################################################
+
+# Maximum number of manifest lines to sort in memory at once
+SORT_CHUNK_SIZE = 500000
+
+# Names of checksum algorithms, from the length of the checksum
+DIGEST_NAMES = { 8: 'crc32', 32: 'md5', 40: 'sha1', 64: 'sha256' }
+
+# Regular expression matching a manifest line
+MANIFEST_LINE = re.compile(r'^(\\?)([0-9a-fA-F]+) [ *](.*)$')
+
+#######################################################################
+# Classes
+#######################################################################
+
+class ManifestCompare:
+    """Class to compare the contents of two checksum manifests
+
+    Files which are only in one of the manifests are reported, along
+    with files in both whose checksums differ. Files are matched by
+    the paths given in the manifests.
+
+    """
+
+    def __init__(self,old_manifest,new_manifest,
+                 report_progress=False,progress_callback=None,
+                 sort_key=None,chunk_size=SORT_CHUNK_SIZE):
+        """Create a new ManifestCompare object
+
+        Arguments:
+          old_manifest: path to the "source" manifest
+          new_manifest: path to the "target" manifest
+          report_progress: if True then invoke progress_callback
+            with progress messages, or write to stdout (if callback
+            is not defined)
+          progress_callback: (optional) callback function that will
+            be invoked to report progress
+          sort_key: (optional) function to use as a key for sorting
+            file names. Default is to use the native sort order
+          chunk_size: maximum number of lines of a manifest to hold
+            in memory when sorting it
+
+        """
+        self._old = old_manifest
+        self._new = new_manifest
+        self._report_progress_flag = report_progress
+        self._progress_callback = progress_callback
+        self._sort_key = sort_key
+        self._chunk_size = chunk_size
+        self._start_time = time.time()
+        self.go_compare()
+        self._end_time = time.time()
+
+    def go_compare(self):
+        """Do the comparison
+
+        Writes the files only in each manifest, and the files in
+        both along with their status, to temporary files and counts
+        them.
+
+        """
+        self._only_in_old = tempfile.TemporaryFile()
+        self._only_in_new = tempfile.TemporaryFile()
+        self._common = tempfile.TemporaryFile()
+        self._n_only_in_old = 0
+        self._n_only_in_new = 0
+        self._n_common = 0
+        self._n_failed = 0
+        self._digest = None
+        old_entries = self._sorted_entries(self._old)
+        new_entries = self._sorted_entries(self._new)
+        self._report_progress("Comparing %s and %s" % (self._old,self._new))
+        for f,old_chksum,new_chksum in join_entries(old_entries,new_entries):
+            if new_chksum is None:
+                self._n_only_in_old += 1
+                self._only_in_old.write("\t%s\n" % f)
+            elif old_chksum is None:
+                self._n_only_in_new += 1
+                self._only_in_new.write("\t%s\n" % f)
+            else:
+                self._n_common += 1
+                if self._digest is None:
+                    self._digest = digest_name(old_chksum)
+                if old_chksum.lower() == new_chksum.lower():
+                    self._common.write("\tOK\t%s\n" % f)
+                else:
+                    self._n_failed += 1
+                    self._common.write("\tFAILED\t%s\n" % f)
+                    self._common.write("\t\t\t%ss: from %s\tTo %s\n" %
+                                       (self._digest.upper(),
+                                        old_chksum,new_chksum))
+
+    def report(self,output_file=None,fp=sys.stdout):
+        """Write a report of the comparison
+
+        Report will be written to the specified file name (if provided),
+        or else to the specified file handle (must have been opened for
+        writing).
+
+        If neither is supplied then the report is written to stdout.
+
+        Returns True if the manifests match, False if not.
+
+        """
+        # Deal with output file
+        if output_file is not None:
+            self._report_progress("Writing report to %s" % output_file)
+            fp = open(output_file,'w')
+            status = self.report(fp=fp)
+            fp.close()
+            return status
+        n_passed = self._n_common - self._n_failed
+        # Preamble
+        title_line = "Comparing contents of %s and %s" % (self._old,
+                                                          self._new)
+        fp.write("%s\n%s\n" % (title_line,"="*len(title_line)))
+        fp.write("\nStart time: %s\nEnd time  : %s\n" % (time.ctime(self._start_time),
+                                                         time.ctime(self._end_time)))
+        # Summary
+        fp.write("\nSummary\n%s\n" % ("-"*len("Summary")))
+        fp.write("\t%d files only found in %s\n" % (self._n_only_in_old,
+                                                    self._old))
+        fp.write("\t%d files only found in %s\n" % (self._n_only_in_new,
+                                                    self._new))
+        fp.write("\t%d files in both\n" % self._n_common)
+        fp.write("\t\t%d files OK\n" % n_passed)
+        fp.write("\t\t%d files FAILED\n" % self._n_failed)
+        # Files only in one or the other manifest
+        fp.write("\nFiles only in %s (%d)\n" % (self._old,self._n_only_in_old))
+        copy_file(self._only_in_old,fp)
+        fp.write("\nFiles only in %s (%d)\n" % (self._new,self._n_only_in_new))
+        copy_file(self._only_in_new,fp)
+        # Files in both manifests
+        fp.write("\nCommon files (%d)\n" % self._n_common)
+        copy_file(self._common,fp)
+        # Send a progress update indicating final result
+        summary = ["Finished: %d/%d OK" % (n_passed,self._n_common)]
+        if self._n_failed > 0:
+            summary.append(", %d failed" % self._n_failed)
+        n_extra = self._n_only_in_old + self._n_only_in_new
+        if n_extra > 0:
+            summary.append(", %d 'extra' files" % n_extra)
+        self._report_progress(' '.join(summary))
+        return not (self._n_failed or n_extra)
+
+    def _report_progress(self,message):
+        if self._report_progress_flag:
+            if self._progress_callback is not None:
+                self._progress_callback(message)
+            else:
+                print str(message)
+
+    def _sorted_entries(self,manifest):
+        """Internal: return an iterator with the sorted entries of a manifest
+
+        """
+        key = entry_key(self._sort_key)
+        if is_sorted(manifest,key):
+            return decorate(read_manifest(manifest),key)
+        self._report_progress("Sorting %s" % manifest)
+        return sort_entries(read_manifest(manifest),key,self._chunk_size)
+
+#######################################################################
+# Functions
+#######################################################################
+
+def read_manifest(manifest):
+    """Generator yielding (path,checksum) tuples from a manifest
+
+    Reads files in the format written by 'md5sum' and similar
+    programs (including the '*' marker for binary mode, and the
+    escaping of names containing newlines or backslashes).
+
+    Raises ValueError for lines which aren't in this format.
+
+    """
+    fp = open(manifest,'r')
+    try:
+        for i,line in enumerate(fp):
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            match = MANIFEST_LINE.match(line)
+            if match is None:
+                raise ValueError("%s: line %d: not a checksum line" %
+                                 (manifest,i+1))
+            escaped,chksum,path = match.groups()
+            if escaped:
+                path = unescape(path)
+            yield (path,chksum)
+    finally:
+        fp.close()
+
+def format_entry(path,chksum):
+    """Return a manifest line for a file
+
+    """
+    if '\\' in path or '\n' in path:
+        return "\\%s  %s\n" % (chksum,
+                               path.replace('\\','\\\\').replace('\n','\\n'))
+    return "%s  %s\n" % (chksum,path)
+
+def unescape(path):
+    """Reverse the escaping of backslashes and newlines in a path
+
+    """
+    return re.sub(r'\\(.)',lambda m: '\n' if m.group(1) == 'n' else m.group(1),
+                  path)
+
+def entry_key(sort_key=None):
+    """Return a function giving the sort key for a path
+
+    If a sort key function is supplied then the key also includes
+    the path, so that paths which the sort key treats as the same
+    are still in a definite order (which is needed to join the
+    manifests).
+
+    """
+    if sort_key is None:
+        return lambda path: path
+    return lambda path: (sort_key(path),path)
+
+def is_sorted(manifest,key):
+    """Check if the entries in a manifest are sorted
+
+    """
+    last = None
+    for path,chksum in read_manifest(manifest):
+        k = key(path)
+        if last is not None and k < last:
+            return False
+        last = k
+    return True
+
+def decorate(entries,key):
+    """Generator yielding (key,path,checksum) for (path,checksum) tuples
+
+    """
+    for path,chksum in entries:
+        yield (key(path),path,chksum)
+
+def sort_entries(entries,key,chunk_size=SORT_CHUNK_SIZE):
+    """Sort manifest entries using bounded memory
+
+    The entries are read in chunks of up to 'chunk_size', each
+    of which is sorted and written to a temporary file; the sorted
+    chunks are then merged.
+
+    Arguments:
+      entries: iterator yielding (path,checksum) tuples
+      key: function returning the sort key for a path
+      chunk_size: maximum number of entries to hold in memory
+
+    Returns:
+      Iterator yielding (key,path,checksum) tuples in sorted
+      order.
+
+    """
+    chunks = []
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            chunk.sort(key=lambda e: key(e[0]))
+            fp = tempfile.TemporaryFile()
+            for path,chksum in chunk:
+                fp.write(format_entry(path,chksum))
+            chunks.append(fp)
+            chunk = []
+    chunk.sort(key=lambda e: key(e[0]))
+    if not chunks:
+        return decorate(chunk,key)
+    return heapq.merge(decorate(chunk,key),
+                       *[decorate(read_chunk(fp),key) for fp in chunks])
+
+def read_chunk(fp):
+    """Generator yielding (path,checksum) tuples from a temporary file
+
+    """
+    fp.seek(0)
+    for line in fp:
+        escaped,chksum,path = MANIFEST_LINE.match(line.rstrip('\n')).groups()
+        if escaped:
+            path = unescape(path)
+        yield (path,chksum)
+    fp.close()
+
+def join_entries(old_entries,new_entries):
+    """Merge-join two sorted sequences of manifest entries
+
+    Arguments:
+      old_entries: iterator yielding sorted (key,path,checksum)
+        tuples for the "source" manifest
+      new_entries: iterator yielding sorted (key,path,checksum)
+        tuples for the "target" manifest
+
+    Returns:
+      Iterator yielding (path,old_checksum,new_checksum) tuples,
+      where the checksum is None if the path is missing from that
+      manifest.
+
+    """
+    old = next(old_entries,None)
+    new = next(new_entries,None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield (old[1],old[2],None)
+            old = next(old_entries,None)
+        elif old is None or new[0] < old[0]:
+            yield (new[1],None,new[2])
+            new = next(new_entries,None)
+        else:
+            yield (old[1],old[2],new[2])
+            old = next(old_entries,None)
+            new = next(new_entries,None)
+
+def digest_name(chksum):
+    """Return the name of the checksum algorithm from a checksum
+
+    Guesses the algorithm from the length of the checksum; returns
+    'checksum' if it's not recognised.
+
+    """
+    return DIGEST_NAMES.get(len(chksum),'checksum')
+
+def copy_file(fp,fout):
+    """Copy the contents of a temporary file to another file
+
+    """
+    fp.seek(0)
+    while True:
+        data = fp.read(1024*1024)
+        if not data:
+            break
+        fout.write(data)
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import os
+import shutil
+import StringIO
+
+class TestManifestCompare(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.old = os.path.join(self.wd,'old.md5')
+        self.new = os.path.join(self.wd,'new.md5')
+        self._write(self.old,
+                    "69faab6268350295550de7d587bc323d  sub/goodbye.txt\n"
+                    "5a8dd3ad0756a93ded72b823b19dd877 *hello.txt\n"
+                    "d41d8cd98f00b204e9800998ecf8427e  old.txt\n"
+                    "\\d41d8cd98f00b204e9800998ecf8427e  back\\\\slash\n")
+        self._write(self.new,
+                    "5A8DD3AD0756A93DED72B823B19DD877  hello.txt\n"
+                    "d41d8cd98f00b204e9800998ecf8427e  new.txt\n"
+                    "d41d8cd98f00b204e9800998ecf8427e  sub/goodbye.txt\n"
+                    "\\d41d8cd98f00b204e9800998ecf8427e  back\\\\slash\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def _write(self,filen,text):
+        fp = open(filen,'w')
+        fp.write(text)
+        fp.close()
+
+    def test_read_manifest(self):
+        """Test reading entries from a manifest
+        """
+        self.assertEqual(list(read_manifest(self.old))[1:],
+                         [('hello.txt','5a8dd3ad0756a93ded72b823b19dd877'),
+                          ('old.txt','d41d8cd98f00b204e9800998ecf8427e'),
+                          ('back\\slash','d41d8cd98f00b204e9800998ecf8427e')])
+        self._write(self.old,"not a checksum\n")
+        self.assertRaises(ValueError,list,read_manifest(self.old))
+
+    def test_format_entry(self):
+        """Test escaping of names when writing manifest lines
+        """
+        self.assertEqual(format_entry('a\\b\nc','abc'),"\\abc  a\\\\b\\nc\n")
+        self.assertEqual(unescape('a\\\\b\\nc'),'a\\b\nc')
+
+    def test_sort_entries(self):
+        """Test sorting entries using several chunks
+        """
+        entries = [("file%d" % i,'%08x' % i) for i in (5,3,9,1,7,2,8,0,6,4)]
+        key = entry_key()
+        self.assertEqual([e[1] for e in sort_entries(iter(entries),key,3)],
+                         ["file%d" % i for i in range(10)])
+        self.assertFalse(is_sorted(self.new,key))
+
+    def test_manifest_compare(self):
+        """Test comparing two manifests
+        """
+        fp = StringIO.StringIO()
+        result = ManifestCompare(self.old,self.new,chunk_size=2).report(fp=fp)
+        self.assertFalse(result)
+        report = fp.getvalue()
+        self.assertTrue("\t1 files only found in %s\n" % self.old in report)
+        self.assertTrue("\t3 files in both\n\t\t2 files OK\n"
+                        "\t\t1 files FAILED\n" in report)
+        self.assertTrue("Files only in %s (1)\n\tnew.txt\n" % self.new
+                        in report)
+        self.assertTrue("Common files (3)\n\tOK\tback\\slash\n\tOK\thello.txt\n"
+                        "\tFAILED\tsub/goodbye.txt\n\t\t\tMD5s: from "
+                        "69faab6268350295550de7d587bc323d\t"
+                        "To d41d8cd98f00b204e9800998ecf8427e\n" in report)
+
+    def test_identical_manifests(self):
+        """Test comparing a manifest against itself
+        """
+        fp = StringIO.StringIO()
+        self.assertTrue(ManifestCompare(self.old,self.old).report(fp=fp))
+
+########################################################################
+# Main: test runner
+#########################################################################
+if __name__ == "__main__":
+    # Run tests
+    unittest.main()
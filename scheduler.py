@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+#
+#     scheduler.py: schedule file reads according to the storage device
+#     Copyright (C) University of Manchester 2013 Peter Briggs
+#
+########################################################################
+#
+# scheduler.py
+#
+#########################################################################
+
+"""scheduler
+
+Provides the IOScheduler class, which runs a function on a set of
+files using worker threads, grouping the files by the device that
+they are stored on:
+
+>>> s = IOScheduler()
+>>> s.run([('file1.txt','/data/file1.txt'),...],do_checksum)
+
+Each device gets its own pool of worker threads, with the number of
+threads depending on the type of device ('hdd', 'ssd' or 'network';
+see DEVICE_CONCURRENCY). Within a device the files are processed in
+the order that they are physically stored (using the FIEMAP ioctl on
+Linux, where available) or otherwise in inode order, to minimise
+seeking on spinning disks.
+
+Optionally the scheduler can also deal separately with small and
+large files (see the 'small_file_threshold' argument): large files
+are processed first, largest first, so that a huge file isn't left
+until the end of a run; small files are then processed in batches,
+with each batch being handled by a worker as a single task.
+
+"""
+
+#######################################################################
+# Import modules that this module depends on
+#######################################################################
+
+import os
+import sys
+import struct
+import threading
+import Queue
+import throttle
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+#######################################################################
+# Module constants
+#######################################################################
+
+# Default number of concurrent reads for each type of device
+DEVICE_CONCURRENCY = { 'hdd': 1,
+                       'ssd': 8,
+                       'network': 4,
+                       'unknown': 2 }
+
+# Filesystem types which are treated as network storage
+NETWORK_FILESYSTEMS = ('nfs','nfs4','cifs','smbfs','smb3','afs','ceph',
+                       'glusterfs','lustre','gpfs','fuse.sshfs','9p')
+
+# Maximum number of small files in each batch
+SMALL_FILE_BATCH_SIZE = 256
+
+# Orderings for files within a device
+ORDERINGS = ('extent','inode','none')
+
+# ioctl request and structure formats for FIEMAP on Linux
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FORMAT = '=QQLLLL'
+FIEMAP_EXTENT_FORMAT = '=QQQQQLLLL'
+
+#######################################################################
+# Classes
+#######################################################################
+
+class IOScheduler:
+    """Class for running work on files with per-device concurrency
+
+    """
+    def __init__(self,concurrency=None,order='extent',device_types=None,
+                 small_file_threshold=None,
+                 batch_size=SMALL_FILE_BATCH_SIZE):
+        """Create a new IOScheduler object
+
+        Arguments:
+          concurrency: (optional) dictionary mapping device types
+            to the number of concurrent worker threads, overriding
+            the defaults in DEVICE_CONCURRENCY
+          order: how to order files within a device: 'extent'
+            (physical location of the data on disk, falling back to
+            inode number where this isn't available), 'inode' or
+            'none' (keep the original order)
+          device_types: (optional) dictionary mapping paths to
+            device types, overriding the automatic detection for
+            any files under those paths
+          small_file_threshold: (optional) if set then files of
+            this size (in bytes) or bigger are processed first, in
+            order of decreasing size, and smaller files are then
+            processed in batches
+          batch_size: maximum number of small files to put into
+            each batch
+
+        """
+        if order not in ORDERINGS:
+            raise ValueError("Unrecognised ordering '%s'" % order)
+        self.concurrency = dict(DEVICE_CONCURRENCY)
+        if concurrency:
+            self.concurrency.update(concurrency)
+        self.order = order
+        self.small_file_threshold = small_file_threshold
+        self.batch_size = max(1,batch_size)
+        self.device_types = {}
+        if device_types:
+            for path in device_types:
+                self.device_types[os.path.abspath(path)] = device_types[path]
+
+    def schedule(self,jobs):
+        """Group jobs by device and order them within each device
+
+        Arguments:
+          jobs: list of (item,path) tuples, where 'path' is the
+            file that will be read when processing 'item'
+
+        Returns:
+          A list of (device_type,tasks) tuples, one for each device,
+          where 'tasks' are in the order that they should be
+          processed. Each task is a list of one or more items
+          (items are only grouped together into a single task if
+          they are small files).
+
+        """
+        devices = {}
+        for item,path in jobs:
+            try:
+                st = os.stat(path)
+                dev,ino,size = st.st_dev,st.st_ino,st.st_size
+            except OSError:
+                # Can't stat so put into a separate group (the
+                # error will be handled by the worker)
+                dev,ino,size = None,0,0
+            if dev not in devices:
+                devices[dev] = (self.device_type(path,dev),[])
+            devices[dev][1].append((item,path,ino,size))
+        scheduled = []
+        for dev in devices:
+            device_type,items = devices[dev]
+            # Separate large files
+            if self.small_file_threshold is not None:
+                large = [x for x in items if x[3] >= self.small_file_threshold]
+                items = [x for x in items if x[3] < self.small_file_threshold]
+            else:
+                large = []
+            # Largest files first
+            large.sort(key=lambda x: x[3],reverse=True)
+            tasks = [[item] for item,path,ino,size in large]
+            # Order remaining files on the device
+            if self.order == 'extent':
+                items = [(physical_offset(path,ino),item)
+                         for item,path,ino,size in items]
+            elif self.order == 'inode':
+                items = [(ino,item) for item,path,ino,size in items]
+            else:
+                items = [(0,item) for item,path,ino,size in items]
+            # Stable sort so that original order is kept for ties
+            items.sort(key=lambda x: x[0])
+            items = [item for key,item in items]
+            if self.small_file_threshold is not None:
+                # Batch small files
+                for i in xrange(0,len(items),self.batch_size):
+                    tasks.append(items[i:i+self.batch_size])
+            else:
+                tasks.extend([[item] for item in items])
+            scheduled.append((device_type,tasks))
+        return scheduled
+
+    def run(self,jobs,func):
+        """Run a function for each of the jobs
+
+        The jobs are grouped by device (see 'schedule') and then
+        processed by worker threads, with the number of threads
+        for each device depending on its type. Returns once all
+        jobs have been processed.
+
+        Arguments:
+          jobs: list of (item,path) tuples, where 'path' is the
+            file that will be read when processing 'item'
+          func: function which is called as 'func(item)' for each
+            job; it should handle its own errors
+
+        """
+        threads = []
+        for device_type,tasks in self.schedule(jobs):
+            queue = Queue.Queue()
+            for task in tasks:
+                queue.put(task)
+            nthreads = max(1,self.concurrency.get(device_type,1))
+            for i in xrange(min(nthreads,len(tasks))):
+                threads.append(threading.Thread(target=worker,
+                                                args=(queue,func)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def device_type(self,path,dev=None):
+        """Return the type of device that a file is stored on
+
+        Returns one of 'hdd', 'ssd', 'network' or 'unknown'.
+
+        """
+        path = os.path.abspath(path)
+        # Explicitly assigned device types
+        for prefix in sorted(self.device_types.keys(),key=len,reverse=True):
+            if path == prefix or path.startswith(prefix.rstrip(os.sep)+os.sep):
+                return self.device_types[prefix]
+        # Network filesystems
+        if filesystem_type(path) in NETWORK_FILESYSTEMS:
+            return 'network'
+        # Check if the underlying block device is rotational
+        if dev is None:
+            try:
+                dev = os.stat(path).st_dev
+            except OSError:
+                return 'unknown'
+        rotational = is_rotational(dev)
+        if rotational is None:
+            return 'unknown'
+        elif rotational:
+            return 'hdd'
+        else:
+            return 'ssd'
+
+#######################################################################
+# Functions
+#######################################################################
+
+def worker(queue,func):
+    """Worker thread function: process tasks from a queue
+
+    Each task is a list of items, and 'func' is called for
+    each item in turn.
+
+    """
+    while True:
+        try:
+            task = queue.get_nowait()
+        except Queue.Empty:
+            return
+        for item in task:
+            func(item)
+
+def parse_size(size):
+    """Convert a size string to a number of bytes
+
+    The size can be a plain integer, or have a suffix 'K', 'M'
+    or 'G' (e.g. '64K' is 65536 bytes). Raises ValueError if the
+    size can't be converted.
+
+    """
+    size = str(size).strip().upper()
+    multiplier = 1
+    for suffix,factor in (('K',1024),('M',1024**2),('G',1024**3)):
+        if size.endswith(suffix):
+            size = size[:-1]
+            multiplier = factor
+            break
+    return int(size)*multiplier
+
+def physical_offset(path,default=0):
+    """Return the physical location of the start of a file's data
+
+    Uses the FIEMAP ioctl (Linux only) to get the physical offset
+    on the device of the first extent of the file. Returns
+    'default' if this isn't available (e.g. on other platforms,
+    unsupported filesystems or empty files).
+
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return default
+    throttle.file_opened()
+    try:
+        fd = os.open(path,os.O_RDONLY)
+    except OSError:
+        return default
+    try:
+        # Request the first extent only
+        request = struct.pack(FIEMAP_FORMAT,0,0xffffffffffffffff,0,0,1,0) + \
+                  '\0'*struct.calcsize(FIEMAP_EXTENT_FORMAT)
+        result = fcntl.ioctl(fd,FS_IOC_FIEMAP,request)
+    except (IOError,OSError):
+        return default
+    finally:
+        os.close(fd)
+    header_size = struct.calcsize(FIEMAP_FORMAT)
+    mapped_extents = struct.unpack(FIEMAP_FORMAT,result[:header_size])[3]
+    if mapped_extents == 0:
+        return default
+    extent = struct.unpack(FIEMAP_EXTENT_FORMAT,result[header_size:])
+    return extent[1]
+
+def filesystem_type(path):
+    """Return the type of the filesystem that a path is on
+
+    Uses /proc/mounts on Linux; returns None if the type
+    can't be determined.
+
+    """
+    try:
+        fp = open('/proc/mounts','r')
+    except IOError:
+        return None
+    fstype = None
+    mount_point = ''
+    for line in fp:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # Mount points have spaces etc escaped as octal
+        mnt = fields[1].decode('string_escape')
+        if (path == mnt or path.startswith(mnt.rstrip('/')+'/')) and \
+           len(mnt) >= len(mount_point):
+            mount_point = mnt
+            fstype = fields[2]
+    fp.close()
+    return fstype
+
+def is_rotational(dev):
+    """Check if a device is a rotational (i.e. spinning) disk
+
+    Uses the block device information in /sys on Linux; returns
+    None if this isn't available.
+
+    """
+    sysfs = "/sys/dev/block/%d:%d" % (os.major(dev),os.minor(dev))
+    if not os.path.exists(sysfs):
+        return None
+    sysfs = os.path.realpath(sysfs)
+    # Partitions don't have a queue, so also try the parent device
+    for d in (sysfs,os.path.dirname(sysfs)):
+        rotational = os.path.join(d,'queue','rotational')
+        if os.path.exists(rotational):
+            try:
+                return (open(rotational).read().strip() == '1')
+            except IOError:
+                return None
+    return None
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import shutil
+import tempfile
+
+class TestIOScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.dirn = tempfile.mkdtemp()
+        self.files = []
+        for i in xrange(10):
+            filen = os.path.join(self.dirn,"file%d" % i)
+            fp = open(filen,'w')
+            fp.write("file %d\n" % i)
+            fp.close()
+            self.files.append(filen)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirn)
+
+    def test_schedule_by_inode(self):
+        """Test files are grouped by device and ordered by inode
+        """
+        jobs = [(os.path.basename(f),f) for f in reversed(self.files)]
+        scheduled = IOScheduler(order='inode').schedule(jobs)
+        self.assertEqual(len(scheduled),1)
+        for task in scheduled[0][1]:
+            self.assertEqual(len(task),1)
+        items = [task[0] for task in scheduled[0][1]]
+        inodes = [os.stat(os.path.join(self.dirn,f)).st_ino
+                  for f in items]
+        self.assertEqual(inodes,sorted(inodes))
+        self.assertEqual(sorted(items),sorted([f for f,path in jobs]))
+
+    def test_schedule_no_ordering(self):
+        """Test files keep their original order with order='none'
+        """
+        jobs = [(os.path.basename(f),f) for f in reversed(self.files)]
+        scheduled = IOScheduler(order='none').schedule(jobs)
+        self.assertEqual(scheduled[0][1],[[f] for f,path in jobs])
+
+    def test_schedule_large_and_small_files(self):
+        """Test large files are scheduled first and small files batched
+        """
+        for i,size in ((0,10000),(1,30000),(2,20000)):
+            fp = open(self.files[i],'w')
+            fp.write('x'*size)
+            fp.close()
+        jobs = [(os.path.basename(f),f) for f in self.files]
+        scheduled = IOScheduler(order='none',small_file_threshold=10000,
+                                batch_size=4).schedule(jobs)
+        self.assertEqual(scheduled[0][1],[['file1'],['file2'],['file0'],
+                                          ['file3','file4','file5','file6'],
+                                          ['file7','file8','file9']])
+
+    def test_parse_size(self):
+        """Test converting size strings to bytes
+        """
+        self.assertEqual(parse_size('1000'),1000)
+        self.assertEqual(parse_size('64K'),65536)
+        self.assertEqual(parse_size('2m'),2097152)
+        self.assertEqual(parse_size('1G'),1073741824)
+        self.assertRaises(ValueError,parse_size,'big')
+
+    def test_device_types(self):
+        """Test overriding the device type for a path
+        """
+        s = IOScheduler(device_types={ self.dirn: 'network' })
+        self.assertEqual(s.device_type(self.files[0]),'network')
+        self.assertTrue(IOScheduler().device_type(self.files[0]) in
+                        DEVICE_CONCURRENCY)
+
+    def test_run(self):
+        """Test running a function on all the jobs
+        """
+        results = {}
+        lock = threading.Lock()
+        def func(item):
+            with lock:
+                results[item] = open(os.path.join(self.dirn,item)).read()
+        jobs = [(os.path.basename(f),f) for f in self.files]
+        IOScheduler(concurrency={ 'unknown': 3, 'hdd': 3, 'ssd': 3 }).run(jobs,func)
+        self.assertEqual(len(results),10)
+        self.assertEqual(results['file3'],"file 3\n")
+
+    def test_physical_offset(self):
+        """Test physical_offset returns a number
+        """
+        self.assertTrue(physical_offset(self.files[0],-1) >= -1)
+        self.assertEqual(physical_offset(os.path.join(self.dirn,'missing'),-1),
+                         -1)
+
+########################################################################
+# Main: test runner
+#########################################################################
+if __name__ == "__main__":
+    # Run tests
+    unittest.main()
@@ -48,7 +48,7 @@ setup(
     maintainer_email = 'peter.briggs@manchester.ac.uk',
     license = 'Artistic License 2.0',
     url = 'https://github.com/pjbriggs/md5compare',
-    py_modules = ['compare','go_compare','version','Md5sum'],
+    py_modules = ['compare','go_compare','version','Md5sum','agent','archive','cache','filters','scheduler','watch','manifest','throttle'],
     requires = ['PyQt (>=4.0)',],
     scripts = scripts,
     )
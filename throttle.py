@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+#
+#     throttle.py: limit the rate of file reads
+#     Copyright (C) University of Manchester 2013 Peter Briggs
+#
+########################################################################
+#
+# throttle.py
+#
+#########################################################################
+
+"""throttle
+
+Provides the Throttle class, which limits the rate at which data is
+read and files are opened so that a comparison can run alongside
+other work on shared storage without saturating it:
+
+>>> throttle.install(Throttle(max_read_rate=50*MB,max_opens=200))
+
+Once a throttle has been installed, the functions in the Md5sum
+module call file_opened before opening each file and data_read
+after each block of data is read; these block the calling thread
+as needed to keep within the limits. The limits are global, so
+they apply to the total across all threads (e.g. when using the
+I/O scheduler).
+
+Each limit is implemented as a token bucket (see TokenBucket),
+which allows short bursts of up to a second's worth of reads but
+otherwise keeps to the average rate.
+
+The limits can be changed while a comparison is running by writing
+them to a control file, for example:
+
+    max-read-rate=20
+    max-opens-per-sec=100
+
+(the read rate is in MB/s; a value of 0 means no limit). The file
+is checked for changes every few seconds; if it's removed then the
+original limits are restored.
+
+The set_io_priority function can also be used to lower the I/O
+priority of the process (Linux only).
+
+"""
+
+#######################################################################
+# Import modules that this module depends on
+#######################################################################
+
+import os
+import time
+import errno
+import logging
+import platform
+import threading
+
+#######################################################################
+# Module constants
+#######################################################################
+
+MB = 1024*1024
+
+# Number of seconds' worth of tokens which can be used in a burst
+BURST_TIME = 1.0
+
+# Minimum interval in seconds between checks of the control file
+CONTROL_CHECK_INTERVAL = 2.0
+
+# Names of the limits in the control file
+CONTROL_KEYS = ('max-read-rate','max-opens-per-sec')
+
+# I/O scheduling classes for ioprio_set (from <linux/ioprio.h>)
+IOPRIO_CLASSES = { 'realtime': 1,
+                   'best-effort': 2,
+                   'idle': 3 }
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# ioprio_set system call numbers for each architecture
+SYS_IOPRIO_SET = { 'x86_64': 251,
+                   'i386': 289,
+                   'i686': 289,
+                   'aarch64': 30,
+                   'armv7l': 314,
+                   'ppc64le': 273,
+                   's390x': 282 }
+
+#######################################################################
+# Classes
+#######################################################################
+
+class TokenBucket:
+    """Class implementing a thread-safe token bucket
+
+    Tokens are added to the bucket at 'rate' per second, up to a
+    maximum of 'burst'. Taking tokens from the bucket with consume
+    never fails: if there aren't enough then the bucket goes into
+    debt, and the caller sleeps until the debt would have been
+    repaid. Since each caller reserves its tokens before sleeping,
+    the total rate across all threads stays within the limit.
+
+    """
+    def __init__(self,rate=None,burst=None,clock=time.time,
+                 sleep=time.sleep):
+        """Create a new TokenBucket object
+
+        Arguments:
+          rate: number of tokens added per second (None or 0
+            for no limit)
+          burst: (optional) maximum number of tokens in the bucket
+            (defaults to BURST_TIME seconds' worth, and at least 1)
+          clock: (optional) function returning the current time
+          sleep: (optional) function used to wait
+
+        """
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self.rate = None
+        self.burst = None
+        self._tokens = 0
+        self.set_rate(rate,burst)
+
+    def set_rate(self,rate,burst=None):
+        """Change the rate (and optionally the burst size)
+
+        """
+        with self._lock:
+            if not rate:
+                rate = None
+            elif burst is None:
+                burst = max(rate*BURST_TIME,1)
+            self.rate = rate
+            self.burst = burst
+            if rate is not None:
+                # Start with a full bucket
+                self._tokens = burst
+                self._last = self._clock()
+
+    def consume(self,n=1):
+        """Take tokens from the bucket, waiting if necessary
+
+        Returns the number of seconds spent waiting.
+
+        """
+        with self._lock:
+            if self.rate is None:
+                return 0.0
+            now = self._clock()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last)*self.rate)
+            self._last = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0.0
+            wait = -self._tokens/float(self.rate)
+        self._sleep(wait)
+        return wait
+
+class Throttle:
+    """Class limiting the rate of reads and file opens
+
+    """
+    def __init__(self,max_read_rate=None,max_opens=None,control_file=None,
+                 clock=time.time,sleep=time.sleep):
+        """Create a new Throttle object
+
+        Arguments:
+          max_read_rate: (optional) maximum number of bytes read
+            per second
+          max_opens: (optional) maximum number of files opened
+            per second
+          control_file: (optional) file to check for new limits
+            (see the module documentation)
+          clock: (optional) function returning the current time
+          sleep: (optional) function used to wait
+
+        """
+        self._defaults = (max_read_rate,max_opens)
+        self._reads = TokenBucket(clock=clock,sleep=sleep)
+        self._opens = TokenBucket(clock=clock,sleep=sleep)
+        self.set_limits(max_read_rate,max_opens)
+        self._clock = clock
+        self._control_file = control_file
+        self._control_mtime = None
+        self._next_check = 0
+        self._check_lock = threading.Lock()
+
+    def set_limits(self,max_read_rate=None,max_opens=None):
+        """Change the limits (None for no limit)
+
+        """
+        self._reads.set_rate(max_read_rate)
+        self._opens.set_rate(max_opens)
+
+    def limits(self):
+        """Return the current limits as (max_read_rate,max_opens)
+
+        """
+        return (self._reads.rate,self._opens.rate)
+
+    def file_opened(self):
+        """Account for a file being opened, waiting if necessary
+
+        """
+        self.check_control_file()
+        return self._opens.consume(1)
+
+    def data_read(self,nbytes):
+        """Account for data being read, waiting if necessary
+
+        """
+        self.check_control_file()
+        return self._reads.consume(nbytes)
+
+    def check_control_file(self,force=False):
+        """Update the limits if the control file has changed
+
+        The file is only checked at most once every
+        CONTROL_CHECK_INTERVAL seconds (unless 'force' is True).
+
+        """
+        if self._control_file is None:
+            return
+        now = self._clock()
+        if not force and now < self._next_check:
+            return
+        if not self._check_lock.acquire(False):
+            # Another thread is already checking
+            return
+        try:
+            self._next_check = now + CONTROL_CHECK_INTERVAL
+            try:
+                mtime = os.stat(self._control_file).st_mtime
+            except OSError,ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                mtime = None
+            if mtime == self._control_mtime:
+                return
+            self._control_mtime = mtime
+            if mtime is None:
+                logging.warning("%s: removed, restoring original limits" %
+                                self._control_file)
+                self.set_limits(*self._defaults)
+                return
+            try:
+                limits = read_control_file(self._control_file)
+            except (IOError,ValueError),ex:
+                logging.warning("%s: ignored (%s)" % (self._control_file,ex))
+                return
+            max_read_rate,max_opens = self._defaults
+            if 'max-read-rate' in limits:
+                max_read_rate = limits['max-read-rate']
+                if max_read_rate is not None:
+                    max_read_rate *= MB
+            if 'max-opens-per-sec' in limits:
+                max_opens = limits['max-opens-per-sec']
+            logging.warning("%s: setting limits to %s" %
+                            (self._control_file,
+                             format_limits(max_read_rate,max_opens)))
+            self.set_limits(max_read_rate,max_opens)
+        finally:
+            self._check_lock.release()
+
+#######################################################################
+# Functions
+#######################################################################
+
+# Throttle used by file_opened and data_read
+_throttle = None
+
+def install(throttle):
+    """Use a Throttle for all subsequent reads (None to remove it)
+
+    """
+    global _throttle
+    _throttle = throttle
+
+def file_opened():
+    """Account for a file being opened using the installed throttle
+
+    """
+    if _throttle is not None:
+        _throttle.file_opened()
+
+def data_read(nbytes):
+    """Account for data being read using the installed throttle
+
+    """
+    if _throttle is not None:
+        _throttle.data_read(nbytes)
+
+def read_control_file(filen):
+    """Read limits from a control file
+
+    Lines have the form NAME=VALUE, where NAME is one of
+    CONTROL_KEYS; blank lines and lines starting with '#' are
+    ignored.
+
+    Returns:
+      Dictionary mapping names to values (floats, or None for no
+      limit).
+
+    Raises ValueError if the file contains anything else.
+
+    """
+    limits = {}
+    fp = open(filen,'r')
+    try:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                name,value = [x.strip() for x in line.split('=',1)]
+            except ValueError:
+                raise ValueError("bad line '%s'" % line)
+            if name not in CONTROL_KEYS:
+                raise ValueError("unrecognised limit '%s'" % name)
+            limits[name] = parse_limit(value)
+    finally:
+        fp.close()
+    return limits
+
+def parse_limit(value):
+    """Convert a limit to a float (or None if it's zero or 'none')
+
+    Raises ValueError if the value isn't a non-negative number.
+
+    """
+    if value.lower() == 'none':
+        return None
+    limit = float(value)
+    if limit < 0:
+        raise ValueError("negative limit '%s'" % value)
+    if limit == 0:
+        return None
+    return limit
+
+def format_limits(max_read_rate,max_opens):
+    """Return a description of limits for reporting
+
+    """
+    limits = []
+    if max_read_rate:
+        limits.append("%.1f MB/s" % (float(max_read_rate)/MB))
+    if max_opens:
+        limits.append("%g files/s" % max_opens)
+    if not limits:
+        return "unlimited"
+    return ', '.join(limits)
+
+def parse_io_priority(spec):
+    """Convert an I/O priority specification to a (class,level) tuple
+
+    The specification is a class name (one of IOPRIO_CLASSES),
+    optionally followed by a colon and a level from 0 (highest)
+    to 7 (lowest), e.g. 'idle' or 'best-effort:7'.
+
+    Raises ValueError if the specification isn't valid.
+
+    """
+    if ':' in spec:
+        ioclass,level = spec.split(':',1)
+        try:
+            level = int(level)
+        except ValueError:
+            raise ValueError("bad level '%s'" % level)
+        if level < 0 or level > 7:
+            raise ValueError("level must be between 0 and 7")
+    else:
+        ioclass,level = spec,None
+    if ioclass not in IOPRIO_CLASSES:
+        raise ValueError("unrecognised class '%s'" % ioclass)
+    if level is None:
+        if ioclass == 'idle':
+            level = 0
+        else:
+            level = 4
+    return (ioclass,level)
+
+def set_io_priority(ioclass,level=4):
+    """Set the I/O priority of the current process (Linux only)
+
+    Uses the ioprio_set system call, in the same way as the
+    'ionice' utility. Threads inherit the priority of the thread
+    which creates them, so this should be called before any worker
+    threads are started. The priority only has an effect with I/O
+    schedulers which support it (e.g. CFQ and BFQ).
+
+    Arguments:
+      ioclass: name of the scheduling class (one of IOPRIO_CLASSES)
+      level: priority level within the class, from 0 (highest)
+        to 7 (lowest)
+
+    Raises OSError if the priority can't be set.
+
+    """
+    syscall_number = SYS_IOPRIO_SET.get(platform.machine())
+    if syscall_number is None:
+        raise OSError(errno.ENOSYS,"ioprio_set is not available")
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        syscall = libc.syscall
+    except (ImportError,OSError,AttributeError,TypeError):
+        raise OSError(errno.ENOSYS,"ioprio_set is not available")
+    ioprio = (IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT) | level
+    if syscall(syscall_number,IOPRIO_WHO_PROCESS,0,ioprio) < 0:
+        err = ctypes.get_errno()
+        raise OSError(err,os.strerror(err))
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import shutil
+import tempfile
+
+class FakeClock:
+    """Clock for tests, which advances when 'sleeping'
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+    def time(self):
+        return self.now
+    def sleep(self,seconds):
+        self.now += seconds
+        self.slept += seconds
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def _bucket(self,rate,burst=None):
+        return TokenBucket(rate,burst,clock=self.clock.time,
+                           sleep=self.clock.sleep)
+
+    def test_no_limit(self):
+        """Test TokenBucket with no rate doesn't wait
+        """
+        bucket = self._bucket(None)
+        for i in range(1000):
+            self.assertEqual(bucket.consume(1000000),0.0)
+
+    def test_rate_limit(self):
+        """Test TokenBucket keeps to the rate after the initial burst
+        """
+        bucket = self._bucket(100)
+        # Full bucket allows a burst
+        self.assertEqual(bucket.consume(100),0.0)
+        # Then 1000 more tokens take 10 seconds
+        for i in range(10):
+            bucket.consume(100)
+        self.assertAlmostEqual(self.clock.slept,10.0)
+
+    def test_tokens_accumulate_up_to_burst(self):
+        """Test TokenBucket refills while idle, up to the burst size
+        """
+        bucket = self._bucket(10,burst=20)
+        bucket.consume(20)
+        self.clock.now += 100
+        self.assertEqual(bucket.consume(20),0.0)
+        self.assertAlmostEqual(bucket.consume(10),1.0)
+
+    def test_change_rate(self):
+        """Test changing the rate of a TokenBucket
+        """
+        bucket = self._bucket(10)
+        bucket.consume(10)
+        bucket.set_rate(None)
+        self.assertEqual(bucket.consume(1000),0.0)
+        bucket.set_rate(5)
+        bucket.consume(5)
+        self.assertAlmostEqual(bucket.consume(5),1.0)
+
+class TestThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wd = tempfile.mkdtemp()
+        self.control_file = os.path.join(self.wd,'limits')
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def _write_control_file(self,text,mtime):
+        fp = open(self.control_file,'w')
+        fp.write(text)
+        fp.close()
+        os.utime(self.control_file,(mtime,mtime))
+
+    def test_limits(self):
+        """Test Throttle limits reads and opens
+        """
+        t = Throttle(max_read_rate=MB,max_opens=10,
+                     clock=self.clock.time,sleep=self.clock.sleep)
+        for i in range(5):
+            t.data_read(MB)
+        self.assertAlmostEqual(self.clock.slept,4.0)
+        for i in range(30):
+            t.file_opened()
+        self.assertAlmostEqual(self.clock.slept,6.0)
+
+    def test_control_file(self):
+        """Test Throttle picks up limits from the control file
+        """
+        t = Throttle(max_read_rate=MB,control_file=self.control_file,
+                     clock=self.clock.time,sleep=self.clock.sleep)
+        t.check_control_file()
+        self.assertEqual(t.limits(),(MB,None))
+        self._write_control_file("# Limits\nmax-read-rate=2.5\n"
+                                 "max-opens-per-sec = 100\n",1000)
+        # Not checked again until the interval has passed
+        t.check_control_file()
+        self.assertEqual(t.limits(),(MB,None))
+        self.clock.now += CONTROL_CHECK_INTERVAL
+        t.check_control_file()
+        self.assertEqual(t.limits(),(2.5*MB,100))
+        self._write_control_file("max-read-rate=0\n",2000)
+        t.check_control_file(force=True)
+        self.assertEqual(t.limits(),(None,None))
+        # Bad file is ignored
+        self._write_control_file("max-read-rate=fast\n",3000)
+        t.check_control_file(force=True)
+        self.assertEqual(t.limits(),(None,None))
+        # Removing the file restores the original limits
+        os.remove(self.control_file)
+        t.check_control_file(force=True)
+        self.assertEqual(t.limits(),(MB,None))
+
+    def test_install(self):
+        """Test installing and removing a throttle
+        """
+        t = Throttle(max_opens=1,clock=self.clock.time,
+                     sleep=self.clock.sleep)
+        install(t)
+        try:
+            file_opened()
+            file_opened()
+            self.assertAlmostEqual(self.clock.slept,1.0)
+        finally:
+            install(None)
+        file_opened()
+        self.assertAlmostEqual(self.clock.slept,1.0)
+
+class TestParsing(unittest.TestCase):
+
+    def test_parse_limit(self):
+        """Test converting limit values
+        """
+        self.assertEqual(parse_limit('20'),20.0)
+        self.assertEqual(parse_limit('0.5'),0.5)
+        self.assertEqual(parse_limit('0'),None)
+        self.assertEqual(parse_limit('none'),None)
+        self.assertRaises(ValueError,parse_limit,'-1')
+        self.assertRaises(ValueError,parse_limit,'fast')
+
+    def test_parse_io_priority(self):
+        """Test converting I/O priority specifications
+        """
+        self.assertEqual(parse_io_priority('idle'),('idle',0))
+        self.assertEqual(parse_io_priority('best-effort'),('best-effort',4))
+        self.assertEqual(parse_io_priority('best-effort:7'),('best-effort',7))
+        self.assertRaises(ValueError,parse_io_priority,'best-effort:8')
+        self.assertRaises(ValueError,parse_io_priority,'lowest')
+
+    def test_format_limits(self):
+        """Test describing limits
+        """
+        self.assertEqual(format_limits(None,None),"unlimited")
+        self.assertEqual(format_limits(20*MB,100),"20.0 MB/s, 100 files/s")
+
+########################################################################
+# Main: test runner
+#########################################################################
+if __name__ == "__main__":
+    # Run tests
+    unittest.main()
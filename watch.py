@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+#
+#     watch.py: watch directories for changes using inotify
+#     Copyright (C) University of Manchester 2013 Peter Briggs
+#
+########################################################################
+#
+# watch.py
+#
+#########################################################################
+
+"""watch
+
+Provides the Watcher class, which uses the Linux inotify interface
+to watch one or more directory trees and reports the files which
+have been created, modified, moved or deleted:
+
+>>> w = Watcher(['/data','/mirror'])
+>>> w.poll()
+['run1/reads.fastq']
+
+Paths are returned relative to the top-level directories, so that
+a comparison can be updated by only re-examining the files which
+have changed (see compare.Compare.update_files).
+
+Changes are 'debounced': each file is only reported once there
+have been no further events for it for a short delay, so that files
+which are still being written aren't reported repeatedly. Files which
+never stop changing (e.g. log files) are still reported once they've
+been waiting for a maximum hold time.
+
+inotify is accessed directly via ctypes, so no additional packages
+are needed; it's only available on Linux.
+
+"""
+
+#######################################################################
+# Import modules that this module depends on
+#######################################################################
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+
+#######################################################################
+# Module constants
+#######################################################################
+
+# inotify event flags (from <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# Events to watch for
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+             IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Layout of the fixed part of an inotify event
+# (wd, mask, cookie, len), followed by 'len' bytes of name
+EVENT_HEADER = 'iIII'
+EVENT_HEADER_SIZE = struct.calcsize(EVENT_HEADER)
+EVENT_BUFFER_SIZE = 65536
+
+# Seconds to wait after the last event for a file before reporting it
+DEBOUNCE_DELAY = 2.0
+
+# Maximum seconds to hold back a file which keeps changing
+MAX_HOLD_TIME = 60.0
+
+#######################################################################
+# Classes
+#######################################################################
+
+class Inotify:
+    """Class providing a minimal interface to Linux inotify
+
+    """
+    def __init__(self):
+        """Create a new Inotify object
+
+        Raises OSError if inotify isn't available.
+
+        """
+        self._libc = _get_libc()
+        if self._libc is None:
+            raise OSError(errno.ENOSYS,"inotify is not available")
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise _os_error()
+
+    def add_watch(self,path,mask=WATCH_MASK):
+        """Start watching a directory and return the watch descriptor
+
+        Adding a watch for a directory which is already being
+        watched returns the existing watch descriptor.
+
+        """
+        wd = self._libc.inotify_add_watch(self.fd,path,mask)
+        if wd < 0:
+            ex = _os_error(path)
+            if ex.errno == errno.ENOSPC:
+                ex.strerror = "too many watches (increase " \
+                              "/proc/sys/fs/inotify/max_user_watches)"
+            raise ex
+        return wd
+
+    def rm_watch(self,wd):
+        """Stop watching a directory
+
+        """
+        self._libc.inotify_rm_watch(self.fd,wd)
+
+    def read_events(self,timeout=None):
+        """Return pending events, waiting up to 'timeout' seconds
+
+        Returns a list of (wd,mask,cookie,name) tuples, which is
+        empty if no events arrived before the timeout.
+
+        """
+        try:
+            ready = select.select([self.fd],[],[],timeout)[0]
+        except select.error,ex:
+            if ex.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+        return parse_events(os.read(self.fd,EVENT_BUFFER_SIZE))
+
+    def close(self):
+        """Stop watching and release the inotify file descriptor
+
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class Watcher:
+    """Class reporting changes to files in a set of directories
+
+    All subdirectories are watched (apart from any excluded by
+    the file filter), and new subdirectories are watched as they
+    are created. Each changed file is reported using its path
+    relative to the top-level directory, so a file changing in
+    any of the directories is reported once under the same
+    name.
+
+    """
+    def __init__(self,dirs,file_filter=None,delay=DEBOUNCE_DELAY,
+                 max_hold=MAX_HOLD_TIME):
+        """Create a new Watcher object
+
+        Arguments:
+          dirs: list of directories to watch
+          file_filter: (optional) filters.FileFilter object used
+            to exclude files and directories
+          delay: number of seconds with no further events for a
+            file to wait before reporting it
+          max_hold: maximum number of seconds to wait before
+            reporting a file which keeps changing
+
+        """
+        self._dirs = list(dirs)
+        self._filter = file_filter
+        self._delay = delay
+        self._max_hold = max_hold
+        self._inotify = Inotify()
+        # Map watch descriptors to (top-level directory,subdirectory)
+        self._watches = {}
+        # Relative paths of all files seen so far
+        self._files = set()
+        # Changed files not yet reported, mapped to the times of
+        # their first and last events
+        self._pending = {}
+        self._now = time.time()
+        for top in self._dirs:
+            self._add_watches(top,'')
+
+    def poll(self,timeout=None):
+        """Wait for changes and return the files which changed
+
+        Waits until at least one changed file is ready to be
+        reported (i.e. there have been no events for it for the
+        debounce delay, or it has been waiting for the maximum
+        hold time), and then returns a sorted list of the relative
+        paths of all the files which are ready (files which have
+        been deleted are also included). Files which are still
+        changing are held back for a later call. If no changes
+        are ready after 'timeout' seconds then an empty list is
+        returned.
+
+        Arguments:
+          timeout: (optional) maximum number of seconds to wait
+            (default is to wait indefinitely)
+
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        else:
+            deadline = None
+        while True:
+            now = time.time()
+            wait = None
+            changed = []
+            for path,(first,last) in self._pending.iteritems():
+                ready = min(last + self._delay,first + self._max_hold)
+                if ready <= now:
+                    changed.append(path)
+                elif wait is None or ready - now < wait:
+                    wait = ready - now
+            if changed:
+                for path in changed:
+                    del self._pending[path]
+                changed.sort()
+                return changed
+            if deadline is not None:
+                if now >= deadline:
+                    return []
+                if wait is None or deadline - now < wait:
+                    wait = deadline - now
+            events = self._inotify.read_events(wait)
+            if events:
+                self._now = time.time()
+                for event in events:
+                    self._handle_event(*event)
+
+    def close(self):
+        """Stop watching the directories
+
+        """
+        self._inotify.close()
+
+    def _handle_event(self,wd,mask,cookie,name):
+        """Internal: update the pending changes for an inotify event
+
+        """
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost so assume everything changed
+            for top in self._dirs:
+                self._add_changes(self._add_watches(top,''))
+            self._add_changes(self._files)
+            return
+        if wd not in self._watches:
+            return
+        if mask & IN_IGNORED:
+            # Directory was deleted or unmounted
+            del self._watches[wd]
+            return
+        top,subdir = self._watches[wd]
+        path = os.path.join(subdir,name)
+        if mask & IN_ISDIR:
+            if self._filter is not None and self._filter.exclude_dir(path):
+                return
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                # Everything that was under the directory has gone
+                # (watches for a directory moved elsewhere in the tree
+                # are re-added by the corresponding IN_MOVED_TO)
+                for d in self._watches.keys():
+                    t,s = self._watches[d]
+                    if t == top and (s == path or s.startswith(path+os.sep)):
+                        self._inotify.rm_watch(d)
+                        del self._watches[d]
+                prefix = path + os.sep
+                self._add_changes([f for f in self._files
+                                   if f.startswith(prefix)])
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_changes(self._add_watches(top,path))
+            return
+        if self._filter is not None and self._filter.exclude_file(path):
+            return
+        self._files.add(path)
+        self._add_changes([path])
+
+    def _add_changes(self,paths):
+        """Internal: record events for files at the current event time
+
+        """
+        now = self._now
+        for path in paths:
+            try:
+                first,last = self._pending[path]
+            except KeyError:
+                first = now
+            self._pending[path] = (first,now)
+
+    def _add_watches(self,top,subdir):
+        """Internal: watch a directory and all its subdirectories
+
+        Returns a list of the relative paths of the files found
+        under the directory.
+
+        """
+        files = []
+        for dirpath,dirnames,filenames in os.walk(os.path.join(top,subdir)):
+            relpath = os.path.relpath(dirpath,top)
+            if relpath == '.':
+                relpath = ''
+            try:
+                wd = self._inotify.add_watch(dirpath)
+            except OSError,ex:
+                if ex.errno == errno.ENOSPC:
+                    raise
+                # Directory vanished or isn't readable
+                del dirnames[:]
+                continue
+            self._watches[wd] = (top,relpath)
+            if self._filter is not None:
+                dirnames[:] = [d for d in dirnames
+                               if not self._filter.exclude_dir(
+                                       os.path.join(relpath,d))]
+            for f in filenames:
+                path = os.path.join(relpath,f)
+                if self._filter is not None and self._filter.exclude_file(path):
+                    continue
+                files.append(path)
+        self._files.update(files)
+        return files
+
+#######################################################################
+# Functions
+#######################################################################
+
+def is_available():
+    """Check if inotify can be used on this system
+
+    """
+    return sys.platform.startswith('linux') and _get_libc() is not None
+
+def parse_events(data):
+    """Unpack inotify events from data read from the inotify descriptor
+
+    Returns a list of (wd,mask,cookie,name) tuples.
+
+    """
+    events = []
+    i = 0
+    while i + EVENT_HEADER_SIZE <= len(data):
+        wd,mask,cookie,length = struct.unpack_from(EVENT_HEADER,data,i)
+        i += EVENT_HEADER_SIZE
+        name = data[i:i+length].rstrip('\0')
+        i += length
+        events.append((wd,mask,cookie,name))
+    return events
+
+def _get_libc():
+    """Internal: return the C library if it provides inotify (or None)
+
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (ImportError,OSError,AttributeError,TypeError):
+        return None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int,ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int,ctypes.c_int]
+    return libc
+
+def _os_error(path=None):
+    """Internal: return an OSError for the last C library error
+
+    """
+    import ctypes
+    err = ctypes.get_errno()
+    if path is not None:
+        return OSError(err,os.strerror(err),path)
+    return OSError(err,os.strerror(err))
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import shutil
+import tempfile
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        if not is_available():
+            self.skipTest("inotify not available")
+        self.wd = tempfile.mkdtemp()
+        self.dirs = []
+        for d in ('a','b'):
+            dirn = os.path.join(self.wd,d)
+            os.mkdir(dirn)
+            os.mkdir(os.path.join(dirn,'sub'))
+            self._write(os.path.join(dirn,'sub','file.txt'),"hello!")
+            self.dirs.append(dirn)
+        self.watcher = Watcher(self.dirs,delay=0.1)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.wd)
+
+    def _write(self,filen,text):
+        fp = open(filen,'w')
+        fp.write(text)
+        fp.close()
+
+    def test_modified_and_created_files(self):
+        """Test Watcher reports modified and new files
+        """
+        self._write(os.path.join(self.dirs[0],'sub','file.txt'),"goodbye")
+        self._write(os.path.join(self.dirs[1],'new.txt'),"new")
+        self.assertEqual(self.watcher.poll(timeout=5),
+                         ['new.txt',os.path.join('sub','file.txt')])
+        self.assertEqual(self.watcher.poll(timeout=0.2),[])
+
+    def test_new_and_removed_directories(self):
+        """Test Watcher reports files in new and removed directories
+        """
+        os.mkdir(os.path.join(self.dirs[0],'new'))
+        self._write(os.path.join(self.dirs[0],'new','file.txt'),"new")
+        shutil.rmtree(os.path.join(self.dirs[1],'sub'))
+        self.assertEqual(self.watcher.poll(timeout=5),
+                         [os.path.join('new','file.txt'),
+                          os.path.join('sub','file.txt')])
+
+    def test_busy_file_does_not_hold_back_others(self):
+        """Test Watcher reports quiet files while another keeps changing
+        """
+        self.watcher.close()
+        self.watcher = Watcher(self.dirs,delay=0.3,max_hold=1.5)
+        busy = os.path.join(self.dirs[0],'busy.log')
+        self._write(os.path.join(self.dirs[1],'sub','file.txt'),"changed")
+        start = time.time()
+        reported = []
+        while time.time() - start < 3 and len(reported) < 2:
+            fp = open(busy,'a')
+            fp.write("more\n")
+            fp.close()
+            for f in self.watcher.poll(timeout=0.1):
+                reported.append((f,time.time()-start))
+        self.assertEqual([f for f,t in reported],
+                         [os.path.join('sub','file.txt'),'busy.log'])
+        # Quiet file reported after the delay, not held back
+        self.assertTrue(reported[0][1] < 1.0)
+        # Busy file reported after the maximum hold time
+        self.assertTrue(reported[1][1] >= 1.4)
+
+    def test_parse_events(self):
+        """Test unpacking inotify event data
+        """
+        data = struct.pack(EVENT_HEADER,1,IN_CREATE,0,8) + "abc\0\0\0\0\0" + \
+               struct.pack(EVENT_HEADER,2,IN_DELETE|IN_ISDIR,0,0)
+        self.assertEqual(parse_events(data),
+                         [(1,IN_CREATE,0,'abc'),
+                          (2,IN_DELETE|IN_ISDIR,0,'')])
+
+########################################################################
+# Main: test runner
+#########################################################################
+if __name__ == "__main__":
+    # Run tests
+    unittest.main()